@@ -1,9 +1,12 @@
 import streamlit as st
-from sentence_transformers import SentenceTransformer
 
 from constants import *
+from embeddings.embeddings import BackgroundEmbeddingModel
 from database.retrieve import retrieve_relevant_chunks
-from generation.generation import build_prompt, get_llm_answer
+from database.retrievers import without_embeddings
+from generation.generation import build_prompt, GenerationError
+from caching.caching import stream_answer, cache_stats
+from tracing.tracing import start_trace, span
 
 
 # --- Page Configuration ---
@@ -33,12 +36,34 @@ with st.sidebar:
                                      value=SIMILARITY_THRESHOLD,
                                      step=0.05,
                                      help="Minimum similarity score for a chunk to be considered relevant.")
+    # The full-text search needs Postgres, the local backend only supports the vector search
+    retrieval_modes = ["vector", "hybrid"] if RETRIEVAL_BACKEND == "pgvector" else ["vector"]
+    retrieval_mode = st.radio(label="Retrieval Mode:",
+                              options=retrieval_modes,
+                              index=retrieval_modes.index(RETRIEVAL_MODE) if RETRIEVAL_MODE in retrieval_modes else 0,
+                              format_func=lambda mode: {"vector": "Semantic", "hybrid": "Hybrid (semantic + keywords)"}[mode],
+                              help="Hybrid retrieval also matches the exact words of the question (product names, tariff codes, figures).")
+
+    with st.expander("Filters"):
+        date_range = st.date_input(label="Published between:",
+                                   value=(),
+                                   help="Only search the press releases published in this date range.")
+        author = st.text_input(label="Author:", help="Only search the press releases of this author (exact name).")
+        source_link = st.text_input(label="Source Link:", help="Only search this press release.")
+    # A range with only its start picked yet filters from that date on
+    retrieval_filters = {
+        "date_from": date_range[0] if len(date_range) > 0 else None,
+        "date_to": date_range[1] if len(date_range) > 1 else None,
+        "author": author.strip() or None,
+        "source_link": source_link.strip() or None,
+    }
 
 
 # --- Initialize Components ---
 @st.cache_resource
 def initialize_components():
-    return SentenceTransformer(EMBEDDING_MODEL)
+    # The page renders while the model loads, the first question waits for it if needed
+    return BackgroundEmbeddingModel()
 
 embedding_model = initialize_components()
 
@@ -49,27 +74,40 @@ with st.form(key='question_form'):
     submit_button = st.form_submit_button(label='Get Answer')
 
 if submit_button and user_question:
-    with st.spinner("Analyzing press releases..."):
+    # Time every stage of the answer (no-op unless TRACING_ENABLED)
+    with start_trace("question"), st.spinner("Analyzing press releases..."):
         # 1. Retrieve relevant chunks
         relevant_chunks = retrieve_relevant_chunks(query_text=user_question,
                                                    model=embedding_model,
                                                    top_k=top_k,
-                                                   similarity_threshold=similarity_threshold)
+                                                   similarity_threshold=similarity_threshold,
+                                                   mode=retrieval_mode,
+                                                   filters=retrieval_filters)
 
         # (DEBUG) Show the debug view for retrieved chunks
         with st.expander("Show Retrieved Chunks (for debugging)"):
-            st.json(relevant_chunks)
+            st.json(without_embeddings(relevant_chunks))
 
         # Early exit if there are no relevant document chunks for the user's question
         if len(relevant_chunks) == 0:
             st.warning("No relevant information found in the press releases for your query.")
         else:
             # 2. Build the prompt for the LLM
-            prompt = build_prompt(user_question, relevant_chunks)
+            with span("build_prompt"):
+                prompt = build_prompt(user_question, relevant_chunks)
 
-            # 3. Get the answer from the LLM
-            llm_answer = get_llm_answer(prompt)
-
-            # 4. Display the answer
+            # 3. Get the answer from the LLM (or from the answer cache if this question was already answered)
+            # and display it incrementally, as the tokens arrive
+            chunk_ids = [chunk["id"] for chunk in relevant_chunks]
             st.subheader("Answer")
-            st.markdown(llm_answer)
+            with span("answer"):
+                try:
+                    st.write_stream(stream_answer(user_question, chunk_ids, prompt))
+                except GenerationError as e:
+                    st.error(e.user_message)
+
+
+# --- Cache statistics (rendered last so that they include the current request) ---
+with st.sidebar:
+    with st.expander("Cache Statistics"):
+        st.json(cache_stats())
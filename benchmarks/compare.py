@@ -0,0 +1,59 @@
+import sys
+import json
+import argparse
+
+
+def compare_results(old_results: dict, new_results: dict, tolerance: float = 0.1) -> list[str]:
+    """
+    Compare two benchmark result files run by run (matched by corpus size) and stage by stage. Print the p50/p95
+    latency and recall@k changes and return the regressions: a p95 latency more than `tolerance` higher, or a lower recall.
+    """
+    regressions = []
+    old_runs = {run["articles"]: run for run in old_results["runs"]}
+    for new_run in new_results["runs"]:
+        old_run = old_runs.get(new_run["articles"])
+        if old_run is None:
+            continue
+
+        print(f"\n{new_run['articles']} articles")
+        print(f"  {'stage':<36}{'p50 ms (old -> new)':>26}{'p95 ms (old -> new)':>26}{'change':>10}")
+        for name, new_stage in new_run["stages"].items():
+            old_stage = old_run["stages"].get(name)
+            if old_stage is None:
+                continue
+            change = (new_stage["p95_ms"] - old_stage["p95_ms"]) / old_stage["p95_ms"] if old_stage["p95_ms"] > 0 else 0.0
+            flag = " !" if change > tolerance else ""
+            print(f"  {name:<36}{old_stage['p50_ms']:>12.2f} -> {new_stage['p50_ms']:<10.2f}"
+                  f"{old_stage['p95_ms']:>12.2f} -> {new_stage['p95_ms']:<10.2f}{change:>+9.0%}{flag}")
+            if change > tolerance:
+                regressions.append(f"{new_run['articles']} articles, {name}: p95 {old_stage['p95_ms']:.2f} -> {new_stage['p95_ms']:.2f} ms")
+
+        for name, new_recall in new_run["recall_at_k"].items():
+            old_recall = old_run["recall_at_k"].get(name)
+            if old_recall is None:
+                continue
+            print(f"  recall@k {name}: {old_recall:.3f} -> {new_recall:.3f}")
+            if new_recall < old_recall:
+                regressions.append(f"{new_run['articles']} articles, recall@k {name}: {old_recall:.3f} -> {new_recall:.3f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files and report the regressions.")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative p95 latency increase.")
+    args = parser.parse_args()
+
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+
+    found_regressions = compare_results(old, new, args.tolerance)
+    if len(found_regressions) > 0:
+        print(f"\n{len(found_regressions)} regressions:")
+        for regression in found_regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\nNo regressions.")
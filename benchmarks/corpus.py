@@ -0,0 +1,75 @@
+import os
+import random
+from datetime import date, timedelta
+
+from scraping.chunk_store import ChunkStore
+
+
+# Words of the synthetic press releases. Every article is about one topic, so that its chunks (and the questions
+# asked about them) share a vocabulary and the vector search has real neighbours to find
+TOPIC_WORDS = {
+    "network": ["fiber", "5G", "antenna", "broadband", "coverage", "expansion", "households", "gigabit", "rollout", "towers"],
+    "ai": ["AI", "model", "assistant", "automation", "data", "machine", "learning", "chatbot", "platform", "agents"],
+    "finance": ["revenue", "quarter", "EBITDA", "growth", "guidance", "dividend", "investors", "results", "billion", "outlook"],
+    "security": ["cyber", "attacks", "protection", "firewall", "threats", "encryption", "phishing", "defense", "incidents", "SOC"],
+    "sustainability": ["climate", "emissions", "renewable", "energy", "recycling", "neutral", "green", "carbon", "solar", "targets"],
+    "tariffs": ["tariff", "mobile", "plan", "customers", "prepaid", "roaming", "unlimited", "price", "contract", "MagentaMobil"],
+    "partnerships": ["partner", "T-Systems", "cloud", "agreement", "alliance", "cooperation", "joint", "venture", "SAP", "Google"],
+}
+COMMON_WORDS = ["Deutsche", "Telekom", "the", "and", "with", "for", "new", "announced", "today", "in", "Germany", "Europe",
+                "customers", "company", "will", "has", "more", "than", "year", "services"]
+AUTHORS = ["Corporate Communications", "Investor Relations", "T-Systems Press Office", None]
+
+
+def make_sentence(rng: random.Random, topic: str, length: int) -> str:
+    """ A sentence mixing topic words (about half of them) with common press release words. """
+    words = [rng.choice(TOPIC_WORDS[topic]) if rng.random() < 0.5 else rng.choice(COMMON_WORDS) for _ in range(length)]
+    return " ".join(words).capitalize() + "."
+
+
+def make_article(rng: random.Random, index: int, chunks_per_article: int, sentences_per_chunk: int) -> dict:
+    """ One synthetic press release in the shape written by the scraper. """
+    topic = rng.choice(list(TOPIC_WORDS))
+    publish_date = date(2020, 1, 1) + timedelta(days=rng.randrange(6 * 365))
+    content = [" ".join(make_sentence(rng, topic, rng.randint(8, 20)) for _ in range(sentences_per_chunk))
+               for _ in range(chunks_per_article)]
+    return {
+        "title": f"Synthetic press release {index}: {make_sentence(rng, topic, 6)[:-1]}",
+        "date": publish_date.strftime("%m-%d-%Y"),
+        "author": rng.choice(AUTHORS),
+        "link": f"https://www.telekom.com/en/media/media-information/synthetic/press-release-{index}",
+        "content": content
+    }
+
+
+def generate_corpus(path: str, article_count: int, chunks_per_article: int = 8, sentences_per_chunk: int = 4,
+                    seed: int = 0) -> int:
+    """
+    Write `article_count` synthetic press releases to the chunk store at `path` (replaced if it exists). The corpus
+    only depends on the seed, so successive benchmark runs are comparable. Return the number of chunks written.
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    rng = random.Random(seed)
+    chunk_count = 0
+    with ChunkStore(path) as store:
+        for start in range(0, article_count, 1000):
+            articles = [make_article(rng, index, chunks_per_article, sentences_per_chunk)
+                        for index in range(start, min(start + 1000, article_count))]
+            store.put_articles(articles)
+            chunk_count += sum(len(article["content"]) for article in articles)
+    return chunk_count
+
+
+def generate_questions(count: int, seed: int = 1) -> list[str]:
+    """ Questions worded like the real ones, about the topics of the synthetic corpus. """
+    rng = random.Random(seed)
+    templates = ["What did Deutsche Telekom announce about {} and {}?", "How is Telekom improving {} for {}?",
+                 "Which {} news mention {}?", "What are the {} {} plans of Deutsche Telekom?"]
+    questions = []
+    for _ in range(count):
+        words = TOPIC_WORDS[rng.choice(list(TOPIC_WORDS))]
+        questions.append(rng.choice(templates).format(rng.choice(words), rng.choice(words)))
+    return questions
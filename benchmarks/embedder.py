@@ -0,0 +1,58 @@
+import re
+import hashlib
+
+import numpy as np
+
+from constants import *
+
+
+class HashingEmbedder:
+    """
+    A stand-in for the SentenceTransformer model which needs no download and no GPU: every word is hashed to a few
+    signed dimensions (feature hashing) and the sum is L2-normalized. Texts sharing words get similar embeddings, so
+    the retrieval has meaningful neighbours, and the vectors have the dimension of the DB column.
+    """
+
+    def __init__(self, dimension: int = VECTOR_DIMENSION, hashes_per_word: int = 4):
+        self.dimension = dimension
+        self.hashes_per_word = hashes_per_word
+        self._word_vectors = {}
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=4 * self.hashes_per_word).digest()
+            vector = np.zeros(self.dimension, dtype=np.float32)
+            for value in np.frombuffer(digest, dtype=np.uint32):
+                vector[value % self.dimension] += 1.0 if value & 0x80000000 else -1.0
+            self._word_vectors[word] = vector
+        return vector
+
+    def _encode_one(self, text: str) -> np.ndarray:
+        embedding = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            embedding += self._word_vector(word)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        """ Same call shape as `SentenceTransformer.encode`: one text gives a vector, a list gives a matrix. """
+        if isinstance(sentences, str):
+            return self._encode_one(sentences)
+        if len(sentences) == 0:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.stack([self._encode_one(sentence) for sentence in sentences])
+
+
+def get_embedding_model(name: str):
+    """
+    "hashing" for the offline stand-in, "onnx" for the exported ONNX model, anything else is loaded as a
+    SentenceTransformer model.
+    """
+    if name == "hashing":
+        return HashingEmbedder()
+    if name == "onnx":
+        from embeddings.embeddings import OnnxEmbedder
+        return OnnxEmbedder()
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
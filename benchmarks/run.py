@@ -0,0 +1,288 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.stub_llm import find_free_port, start_stub_llm
+
+# The generation stage talks to the local stub LLM and the pgvector stages to a dedicated database. Both are read
+# from the environment when constants.py is first imported, so they have to be set before the project imports
+STUB_LLM_PORT = find_free_port()
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{STUB_LLM_PORT}/v1"
+os.environ.setdefault("DB_NAME", "telekom_rag_benchmark")
+
+from constants import *  # noqa: E402
+from benchmarks.corpus import generate_corpus, generate_questions  # noqa: E402
+from benchmarks.embedder import get_embedding_model  # noqa: E402
+from benchmarks.stats import summarize_latencies, time_calls, timer, peak_rss_mb  # noqa: E402
+from database.evaluate import recall_at_k  # noqa: E402
+from database.ingest import read_articles  # noqa: E402
+from scraping.chunk_store import ChunkStore  # noqa: E402
+from database.local_index import LocalIndexWriter, LocalMatrixRetriever  # noqa: E402
+from generation.generation import build_prompt, request_llm_answer, stream_llm_answer  # noqa: E402
+
+
+def benchmark_ingestion(corpus_path: str, model) -> tuple[dict, list[dict], np.ndarray]:
+    """ Time the read and encode stages of the ingestion separately. Return the timings, the chunks and their embeddings. """
+    stages = {}
+    with timer({}) as measurement, ChunkStore(corpus_path) as store:
+        articles = list(read_articles(store, set()))
+    chunks = [{"content": content, "title": article["title"], "author": article["author"],
+               "publish_date": article["publish_date"].strftime("%Y-%m-%d"), "source_link": article["source_link"]}
+              for article in articles for content in article["chunks"].values()]
+    stages["ingest.read"] = summarize_latencies([measurement["seconds"]], items=len(chunks))
+
+    batches = [[chunk["content"] for chunk in chunks[start:start + INGESTION_BATCH_SIZE]]
+               for start in range(0, len(chunks), INGESTION_BATCH_SIZE)]
+    latencies, embeddings = time_calls(model.encode, batches)
+    stages["ingest.encode"] = summarize_latencies(latencies, items=len(chunks))
+    return stages, chunks, np.concatenate(embeddings).astype(np.float32)
+
+
+def benchmark_searches(retriever, query_embeddings: list, top_k: int) -> tuple[dict, list[list]]:
+    """ Time one search per question, then all of them as one batch. Return the timings and the retrieved ids. """
+    latencies, results = time_calls(lambda query_embedding: retriever.search(query_embedding, top_k, -1.0),
+                                    query_embeddings)
+    with timer({}) as measurement:
+        retriever.batch_search(query_embeddings, top_k, -1.0)
+    stages = {
+        "single": summarize_latencies(latencies),
+        "batch": summarize_latencies([measurement["seconds"]], items=len(query_embeddings)),
+    }
+    return stages, [[chunk["id"] for chunk in chunks] for chunks in results]
+
+
+def mean_recall(retrieved_ids: list[list], exact_ids: list[list]) -> float:
+    return round(float(np.mean([recall_at_k(ids, exact) for ids, exact in zip(retrieved_ids, exact_ids)])), 4)
+
+
+def benchmark_local_backend(chunks: list[dict], embeddings: np.ndarray, query_embeddings: list, top_k: int,
+                            work_dir: str) -> tuple[dict, dict, dict, list[list[dict]]]:
+    """
+    Write the local index in each dtype and time its searches. float32 is the exact search the recall is measured
+    against. Also return the float32 results, the context of the prompt and generation stages.
+    """
+    stages, recalls, sizes = {}, {}, {}
+    exact_ids, exact_results = None, None
+    for dtype in ("float32", "float16"):
+        directory = os.path.join(work_dir, f"local_index_{dtype}")
+        with timer({}) as measurement:
+            with LocalIndexWriter(directory, dtype) as writer:
+                for start in range(0, len(chunks), INGESTION_BATCH_SIZE):
+                    metadata_rows = [{"id": start + i, **chunk} for i, chunk in enumerate(chunks[start:start + INGESTION_BATCH_SIZE])]
+                    writer.add(embeddings[start:start + INGESTION_BATCH_SIZE], metadata_rows)
+        stages[f"ingest.local.{dtype}"] = summarize_latencies([measurement["seconds"]], items=len(chunks))
+        sizes[f"local.{dtype}"] = round(sum(os.path.getsize(path) for path in glob.glob(os.path.join(directory, "*"))) / 2**20, 2)
+
+        with LocalMatrixRetriever(directory) as retriever:
+            search_stages, retrieved_ids = benchmark_searches(retriever, query_embeddings, top_k)
+            if exact_ids is None:
+                exact_ids = retrieved_ids
+                exact_results = retriever.batch_search(query_embeddings, top_k, -1.0)
+        stages[f"search.local.{dtype}"] = search_stages["single"]
+        stages[f"search.local.{dtype}.batch"] = search_stages["batch"]
+        recalls[f"local.{dtype}"] = mean_recall(retrieved_ids, exact_ids)
+    return stages, recalls, sizes, exact_results
+
+
+def ensure_database():
+    """ Create the benchmark database (and its tables) if needed, from the default maintenance database. """
+    import psycopg2
+    from database.create import setup_database
+
+    admin_conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, dbname="postgres", user=DB_USER, password=DB_PASSWORD)
+    admin_conn.autocommit = True
+    with admin_conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (DB_NAME,))
+        if cur.fetchone() is None:
+            print(f"Creating the benchmark database '{DB_NAME}'...")
+            cur.execute(f'CREATE DATABASE "{DB_NAME}";')
+    admin_conn.close()
+
+    from database import pooled_connection
+    with pooled_connection() as conn:
+        setup_database(conn)
+
+
+def benchmark_pgvector_backend(corpus_path: str, model, query_embeddings: list, top_k: int,
+                               index_types: list[str]) -> tuple[dict, dict, dict]:
+    """
+    Load the corpus into the benchmark database with the real ingestion pipeline, then time the searches with each
+    ANN index type against the exact (sequential scan) search.
+    """
+    from database import pooled_connection, clear_db
+    from database.create import create_vector_index, get_vector_index_name
+    from database.ingest import process_and_insert_data
+    from database.retrievers import PgvectorRetriever
+
+    stages, recalls, sizes = {}, {}, {}
+    ensure_database()
+    clear_db()
+    with pooled_connection() as conn:
+        with timer({}) as measurement:
+            process_and_insert_data(conn, model, restart=True, chunk_store_path=corpus_path)
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM documents;")
+            chunk_count = cur.fetchone()[0]
+        conn.commit()
+    stages["ingest.pgvector"] = summarize_latencies([measurement["seconds"]], items=chunk_count)
+
+    exact_stages, exact_ids = benchmark_searches(PgvectorRetriever(exact=True), query_embeddings, top_k)
+    stages["search.pgvector.exact"] = exact_stages["single"]
+    stages["search.pgvector.exact.batch"] = exact_stages["batch"]
+
+    for index_type in index_types:
+        with pooled_connection() as conn:
+            with timer({}) as measurement:
+                create_vector_index(conn, index_type, rebuild=True)
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_relation_size(%s);", (get_vector_index_name(index_type, EMBEDDING_STORAGE),))
+                sizes[f"pgvector.{index_type}"] = round(cur.fetchone()[0] / 2**20, 2)
+        stages[f"index_build.{index_type}"] = summarize_latencies([measurement["seconds"]], items=chunk_count)
+
+        search_stages, retrieved_ids = benchmark_searches(PgvectorRetriever(), query_embeddings, top_k)
+        stages[f"search.pgvector.{index_type}"] = search_stages["single"]
+        stages[f"search.pgvector.{index_type}.batch"] = search_stages["batch"]
+        recalls[f"pgvector.{index_type}"] = mean_recall(retrieved_ids, exact_ids)
+    return stages, recalls, sizes
+
+
+def benchmark_generation(prompts: list[str]) -> dict:
+    """ Time complete answers and streamed answers (total and time to first token) from the stub LLM. """
+    latencies, _ = time_calls(request_llm_answer, prompts)
+    stages = {"generation": summarize_latencies(latencies)}
+
+    first_token_latencies, stream_latencies = [], []
+    for prompt in prompts:
+        start = time.perf_counter()
+        for i, _ in enumerate(stream_llm_answer(prompt)):
+            if i == 0:
+                first_token_latencies.append(time.perf_counter() - start)
+        stream_latencies.append(time.perf_counter() - start)
+    stages["generation.stream"] = summarize_latencies(stream_latencies)
+    stages["generation.stream.first_token"] = summarize_latencies(first_token_latencies)
+    return stages
+
+
+def run_benchmark(article_count: int, model, questions: list[str], args, work_dir: str) -> dict:
+    """ Benchmark every stage on a synthetic corpus of `article_count` press releases. """
+    print(f"\n=== {article_count} articles ===")
+    corpus_path = os.path.join(work_dir, "press_releases.sqlite")
+    chunk_count = generate_corpus(corpus_path, article_count, chunks_per_article=args.chunks_per_article, seed=args.seed)
+    run = {"articles": article_count, "chunks": chunk_count, "stages": {}, "recall_at_k": {}, "index_size_mb": {}}
+
+    print("Ingestion (read, encode)...")
+    stages, chunks, embeddings = benchmark_ingestion(corpus_path, model)
+    run["stages"].update(stages)
+
+    print("Query embedding...")
+    latencies, query_embeddings = time_calls(model.encode, questions)
+    run["stages"]["query_embedding"] = summarize_latencies(latencies)
+    with timer({}) as measurement:
+        model.encode(questions)
+    run["stages"]["query_embedding.batch"] = summarize_latencies([measurement["seconds"]], items=len(questions))
+
+    print("Local backend (write, search)...")
+    stages, recalls, sizes, context_chunks = benchmark_local_backend(chunks, embeddings, query_embeddings, args.top_k, work_dir)
+    run["stages"].update(stages)
+    run["recall_at_k"].update(recalls)
+    run["index_size_mb"].update(sizes)
+
+    if args.pgvector:
+        print(f"pgvector backend in database '{DB_NAME}' (ingest, index build, search)...")
+        stages, recalls, sizes = benchmark_pgvector_backend(corpus_path, model, query_embeddings, args.top_k, args.index_types)
+        run["stages"].update(stages)
+        run["recall_at_k"].update(recalls)
+        run["index_size_mb"].update(sizes)
+
+    print("Prompt building...")
+    latencies, prompts = time_calls(lambda i: build_prompt(questions[i], context_chunks[i]), range(len(questions)))
+    run["stages"]["build_prompt"] = summarize_latencies(latencies)
+
+    print("Generation (stub LLM)...")
+    run["stages"].update(benchmark_generation(prompts[:args.generation_calls]))
+
+    run["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return run
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(run: dict):
+    print(f"\n{run['articles']} articles / {run['chunks']} chunks (peak RSS {run['peak_rss_mb']} MB)")
+    print(f"  {'stage':<36}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'items/s':>12}")
+    for name, stage in run["stages"].items():
+        throughput = stage["throughput_per_s"] if stage["throughput_per_s"] is not None else float("nan")
+        print(f"  {name:<36}{stage['p50_ms']:>10.2f}{stage['p95_ms']:>10.2f}{stage['p99_ms']:>10.2f}{throughput:>12.1f}")
+    for name, recall in run["recall_at_k"].items():
+        print(f"  recall@k {name}: {recall:.3f}")
+    for name, size in run["index_size_mb"].items():
+        print(f"  size {name}: {size} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the RAG pipeline end to end on synthetic press releases (offline, CPU only).")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000],
+                        help="Corpus sizes, in articles.")
+    parser.add_argument("--chunks-per-article", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--embedder", default="hashing",
+                        help=f"'hashing' (offline stand-in) or a SentenceTransformer model name, e.g. '{EMBEDDING_MODEL}'.")
+    parser.add_argument("--pgvector", action="store_true",
+                        help="Also benchmark the Postgres backend, in the DB_NAME database (default: telekom_rag_benchmark). Its documents are replaced.")
+    parser.add_argument("--index-types", nargs="+", default=["hnsw", "ivfflat"], choices=["hnsw", "ivfflat"])
+    parser.add_argument("--generation-calls", type=int, default=20)
+    parser.add_argument("--llm-first-token-latency", type=float, default=0.2, help="Seconds.")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Results file (default: benchmark_results/benchmark_<timestamp>.json).")
+    args = parser.parse_args()
+
+    if args.pgvector and DB_NAME == "telekom_rag":
+        sys.exit("Refusing to replace the documents of the application database, set DB_NAME to another database.")
+
+    started_at = datetime.now(timezone.utc)
+    output = args.output or os.path.join("benchmark_results", f"benchmark_{started_at:%Y%m%dT%H%M%SZ}.json")
+    stub_server = start_stub_llm(STUB_LLM_PORT, args.llm_first_token_latency, args.llm_tokens_per_second)
+    embedding_model = get_embedding_model(args.embedder)
+    benchmark_questions = generate_questions(args.questions, seed=args.seed + 1)
+
+    results = {
+        "meta": {
+            "started_at": started_at.isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": vars(args),
+        },
+        "runs": [],
+    }
+    work_directory = tempfile.mkdtemp(prefix="rag_benchmark_")
+    try:
+        for size in args.sizes:
+            results["runs"].append(run_benchmark(size, embedding_model, benchmark_questions, args, work_directory))
+            print_run(results["runs"][-1])
+    finally:
+        stub_server.shutdown()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump(results, fp, indent=4)
+    print(f"\nResults written to '{output}'. Compare two runs with `python -m benchmarks.compare <old> <new>`.")
@@ -0,0 +1,54 @@
+import time
+import resource
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def peak_rss_mb() -> float:
+    """ Peak resident memory of this process so far, in MB (ru_maxrss is in KB on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize_latencies(latencies: list[float], items: int = None, total_seconds: float = None) -> dict:
+    """
+    Latency percentiles (in ms) of the timed calls, and the throughput in items per second.
+    `items` defaults to one per call and `total_seconds` to the sum of the latencies (pass the wall time of
+    concurrent calls instead).
+    """
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total_seconds = float(latencies.sum()) if total_seconds is None else total_seconds
+    items = len(latencies) if items is None else items
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) > 0 else (0.0, 0.0, 0.0)
+    return {
+        "calls": len(latencies),
+        "items": items,
+        "total_s": round(total_seconds, 4),
+        "throughput_per_s": round(items / total_seconds, 2) if total_seconds > 0 else None,
+        "mean_ms": round(float(latencies.mean()) * 1000, 3) if len(latencies) > 0 else 0.0,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def time_calls(function, arguments: list) -> tuple[list[float], list]:
+    """ Call `function` on each argument, return the latency of each call (in seconds) and the results. """
+    latencies, results = [], []
+    for argument in arguments:
+        start = time.perf_counter()
+        results.append(function(argument))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+@contextmanager
+def timer(measurement: dict):
+    """ Store the wall time of the block in `measurement["seconds"]`. """
+    start = time.perf_counter()
+    try:
+        yield measurement
+    finally:
+        measurement["seconds"] = time.perf_counter() - start
+
@@ -0,0 +1,110 @@
+import json
+import time
+import socket
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+STUB_ANSWER_WORDS = ("Based on the provided context, Deutsche Telekom announced several initiatives [Source 1]. "
+                     "Sources Used: [Source 1]").split(" ")
+
+
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """
+    Answer the OpenAI chat completions endpoint with a canned answer, after a fixed time to first token and at a
+    fixed token rate, so that the generation stage can be timed offline and reproducibly.
+    """
+    protocol_version = "HTTP/1.1"
+    first_token_latency = 0.2  # Seconds
+    tokens_per_second = 200.0
+    answer_tokens = 100
+
+    def log_message(self, format, *args):
+        pass  # One line per request would drown the benchmark output
+
+    def _answer_tokens(self) -> list[str]:
+        return [STUB_ANSWER_WORDS[i % len(STUB_ANSWER_WORDS)] + " " for i in range(self.answer_tokens)]
+
+    def _send(self, status: int, content_type: str, body: bytes = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if body is not None:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send(404, "application/json", b'{"error": {"message": "Not found"}}')
+            return
+
+        tokens = self._answer_tokens()
+        time.sleep(self.first_token_latency)
+        completion = {"id": "chatcmpl-stub", "created": int(time.time()), "model": request.get("model", "stub")}
+
+        if not request.get("stream"):
+            time.sleep(len(tokens) / self.tokens_per_second)
+            self._send(200, "application/json", json.dumps({
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": {"prompt_tokens": len(request["messages"][0]["content"]) // 4,
+                          "completion_tokens": len(tokens), "total_tokens": 0},
+            }).encode("utf-8"))
+            return
+
+        # Server-sent events, one chunk per token, without a Content-Length: the connection is closed at the end
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            if i > 0:
+                time.sleep(1 / self.tokens_per_second)
+            chunk = {**completion, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "finish_reason": None, "delta": {"content": token}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def start_stub_llm(port: int, first_token_latency: float = StubLLMHandler.first_token_latency,
+                   tokens_per_second: float = StubLLMHandler.tokens_per_second,
+                   answer_tokens: int = StubLLMHandler.answer_tokens) -> ThreadingHTTPServer:
+    """ Serve the stub LLM on a background thread. Stop it with `shutdown()`. """
+    handler = type("ConfiguredStubLLMHandler", (StubLLMHandler,), {
+        "first_token_latency": first_token_latency,
+        "tokens_per_second": tokens_per_second,
+        "answer_tokens": answer_tokens,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI-compatible LLM (set OPENAI_BASE_URL=http://127.0.0.1:<port>/v1).")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-token-latency", type=float, default=StubLLMHandler.first_token_latency)
+    parser.add_argument("--tokens-per-second", type=float, default=StubLLMHandler.tokens_per_second)
+    parser.add_argument("--answer-tokens", type=int, default=StubLLMHandler.answer_tokens)
+    args = parser.parse_args()
+
+    stub_server = start_stub_llm(args.port, args.first_token_latency, args.tokens_per_second, args.answer_tokens)
+    print(f"Stub LLM listening on http://127.0.0.1:{args.port}/v1 (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub_server.shutdown()
@@ -0,0 +1,261 @@
+import re
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator, AsyncIterator
+
+import psycopg2
+
+from constants import *
+from database import pooled_connection
+from database.pool import PoolTimeoutError
+from generation.generation import get_prompt_version, request_llm_answer, stream_llm_answer, request_llm_answer_async, \
+    stream_llm_answer_async
+from tracing.tracing import span, set_attribute, record_error
+
+
+_stats_lock = threading.Lock()
+_stats = {
+    "query_embedding": {"hits": 0, "misses": 0},
+    "answer": {"hits": 0, "misses": 0, "errors": 0},
+}
+
+_stores_since_eviction = 0  # Answers stored by this process since it last evicted from the answer cache
+
+# Level 1: in-process LRU of normalized question -> query embedding
+_query_embeddings = OrderedDict()
+_query_embeddings_lock = threading.Lock()
+
+
+def _count(cache_name: str, event: str):
+    with _stats_lock:
+        _stats[cache_name][event] += 1
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalize a question so that trivially different spellings share a cache entry.
+    Lowercasing doesn't change the embedding since the all-MiniLM-L6-v2 tokenizer is uncased.
+    """
+    return re.sub(r"\s+", " ", question).strip().lower()
+
+
+def encode_query(model, query_text: str):
+    """ Return the embedding of the query, computing it with the model only if it isn't in the LRU cache. """
+    key = (EMBEDDING_MODEL, normalize_question(query_text))
+
+    with _query_embeddings_lock:
+        embedding = _query_embeddings.get(key)
+        if embedding is not None:
+            _query_embeddings.move_to_end(key)
+    if embedding is not None:
+        _count("query_embedding", "hits")
+        return embedding
+
+    _count("query_embedding", "misses")
+    embedding = model.encode(key[1])
+    with _query_embeddings_lock:
+        _query_embeddings[key] = embedding
+        while len(_query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embeddings.popitem(last=False)
+    return embedding
+
+
+def encode_queries(model, query_texts: list[str]) -> list:
+    """
+    Batch version of `encode_query`: the questions which are not in the LRU cache are embedded with a single
+    vectorized `encode` call. The embeddings are returned in the order of the questions.
+    """
+    keys = [(EMBEDDING_MODEL, normalize_question(query_text)) for query_text in query_texts]
+
+    embeddings = {}
+    with _query_embeddings_lock:
+        for key in keys:
+            if key in _query_embeddings:
+                _query_embeddings.move_to_end(key)
+                embeddings[key] = _query_embeddings[key]
+    missing_keys = list(dict.fromkeys(key for key in keys if key not in embeddings))
+    with _stats_lock:
+        _stats["query_embedding"]["hits"] += len(keys) - len(missing_keys)
+        _stats["query_embedding"]["misses"] += len(missing_keys)
+
+    if len(missing_keys) > 0:
+        new_embeddings = model.encode([key[1] for key in missing_keys])
+        with _query_embeddings_lock:
+            for key, embedding in zip(missing_keys, new_embeddings):
+                embeddings[key] = _query_embeddings[key] = embedding
+            while len(_query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                _query_embeddings.popitem(last=False)
+    return [embeddings[key] for key in keys]
+
+
+def get_answer_cache_key(question: str, chunk_ids: list[int]) -> str:
+    """ Build the answer cache key from everything the LLM answer depends on. """
+    key_parts = [normalize_question(question), list(chunk_ids), OPENAI_LLM_MODEL, LLM_TEMPERATURE, LLM_MAX_OUTPUT_TOKENS,
+                 get_prompt_version()]
+    return hashlib.sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+
+def get_cached_answer(cache_key: str) -> str | None:
+    """ Level 2: look up a non-expired answer in the persistent answer cache. """
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE answer_cache
+            SET last_accessed = now()
+            WHERE cache_key = %s AND created_at > now() - make_interval(secs => %s)
+            RETURNING answer;
+            """,
+            (cache_key, ANSWER_CACHE_TTL_SECONDS)
+        )
+        row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def store_answer(cache_key: str, answer: str):
+    """
+    Save an answer to the persistent answer cache. Every ANSWER_CACHE_EVICTION_INTERVAL answers, the expired entries
+    and, if the cache is over its size, the least recently used ones are evicted.
+    """
+    global _stores_since_eviction
+    with _stats_lock:
+        _stores_since_eviction += 1
+        evict = _stores_since_eviction >= ANSWER_CACHE_EVICTION_INTERVAL
+        if evict:
+            _stores_since_eviction = 0
+
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO answer_cache (cache_key, answer)
+            VALUES (%s, %s)
+            ON CONFLICT (cache_key) DO UPDATE
+            SET answer = EXCLUDED.answer, created_at = now(), last_accessed = now();
+            """,
+            (cache_key, answer)
+        )
+        if evict:
+            evict_answers(cur)
+
+
+def evict_answers(cur):
+    """ Delete the expired answers, then the least recently used ones above ANSWER_CACHE_MAX_ENTRIES. """
+    cur.execute("DELETE FROM answer_cache WHERE created_at <= now() - make_interval(secs => %s);",
+                (ANSWER_CACHE_TTL_SECONDS,))
+    cur.execute("SELECT COUNT(*) FROM answer_cache;")
+    excess = cur.fetchone()[0] - ANSWER_CACHE_MAX_ENTRIES
+    if excess > 0:
+        # Walks the last_accessed index from the oldest entry instead of sorting the whole table
+        cur.execute(
+            """
+            DELETE FROM answer_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM answer_cache
+                ORDER BY last_accessed
+                LIMIT %s
+            );
+            """,
+            (excess,)
+        )
+
+
+def _lookup_answer(cache_key: str) -> str | None:
+    """ Look up the answer cache, counting hits/misses. A cache failure should never prevent us from answering. """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    try:
+        with span("answer_cache.lookup"):
+            cached_answer = get_cached_answer(cache_key)
+    except (psycopg2.Error, PoolTimeoutError) as e:
+        print(f"Error reading the answer cache: {e}")
+        _count("answer", "errors")
+        record_error("answer_cache", e)
+        cached_answer = None
+
+    _count("answer", "misses" if cached_answer is None else "hits")
+    set_attribute("answer_cache", "miss" if cached_answer is None else "hit")
+    return cached_answer
+
+
+def _save_answer(cache_key: str, answer: str):
+    if not ANSWER_CACHE_ENABLED:
+        return
+    try:
+        with span("answer_cache.store"):
+            store_answer(cache_key, answer)
+    except (psycopg2.Error, PoolTimeoutError) as e:
+        print(f"Error writing the answer cache: {e}")
+        _count("answer", "errors")
+        record_error("answer_cache", e)
+
+
+def get_answer(question: str, chunk_ids: list[int], prompt: str) -> str:
+    """
+    Return the LLM answer to the prompt, served from the answer cache when the same question was already answered
+    from the same chunks with the same generation settings. Raises a GenerationError (never cached) if the LLM fails.
+    """
+    cache_key = get_answer_cache_key(question, chunk_ids)
+    cached_answer = _lookup_answer(cache_key)
+    if cached_answer is not None:
+        return cached_answer
+
+    answer = request_llm_answer(prompt)
+    _save_answer(cache_key, answer)
+    return answer
+
+
+def stream_answer(question: str, chunk_ids: list[int], prompt: str) -> Iterator[str]:
+    """
+    Streaming version of `get_answer`: a cached answer is yielded at once, otherwise the LLM tokens are yielded as
+    they arrive and the full answer is cached once the stream completes. A GenerationError is raised (and the partial
+    answer is not cached) if the LLM fails.
+    """
+    cache_key = get_answer_cache_key(question, chunk_ids)
+    cached_answer = _lookup_answer(cache_key)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    tokens = []
+    for token in stream_llm_answer(prompt):
+        tokens.append(token)
+        yield token
+    _save_answer(cache_key, "".join(tokens))
+
+
+async def get_answer_async(question: str, chunk_ids: list[int], prompt: str) -> str:
+    """ asyncio version of `get_answer`: the cache is read and written on worker threads, the LLM is awaited. """
+    cache_key = get_answer_cache_key(question, chunk_ids)
+    cached_answer = await asyncio.to_thread(_lookup_answer, cache_key)
+    if cached_answer is not None:
+        return cached_answer
+
+    answer = await request_llm_answer_async(prompt)
+    await asyncio.to_thread(_save_answer, cache_key, answer)
+    return answer
+
+
+async def stream_answer_async(question: str, chunk_ids: list[int], prompt: str) -> AsyncIterator[str]:
+    """ asyncio version of `stream_answer`. """
+    cache_key = get_answer_cache_key(question, chunk_ids)
+    cached_answer = await asyncio.to_thread(_lookup_answer, cache_key)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    tokens = []
+    async for token in stream_llm_answer_async(prompt):
+        tokens.append(token)
+        yield token
+    await asyncio.to_thread(_save_answer, cache_key, "".join(tokens))
+
+
+def cache_stats() -> dict:
+    """ Return the hit/miss counters of both cache levels. """
+    with _stats_lock:
+        stats = {name: dict(counters) for name, counters in _stats.items()}
+    with _query_embeddings_lock:
+        stats["query_embedding"]["size"] = len(_query_embeddings)
+    return stats
@@ -7,30 +7,124 @@ PRESS_RELEASES_URL = "https://www.telekom.com/dynamic/fragment/com16/en/418728"
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
-PRESS_RELEASES_DIR = "./press_releases"
+PRESS_RELEASES_DIR = "./press_releases"  # Per-article JSON files of earlier versions, imported into the chunk store when it is created
+CHUNK_STORE_PATH = "./press_releases.sqlite"  # The scraped articles and their chunks, in one SQLite file
+SCRAPING_MANIFEST_PATH = "./press_releases_manifest.json"  # URL, content hash, ETag/Last-Modified and scrape time of every scraped article
+HTML_ARCHIVE_DIR = "./press_releases_html"  # Gzipped raw HTML of the scraped articles, named by its SHA-256 (re-chunk with `--rechunk`)
+HTML_ARCHIVE_COMPRESSION_LEVEL = 6  # gzip level (1-9), the higher levels are slower for little gain
 PRESS_RELEASES_TARGET_COUNT = 250  # 10
+SCRAPING_CONCURRENCY = 8  # Number of pages fetched in parallel
+SCRAPING_RATE_LIMIT_PER_HOST = 5.0  # Max requests per second sent to a single host
+SCRAPING_MAX_RETRIES = 3  # Retries (with exponential backoff) on connection errors, 429 and 5xx responses
+SCRAPING_BACKOFF_FACTOR = 0.5  # Sleep 0.5s, 1s, 2s, ... between retries (a Retry-After header takes precedence)
+SCRAPING_CONNECT_TIMEOUT = 5.0  # Seconds
+SCRAPING_READ_TIMEOUT = 30.0  # Seconds
+SCRAPING_HTML_PARSER = "lxml"  # BeautifulSoup parser ("lxml" is several times faster, "html.parser" is used if lxml is not installed)
+SCRAPING_PARSE_WORKERS = None  # Processes parsing and chunking the articles while others are downloaded; None uses every core
 
 
 # --- DB configuration ---
 DB_HOST = os.getenv("DB_HOST", "localhost")  # use the DB_HOST env variable if this is called from the docker-compose network
 DB_PORT = "5432"
-DB_NAME = "telekom_rag"
+DB_NAME = os.getenv("DB_NAME", "telekom_rag")  # The benchmarks use their own database
 DB_USER = "myuser"
 DB_PASSWORD = "mypassword"
+DB_POOL_MIN_SIZE = 1  # Connections opened eagerly when the pool is created
+DB_POOL_MAX_SIZE = 10  # Upper bound on the connections a single process can hold (keep it well below Postgres' max_connections)
+DB_POOL_TIMEOUT = 30.0  # Seconds to wait for a free connection before giving up
+DB_POOL_HEALTHCHECK_INTERVAL = 60.0  # Idle connections older than this (in seconds) are pinged before being handed out
 
 
 # --- Embeddings ---
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
 VECTOR_DIMENSION = 384
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence_transformers")  # "sentence_transformers" (PyTorch) or "onnx" (onnxruntime, export it first with `python -m embeddings.export`)
+ONNX_MODEL_DIR = "./onnx_model"  # Exported ONNX graphs and tokenizer
+ONNX_QUANTIZED = True  # Use the int8 graph (smaller and faster on CPU, slightly less precise)
+ONNX_THREADS = None  # onnxruntime intra-op threads; None uses every core
+ONNX_MAX_SEQUENCE_LENGTH = 256  # Tokens per text, like the SentenceTransformer model (longer texts are truncated)
+ONNX_MIN_COSINE_SIMILARITY = 0.99  # Minimum similarity between the int8 ONNX and the PyTorch embeddings of a text for the export to pass
+ONNX_FLOAT32_MIN_COSINE_SIMILARITY = 0.9999  # Same for the float32 ONNX graph, which should match PyTorch up to rounding
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"  # Reuse the embeddings of the texts (chunks and questions) encoded before, across runs and processes
+EMBEDDING_CACHE_DIR = "./embedding_cache"  # Memory-mapped vectors and their SQLite index
+EMBEDDING_CACHE_MAX_MB = 512  # Size of the vectors file (1.5 KB per embedding), the least recently used embeddings are evicted above it
+EMBEDDING_CACHE_TOUCH_INTERVAL = 30  # Seconds between the writes of the last-used times of the cache hits (lookups stay read-only meanwhile)
+
+
+# --- Ingestion ---
+INGESTION_BATCH_SIZE = 256  # Chunks per encoding / COPY batch (whole articles are never split across batches)
+INGESTION_QUEUE_SIZE = 4  # Max batches buffered between two pipeline stages, this bounds the memory usage
+
+
+# --- Vector index ---
+VECTOR_INDEX_TYPE = "hnsw"  # Approximate nearest neighbour index on the embeddings: "hnsw", "ivfflat" or None (exact search)
+HNSW_M = 16  # Max connections per HNSW graph node (higher = better recall, bigger index, slower build)
+HNSW_EF_CONSTRUCTION = 64  # Candidate list size while building the HNSW graph
+HNSW_EF_SEARCH = 40  # Candidate list size per query (higher = better recall, slower queries)
+IVFFLAT_LISTS = None  # Number of IVFFlat clusters; None picks rows / 1000 (sqrt(rows) above 1M rows)
+IVFFLAT_REBUILD_GROWTH = 2.0  # Rebuild the IVFFlat index (concurrently) after an ingestion once the table has grown or shrunk by this factor since it was built
+IVFFLAT_PROBES = 10  # Clusters scanned per query (higher = better recall, slower queries)
+ITERATIVE_INDEX_SCAN = "relaxed_order"  # How filtered searches scan the ANN index (pgvector >= 0.8): "relaxed_order", "strict_order" or "off"
+INDEX_BUILD_MAINTENANCE_WORK_MEM = "512MB"  # Index builds are much faster when the graph fits in maintenance_work_mem
+EMBEDDING_STORAGE = "vector"  # What the ANN index stores: "vector" (float32), "halfvec" (float16, half the size) or "binary" (1 bit per dimension, 32x smaller)
+HALFVEC_RERANK_OVERSAMPLING = 2  # With "halfvec" storage, top_k * this candidates are re-ranked with the full-precision embeddings
+BINARY_RERANK_OVERSAMPLING = 10  # Same for "binary" storage, which loses much more information
 
 
 # --- Retrieval ---
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pgvector")  # "pgvector" (Postgres) or "local" (memory-mapped embedding matrix, no DB needed)
+LOCAL_INDEX_DIR = "./local_index"  # Files of the local backend: embedding matrix + metadata sidecar
+LOCAL_INDEX_DTYPE = "float32"  # "float32" or "float16" (half the disk and page cache, but slower scoring since numpy has to upcast it)
 TOP_K = 5  # How many similar document chunks to retrieve from the DB
 SIMILARITY_THRESHOLD = 0.5  # What is the minimum similarity above which we consider that a document is relevant to a question
+RETRIEVAL_MODE = "vector"  # "vector" (embeddings only) or "hybrid" (embeddings + Postgres full-text search, merged with reciprocal rank fusion)
+TEXT_SEARCH_CONFIG = "english"  # Postgres text search configuration of the full-text search column
+HYBRID_SEMANTIC_DEPTH = 20  # Candidates taken from the vector search before the fusion
+HYBRID_LEXICAL_DEPTH = 20  # Candidates taken from the full-text search before the fusion
+HYBRID_SEMANTIC_WEIGHT = 1.0  # Weight of the vector search ranks in the fused score
+HYBRID_LEXICAL_WEIGHT = 1.0  # Weight of the full-text search ranks in the fused score
+RRF_K = 60  # Reciprocal rank fusion constant: score = sum(weight / (RRF_K + rank))
 
 
 # --- Generation ---
 OPENAI_LLM_MODEL = "gpt-4-turbo"
 OPENAI_KEY=""
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # None uses the official API; point it to any OpenAI-compatible server (e.g. a local fake for tests)
+LLM_TIMEOUT = 60.0  # Seconds before a request to the LLM is abandoned (applies between streamed tokens too)
+LLM_MAX_RETRIES = 2  # Retries on connection errors, 408/409/429 and 5xx responses (with exponential backoff)
+LLM_RETRY_BACKOFF = 0.5  # Seconds before the first retry of the asyncio client, doubled each time (a Retry-After header takes precedence)
+LLM_MAX_CONCURRENT_REQUESTS = 8  # Requests in flight to the LLM per event loop (asyncio client), the others wait
+LLM_REQUESTS_PER_MINUTE = 500  # Rate limit of the asyncio client, keep it under the provider's (None disables it)
+LLM_TOKENS_PER_MINUTE = 150_000  # Prompt + max completion tokens per minute sent by the asyncio client (None disables it)
+LLM_RATE_LIMIT_BURST_SECONDS = 5  # The asyncio client sends at most this many seconds worth of the per-minute limits at once (e.g. at startup)
 LLM_MAX_OUTPUT_TOKENS = 1024
 LLM_TEMPERATURE = 0.0
+PROMPT_CONTEXT_TOKEN_BUDGET = 3000  # Max tokens of retrieved context in the prompt (smaller prompts are faster and cheaper)
+PROMPT_DUPLICATE_SIMILARITY = 0.95  # Chunks at least this similar to a chunk already in the prompt are dropped
+PROMPT_MMR_LAMBDA = 0.7  # Relevance vs. diversity trade-off when ordering the chunks (1 = relevance only)
+PROMPT_CHARS_PER_TOKEN = 4  # Token estimate when tiktoken isn't installed
+
+
+# --- Caching ---
+ANSWER_CACHE_ENABLED = RETRIEVAL_BACKEND == "pgvector"  # The answer cache lives in (and is invalidated by) the Postgres DB
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # Number of (normalized) questions whose embedding is kept in memory
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60  # Cached LLM answers older than this are ignored and evicted
+ANSWER_CACHE_MAX_ENTRIES = 10_000  # Least recently used answers are evicted above this size
+ANSWER_CACHE_EVICTION_INTERVAL = 100  # The expired and least recently used answers are evicted once every this many stored answers
+
+
+# --- HTTP service ---
+SERVICE_HOST = "0.0.0.0"
+SERVICE_PORT = 8080
+SERVICE_MAX_TOP_K = 100  # Requests asking for more chunks (or fewer than 1) are rejected
+SERVICE_ENCODE_BATCH_SIZE = 64  # Max questions embedded together by the micro-batching encoder
+SERVICE_ENCODE_BATCH_WAIT_MS = 5  # How long the first question of a micro-batch waits for others to join it
+SERVICE_WORKER_THREADS = 32  # Threads running the blocking encode and DB calls (DB_POOL_MAX_SIZE bounds the concurrent queries)
+
+
+# --- Tracing ---
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"  # Per-request spans, counts and errors (no overhead when disabled)
+TRACING_EXPORTERS = ["log"]  # "log" (one JSON line per request) and/or "prometheus" (metrics endpoint)
+PROMETHEUS_PORT = 9464  # Port of the /metrics endpoint of the "prometheus" exporter
+EXPLAIN_SLOW_QUERIES = False  # Re-run the retrieval queries slower than the threshold with EXPLAIN (ANALYZE, BUFFERS) and attach the plan to the trace
+SLOW_QUERY_THRESHOLD_MS = 200
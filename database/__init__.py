@@ -1,20 +1,56 @@
+import threading
+from contextlib import contextmanager
+
 import psycopg2
 from constants import *
+from database.pool import ConnectionPool
+from tracing.tracing import span
+
+
+_pool = None
+_pool_lock = threading.Lock()
 
 
 def get_db_connection():
     """ Establishes a connection to the PostgreSQL database. """
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
+    with span("db.connect"):
+        return psycopg2.connect(
+            host=DB_HOST,
+            port=DB_PORT,
+            dbname=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD
+        )
+
+
+def get_pool() -> ConnectionPool:
+    """ Return the process-wide connection pool, creating it on first use. """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(get_db_connection)
+    return _pool
 
 
-def clear_db(connection):
+@contextmanager
+def pooled_connection():
+    """ Borrow a connection (with the pgvector types already registered) from the process-wide pool. """
+    with get_pool().connection() as conn:
+        yield conn
+
+
+def pool_stats() -> dict:
+    """ Return the usage statistics of the process-wide pool (in use, waiting, created, etc). """
+    return get_pool().stats()
+
+
+def clear_db(connection=None):
     """ Make the documents DB table empty. For debugging/development purposes. """
+    if connection is None:
+        with pooled_connection() as conn:
+            return clear_db(conn)
+
     with connection.cursor() as cur:
         print("Clearing existing data from 'documents' table...")
         cur.execute("TRUNCATE TABLE documents RESTART IDENTITY;")
@@ -0,0 +1,49 @@
+import io
+import struct
+from datetime import date
+
+import numpy as np
+
+
+# See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4 for the binary COPY format
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+POSTGRES_EPOCH = date(2000, 1, 1)
+NULL_FIELD = struct.pack("!i", -1)
+
+
+def encode_text(value: str) -> bytes:
+    return value.encode("utf-8")
+
+
+def encode_date(value: date) -> bytes:
+    """ Dates are sent as the number of days since the Postgres epoch (2000-01-01). """
+    return struct.pack("!i", (value - POSTGRES_EPOCH).days)
+
+
+def encode_vector(value) -> bytes:
+    """ pgvector's binary format: the dimension and an unused field as int16, then the values as big-endian float4. """
+    value = np.asarray(value, dtype=">f4")
+    return struct.pack("!hh", value.shape[0], 0) + value.tobytes()
+
+
+def build_copy_buffer(rows: list[tuple], encoders: list) -> io.BytesIO:
+    """
+    Serialize rows into a binary COPY stream that can be passed to `cursor.copy_expert`.
+    `encoders` holds the function that encodes each column; None values are sent as NULL.
+    """
+    buffer = io.BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    field_count = struct.pack("!h", len(encoders))
+    for row in rows:
+        buffer.write(field_count)
+        for value, encoder in zip(row, encoders):
+            if value is None:
+                buffer.write(NULL_FIELD)
+                continue
+            data = encoder(value)
+            buffer.write(struct.pack("!i", len(data)))
+            buffer.write(data)
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    return buffer
@@ -1,7 +1,30 @@
+import math
+import argparse
+
 from database import get_db_connection
 from constants import *
 
 
+# How each embedding storage option is indexed and searched: indexed expression, operator class, distance operator
+# and the SQL expression the query vector is cast with. The full-precision `embedding` column is always kept, the
+# compact representations are expression indexes over it and their candidates are re-ranked at full precision.
+EMBEDDING_STORAGES = {
+    "vector": ("embedding", "vector_cosine_ops", "<=>", "%(query)s::vector"),
+    "halfvec": (f"(embedding::halfvec({VECTOR_DIMENSION}))", "halfvec_cosine_ops", "<=>",
+                f"%(query)s::vector::halfvec({VECTOR_DIMENSION})"),
+    "binary": (f"(binary_quantize(embedding)::bit({VECTOR_DIMENSION}))", "bit_hamming_ops", "<~>",
+               f"binary_quantize(%(query)s::vector)::bit({VECTOR_DIMENSION})"),
+}
+VECTOR_INDEX_TYPES = ("hnsw", "ivfflat")
+
+
+def get_vector_index_name(index_type: str, storage: str) -> str:
+    """ Name of the ANN index managed by `create_vector_index` for the given index type and embedding storage. """
+    if storage == "vector":
+        return f"documents_embedding_{index_type}_idx"
+    return f"documents_embedding_{storage}_{index_type}_idx"
+
+
 def setup_database(conn):
     """ Set up the necessary database extension and table with metadata columns. """
     with conn.cursor() as cur:
@@ -17,14 +40,275 @@ def setup_database(conn):
                 title TEXT,
                 author TEXT,
                 publish_date DATE,
-                source_link TEXT
+                source_link TEXT,
+                chunk_hash TEXT NOT NULL
+            );
+        """)
+
+        # Full-text search column for the hybrid (lexical + vector) retrieval, added to existing tables too
+        print("Creating the full-text search column and index...")
+        cur.execute(f"""
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(content, '')), 'A') ||
+                setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(title, '')), 'B')
+            ) STORED;
+
+            CREATE INDEX IF NOT EXISTS documents_content_tsv_idx ON documents USING gin (content_tsv);
+        """)
+
+        # B-tree indexes for the metadata filters of the retrieval (source_link is covered by the unique key below)
+        print("Creating the metadata indexes...")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS documents_publish_date_idx ON documents (publish_date);
+            CREATE INDEX IF NOT EXISTS documents_author_idx ON documents (author);
+        """)
+
+        # Migrate tables created before the chunks were keyed by content hash: backfill the hashes (same as
+        # `get_chunk_hash`) and drop the duplicates left by repeated ingestions before adding the unique key
+        cur.execute("""
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_hash TEXT;
+            UPDATE documents SET chunk_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex') WHERE chunk_hash IS NULL;
+            ALTER TABLE documents ALTER COLUMN chunk_hash SET NOT NULL;
+        """)
+        cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'documents_source_link_chunk_hash_key';")
+        if cur.fetchone() is None:
+            print("Creating the (source_link, chunk_hash) unique key...")
+            cur.execute("""
+                DELETE FROM documents AS duplicate
+                USING documents AS original
+                WHERE duplicate.source_link = original.source_link
+                  AND duplicate.chunk_hash = original.chunk_hash
+                  AND duplicate.id > original.id;
+
+                CREATE UNIQUE INDEX documents_source_link_chunk_hash_key ON documents (source_link, chunk_hash);
+            """)
+
+        # Ingestion batches are staged here (one committed batch per checkpoint) and merged into documents at the end
+        print("Creating 'documents_staging' table...")
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE IF NOT EXISTS documents_staging (
+                content TEXT,
+                embedding VECTOR({VECTOR_DIMENSION}),
+                title TEXT,
+                author TEXT,
+                publish_date DATE,
+                source_link TEXT,
+                chunk_hash TEXT NOT NULL
             );
         """)
+
+        print("Creating 'answer_cache' table...")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                cache_key TEXT PRIMARY KEY,
+                answer TEXT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                last_accessed TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+        # Used by the LRU eviction of the answer cache
+        cur.execute("CREATE INDEX IF NOT EXISTS answer_cache_last_accessed_idx ON answer_cache (last_accessed);")
+
+        # The cached answers are only valid for the current content of the documents table, so empty the cache
+        # whenever a statement actually changes rows of it (the transition tables let us ignore no-op statements)
+        print("Creating the answer cache invalidation triggers...")
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION invalidate_answer_cache() RETURNS trigger AS $$
+            BEGIN
+                DELETE FROM answer_cache;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION invalidate_answer_cache_on_change() RETURNS trigger AS $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM changed_rows) THEN
+                    DELETE FROM answer_cache;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE TRIGGER documents_insert_invalidates_answer_cache
+            AFTER INSERT ON documents REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION invalidate_answer_cache_on_change();
+
+            CREATE OR REPLACE TRIGGER documents_update_invalidates_answer_cache
+            AFTER UPDATE ON documents REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION invalidate_answer_cache_on_change();
+
+            CREATE OR REPLACE TRIGGER documents_delete_invalidates_answer_cache
+            AFTER DELETE ON documents REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION invalidate_answer_cache_on_change();
+
+            CREATE OR REPLACE TRIGGER documents_truncate_invalidates_answer_cache
+            AFTER TRUNCATE ON documents
+            FOR EACH STATEMENT EXECUTE FUNCTION invalidate_answer_cache();
+        """)
         conn.commit()
     print("Database setup complete.")
 
 
+def get_ivfflat_lists(row_count: int) -> int:
+    """ Pick the number of IVFFlat lists following the pgvector recommendation (rows / 1000, sqrt(rows) above 1M rows). """
+    if IVFFLAT_LISTS is not None:
+        return IVFFLAT_LISTS
+    if row_count > 1_000_000:
+        return int(math.sqrt(row_count))
+    return max(1, row_count // 1000)
+
+
+def get_vector_index_sql(cur, index_type: str, storage: str, index_name: str, concurrently: bool = False) -> str:
+    """ The CREATE INDEX statement of the ANN index (IVFFlat sizes its lists from the current row count). """
+    indexed_expression, operator_class, _, _ = EMBEDDING_STORAGES[storage]
+    concurrently = "CONCURRENTLY " if concurrently else ""
+    if index_type == "hnsw":
+        print(f"Creating HNSW index over {storage} (m={HNSW_M}, ef_construction={HNSW_EF_CONSTRUCTION})...")
+        return f"""
+            CREATE INDEX {concurrently}IF NOT EXISTS {index_name} ON documents
+            USING hnsw ({indexed_expression} {operator_class})
+            WITH (m = {int(HNSW_M)}, ef_construction = {int(HNSW_EF_CONSTRUCTION)});
+        """
+    cur.execute("SELECT COUNT(*) FROM documents;")
+    lists = get_ivfflat_lists(cur.fetchone()[0])
+    print(f"Creating IVFFlat index over {storage} (lists={lists})...")
+    return f"""
+        CREATE INDEX {concurrently}IF NOT EXISTS {index_name} ON documents
+        USING ivfflat ({indexed_expression} {operator_class})
+        WITH (lists = {int(lists)});
+    """
+
+
+def record_index_row_count(cur, index_name: str):
+    """ Remember in the index comment how many rows it was built over (see `ivfflat_needs_rebuild`). """
+    cur.execute("SELECT COUNT(*) FROM documents;")
+    cur.execute(f"COMMENT ON INDEX {index_name} IS 'rows={int(cur.fetchone()[0])}';")
+
+
+def ivfflat_needs_rebuild(conn, storage: str = EMBEDDING_STORAGE) -> bool:
+    """
+    Whether the IVFFlat index should be rebuilt after an ingestion: its clusters come from the rows present at build
+    time, so it is rebuilt once the table has grown (or shrunk) by IVFFLAT_REBUILD_GROWTH since. A missing index is
+    simply created.
+    """
+    index_name = get_vector_index_name("ivfflat", storage)
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL, obj_description(to_regclass(%s), 'pg_class');",
+                    (index_name, index_name))
+        exists, comment = cur.fetchone()
+        if not exists:
+            return False
+        cur.execute("SELECT COUNT(*) FROM documents;")
+        row_count = cur.fetchone()[0]
+    conn.commit()
+    # Indexes built before the row count was recorded are rebuilt once
+    if comment is None or not comment.startswith("rows="):
+        return True
+    built_row_count = int(comment[len("rows="):])
+    return max(row_count, built_row_count) / max(1, min(row_count, built_row_count)) >= IVFFLAT_REBUILD_GROWTH
+
+
+def rebuild_vector_index(conn, index_type: str, storage: str):
+    """
+    Rebuild the ANN index without blocking the searches or the writes: the new index is built CONCURRENTLY under a
+    temporary name, then swapped in by renaming, so only the renames and the final drop take (brief) locks.
+    """
+    index_name = get_vector_index_name(index_type, storage)
+    new_name, old_name = f"{index_name}_new", f"{index_name}_old"
+    conn.commit()
+    # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            # Leftovers of an interrupted rebuild (a failed concurrent build leaves an invalid index behind)
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_name};")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {old_name};")
+
+            cur.execute("SET maintenance_work_mem = %s;", (INDEX_BUILD_MAINTENANCE_WORK_MEM,))
+            try:
+                cur.execute(get_vector_index_sql(cur, index_type, storage, new_name, concurrently=True))
+            finally:
+                cur.execute("RESET maintenance_work_mem;")
+            record_index_row_count(cur, new_name)
+
+            cur.execute("BEGIN;")
+            try:
+                cur.execute(f"ALTER INDEX IF EXISTS {index_name} RENAME TO {old_name};")
+                cur.execute(f"ALTER INDEX {new_name} RENAME TO {index_name};")
+                cur.execute("COMMIT;")
+            except Exception:
+                cur.execute("ROLLBACK;")
+                raise
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {old_name};")
+    finally:
+        conn.autocommit = autocommit
+
+
+def create_vector_index(conn, index_type: str = VECTOR_INDEX_TYPE, rebuild: bool = False,
+                        storage: str = EMBEDDING_STORAGE):
+    """
+    Create the ANN index on the embeddings (over the representation given by `storage`), then drop the other
+    managed indexes. Creating the new index before dropping the old one keeps the searches indexed while migrating.
+    Build it after the bulk load: building once over the full table is much faster than maintaining it row by row,
+    and IVFFlat picks its cluster centroids from the rows present at build time.
+    With `rebuild`, an existing index is replaced by a fresh one built concurrently (see `rebuild_vector_index`).
+    """
+    assert index_type in VECTOR_INDEX_TYPES or index_type is None, f"Unknown vector index type: {index_type}"
+    assert storage in EMBEDDING_STORAGES, f"Unknown embedding storage: {storage}"
+
+    index_name = get_vector_index_name(index_type, storage) if index_type is not None else None
+    if index_type is None:
+        print("Using exact search, no vector index.")
+    else:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (index_name,))
+            exists = cur.fetchone()[0]
+        if exists and rebuild:
+            rebuild_vector_index(conn, index_type, storage)
+        elif not exists:
+            with conn.cursor() as cur:
+                cur.execute("SELECT set_config('maintenance_work_mem', %s, true);", (INDEX_BUILD_MAINTENANCE_WORK_MEM,))
+                cur.execute(get_vector_index_sql(cur, index_type, storage, index_name))
+                record_index_row_count(cur, index_name)
+
+    with conn.cursor() as cur:
+        for other_type in VECTOR_INDEX_TYPES:
+            for other_storage in EMBEDDING_STORAGES:
+                other_name = get_vector_index_name(other_type, other_storage)
+                if other_name != index_name:
+                    cur.execute(f"DROP INDEX IF EXISTS {other_name};")
+
+        cur.execute("ANALYZE documents;")
+        conn.commit()
+    print("Vector index ready.")
+
+
+def migrate_embedding_storage(conn, storage: str, index_type: str = VECTOR_INDEX_TYPE):
+    """
+    Switch an existing database to another embedding storage option and report the size of the indexes.
+    The full-precision embeddings are left untouched, so the migration can be reverted the same way.
+    """
+    create_vector_index(conn, index_type=index_type, storage=storage)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT indexrelid::regclass::text, pg_size_pretty(pg_relation_size(indexrelid))
+            FROM pg_index
+            WHERE indrelid = 'documents'::regclass;
+        """)
+        for index_name, index_size in cur.fetchall():
+            print(f"  {index_name}: {index_size}")
+        cur.execute("SELECT pg_size_pretty(pg_table_size('documents'));")
+        print(f"  documents table: {cur.fetchone()[0]}")
+    conn.commit()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create (or migrate) the vector DB.")
+    parser.add_argument("--storage", choices=list(EMBEDDING_STORAGES),
+                        help="Migrate the ANN index to this embedding storage option.")
+    args = parser.parse_args()
+
     print("Creating the database...")
 
     # 1. Connect to the database
@@ -33,5 +317,10 @@ if __name__ == "__main__":
     # 2. Set up the database table and extension
     setup_database(connection)
 
+    # 3. Optionally switch to another embedding storage option
+    if args.storage is not None:
+        print(f"Migrating the embedding index to '{args.storage}' storage...")
+        migrate_embedding_storage(connection, args.storage)
+
     connection.close()
     print("Database connection closed.")
@@ -0,0 +1,69 @@
+import argparse
+
+from constants import *
+from database.retrievers import PgvectorRetriever
+from database.create import EMBEDDING_STORAGES
+
+
+# Used when no question file is given
+DEFAULT_EVALUATION_QUESTIONS = [
+    "What are the AI initiatives at Deutsche Telekom?",
+    "How is Deutsche Telekom expanding its fiber network?",
+    "What did Deutsche Telekom announce about 5G?",
+    "Which partnerships did T-Systems enter?",
+    "What were the quarterly financial results?",
+    "How does Deutsche Telekom protect its customers against cyber attacks?",
+    "What is Deutsche Telekom doing for sustainability and climate protection?",
+    "Which new tariffs were introduced for mobile customers?",
+]
+
+
+def recall_at_k(retrieved_ids: list, exact_ids: list) -> float:
+    """ Fraction of the exact top-k results which were also retrieved. """
+    if len(exact_ids) == 0:
+        return 1.0
+    return len(set(retrieved_ids) & set(exact_ids)) / len(exact_ids)
+
+
+def recall_report(query_embeddings: list, top_k: int = TOP_K, storages: list[str] = None,
+                  ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES) -> dict:
+    """
+    Compare the top_k results of each embedding storage option (with the current ANN indexes) against the exact
+    full-precision search. Return the mean recall@k per storage option.
+    """
+    storages = storages or list(EMBEDDING_STORAGES)
+    exact_retriever = PgvectorRetriever(storage="vector", exact=True)
+    retrievers = {storage: PgvectorRetriever(storage=storage) for storage in storages}
+
+    # A threshold of -1 keeps every result, we only compare the rankings
+    exact_ids = [[chunk["id"] for chunk in chunks] for chunks in exact_retriever.batch_search(query_embeddings, top_k, -1.0)]
+    recalls = {storage: [] for storage in storages}
+    for storage, retriever in retrievers.items():
+        retrieved_chunks = retriever.batch_search(query_embeddings, top_k, -1.0, ef_search=ef_search, probes=probes)
+        for chunks, query_exact_ids in zip(retrieved_chunks, exact_ids):
+            recalls[storage].append(recall_at_k([chunk["id"] for chunk in chunks], query_exact_ids))
+
+    return {storage: sum(values) / len(values) for storage, values in recalls.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the recall@k of each embedding storage option against exact search.")
+    parser.add_argument("--questions", help="Text file with one evaluation question per line.")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    if args.questions is not None:
+        with open(args.questions) as fp:
+            questions = [line.strip() for line in fp if line.strip()]
+    else:
+        questions = DEFAULT_EVALUATION_QUESTIONS
+
+    print("Initializing embedding model...")
+    from embeddings.embeddings import load_embedding_model
+    model = load_embedding_model()
+    embeddings = model.encode(questions)
+
+    print(f"\nRecall@{args.top_k} against exact search over {len(questions)} questions "
+          f"(storage options without an ANN index are scanned exhaustively, which only measures their quantization loss):")
+    for storage, recall in recall_report(list(embeddings), top_k=args.top_k).items():
+        print(f"  {storage:>8}: {recall:.3f}")
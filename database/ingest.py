@@ -1,97 +1,291 @@
-import json
-import glob
-import psycopg2
+import queue
+import hashlib
+import argparse
+import threading
 from tqdm import tqdm
-import psycopg2.extras
 from datetime import datetime
-from pgvector.psycopg2 import register_vector
-from sentence_transformers import SentenceTransformer
 
 from constants import *
-from database import get_db_connection
+from database import pooled_connection
+from database.create import create_vector_index, ivfflat_needs_rebuild
+from database.retrievers import close_retriever
+from database.binary_copy import build_copy_buffer, encode_text, encode_vector, encode_date
+from embeddings.embeddings import load_embedding_model
+from embeddings.cache import CachedEmbeddingModel
+from scraping.chunk_store import ChunkStore, open_chunk_store
 
 
-def process_and_insert_data(conn, model):
-    """ Process JSON files, chunk their content, and insert them into the database with metadata. """
-    print(f"Reading JSON files from '{PRESS_RELEASES_DIR}' and chunking text...")
+STAGING_COLUMNS = "content, embedding, title, author, publish_date, source_link, chunk_hash"
+STAGING_ENCODERS = [encode_text, encode_vector, encode_text, encode_text, encode_date, encode_text, encode_text]
 
-    records_to_insert = []
-    json_files = glob.glob(os.path.join(PRESS_RELEASES_DIR, "*.json"))
-    for filepath in tqdm(json_files, desc="Reading files"):
-        json_data = json.load(open(filepath))
 
-        # Extract metadata
-        title = json_data.get("title")
-        author = json_data.get("author")
+def get_chunk_hash(content: str) -> str:
+    """ Hash a chunk's text. Together with the source link it identifies the chunk in the documents table. """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def run_in_thread(iterable, maxsize: int = INGESTION_QUEUE_SIZE):
+    """
+    Consume `iterable` on a background thread and yield its items through a bounded queue.
+    Chaining these lets every pipeline stage run concurrently, while the queue sizes bound the memory usage.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+            items.put(done)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # If the consumer stops early, unblock the producer so that the thread can exit
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=0.1)
+
+
+def read_articles(store: ChunkStore, skip_links: set[str]):
+    """ Stage 1: stream the press releases from the chunk store and yield their chunks with the article's metadata. """
+    for json_data in tqdm(store.iter_articles(), total=len(store), desc="Ingesting articles"):
         link = json_data.get("link")
-        content_chunks = json_data.get("content")
+        if link in skip_links:
+            continue  # Already staged by the interrupted run we are resuming
+
         date_str = json_data.get("date")
-        p_date = datetime.strptime(date_str, "%m-%d-%Y").date()
-
-        # For each chunk, associate the parent document's metadata
-        for chunk in content_chunks:
-            records_to_insert.append({
-                "content": chunk,
-                "title": title,
-                "author": author,
-                "publish_date": p_date,
-                "source_link": link
-            })
-
-    print(f"\nGenerated {len(records_to_insert)} text chunks.")
-
-    # Separate content for embedding
-    all_content = [rec["content"] for rec in records_to_insert]
-
-    print("Generating embeddings for all chunks...")
-    embeddings = model.encode(all_content, show_progress_bar=True)
-
-    # Combine metadata with embeddings for insertion
-    data_for_db = [
-        (
-            rec["content"],
-            embedding,
-            rec["title"],
-            rec["author"],
-            rec["publish_date"],
-            rec["source_link"]
-        )
-        for rec, embedding in zip(records_to_insert, embeddings)
-    ]
-
-    print("Inserting data into the database...")
+        # A chunk repeated in the same article is stored once
+        chunks = {get_chunk_hash(chunk): chunk for chunk in json_data.get("content")}
+        yield {
+            "title": json_data.get("title"),
+            "author": json_data.get("author"),
+            "publish_date": datetime.strptime(date_str, "%m-%d-%Y").date(),
+            "source_link": link,
+            "chunks": chunks,
+        }
+
+
+def find_stored_chunks(links: list[str]) -> set[tuple[str, str]]:
+    """ Return the (source_link, chunk_hash) keys of the chunks of the given articles which are already in the documents table. """
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT source_link, chunk_hash FROM documents WHERE source_link = ANY(%s);", (links,))
+        return set(cur.fetchall())
+
+
+def batch_articles(articles, batch_size: int = INGESTION_BATCH_SIZE, find_stored=find_stored_chunks):
+    """
+    Stage 2: group whole articles into batches of about `batch_size` chunks.
+    Articles are never split so that every committed batch is a valid resume point. The chunks which are already
+    stored (according to `find_stored`, if given) are marked so that the encoder skips them.
+    """
+    def finish(batch):
+        stored_chunks = find_stored([article["source_link"] for article in batch]) if find_stored else set()
+        for article in batch:
+            article["stored_hashes"] = {chunk_hash for chunk_hash in article["chunks"]
+                                        if (article["source_link"], chunk_hash) in stored_chunks}
+        return batch
+
+    batch, batch_chunks = [], 0
+    for article in articles:
+        batch.append(article)
+        batch_chunks += len(article["chunks"])
+        if batch_chunks >= batch_size:
+            yield finish(batch)
+            batch, batch_chunks = [], 0
+    if len(batch) > 0:
+        yield finish(batch)
+
+
+def encode_batches(batches, model):
+    """ Stage 3: embed the chunks of each batch which are not stored yet. """
+    for batch in batches:
+        new_chunks = [(article, chunk_hash) for article in batch for chunk_hash in article["chunks"]
+                      if chunk_hash not in article["stored_hashes"]]
+        embeddings = model.encode([article["chunks"][chunk_hash] for article, chunk_hash in new_chunks]) \
+            if len(new_chunks) > 0 else []
+        for (article, chunk_hash), embedding in zip(new_chunks, embeddings):
+            article.setdefault("embeddings", {})[chunk_hash] = embedding
+        yield batch
+
+
+def write_batch(conn, batch: list[dict]):
+    """
+    Stage 4: stream a batch into the staging table with a binary COPY and commit it (this is the checkpoint).
+    Already stored chunks are staged without an embedding, they only tell the merge that the chunk is still there.
+    """
+    rows = []
+    for article in batch:
+        embeddings = article.get("embeddings", {})
+        for chunk_hash, content in article["chunks"].items():
+            rows.append((content, embeddings.get(chunk_hash), article["title"], article["author"],
+                         article["publish_date"], article["source_link"], chunk_hash))
+
     with conn.cursor() as cur:
-        psycopg2.extras.execute_values(
-            cur,
-            """
-            INSERT INTO documents (content, embedding, title, author, publish_date, source_link) 
-            VALUES %s
-            """,
-            data_for_db
-        )
-        conn.commit()
+        cur.copy_expert(f"COPY documents_staging ({STAGING_COLUMNS}) FROM STDIN WITH (FORMAT binary)",
+                        build_copy_buffer(rows, STAGING_ENCODERS))
+    conn.commit()
+
+
+def merge_staged_data(conn, links: list[str] = None):
+    """
+    Apply the staged articles to the documents table in a single transaction, so readers never see a half-loaded
+    table: delete the chunks that disappeared from the staged articles, refresh their metadata and insert the new chunks.
+    With `links` (every article of the chunk store), the articles which are no longer in the store are deleted too, so
+    an incremental run ends with the same table as a full reload.
+    """
+    with conn.cursor() as cur:
+        print("Merging the staged chunks into the 'documents' table...")
+        if links is not None:
+            # Also drops what an interrupted run staged for an article removed from the store since
+            cur.execute("DELETE FROM documents_staging WHERE NOT (source_link = ANY(%s));", (links,))
+            cur.execute("DELETE FROM documents WHERE NOT (source_link = ANY(%s));", (links,))
+            print(f"Deleted {cur.rowcount} chunks of articles which are no longer in the chunk store.")
+
+        cur.execute("""
+            DELETE FROM documents AS d
+            WHERE d.source_link IN (SELECT source_link FROM documents_staging)
+              AND NOT EXISTS (
+                  SELECT 1 FROM documents_staging AS s
+                  WHERE s.source_link = d.source_link AND s.chunk_hash = d.chunk_hash
+              );
+        """)
+        print(f"Deleted {cur.rowcount} stale chunks.")
+
+        cur.execute("""
+            UPDATE documents AS d
+            SET title = s.title, author = s.author, publish_date = s.publish_date
+            FROM (SELECT DISTINCT source_link, title, author, publish_date FROM documents_staging) AS s
+            WHERE d.source_link = s.source_link
+              AND (d.title, d.author, d.publish_date) IS DISTINCT FROM (s.title, s.author, s.publish_date);
+        """)
+
+        cur.execute(f"""
+            INSERT INTO documents ({STAGING_COLUMNS})
+            SELECT {STAGING_COLUMNS} FROM documents_staging
+            WHERE embedding IS NOT NULL
+            ON CONFLICT (source_link, chunk_hash) DO NOTHING;
+        """)
+        print(f"Inserted {cur.rowcount} new chunks.")
+
+        cur.execute("TRUNCATE documents_staging;")
+    conn.commit()
+
+
+def process_and_insert_data(conn, model, restart: bool = False, chunk_store_path: str = CHUNK_STORE_PATH):
+    """
+    Process the scraped articles, chunk their content, and insert them into the database with metadata.
+    The articles are streamed through a pipeline (read -> batch -> encode -> COPY) so that the memory usage doesn't
+    grow with the corpus and encoding overlaps with writing. Only the chunks which are not stored yet are embedded, and
+    the articles removed from the chunk store are deleted. An interrupted run is resumed from the batches it already staged, unless `restart` is set.
+    """
+    with conn.cursor() as cur:
+        if restart:
+            cur.execute("TRUNCATE documents_staging;")
+        cur.execute("SELECT DISTINCT source_link FROM documents_staging;")
+        staged_links = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    if len(staged_links) > 0:
+        print(f"Resuming from checkpoint: {len(staged_links)} articles were already staged.")
+
+    print(f"Reading the articles from '{chunk_store_path}'...")
+    with open_chunk_store(chunk_store_path) as store:
+        articles = run_in_thread(read_articles(store, staged_links))
+        batches = run_in_thread(batch_articles(articles))
+        encoded_batches = run_in_thread(encode_batches(batches, model))
+        for batch in encoded_batches:
+            write_batch(conn, batch)
+        links = store.links()
+
+    if len(links) == 0:
+        # Most likely the wrong store path, not a reason to empty the documents table
+        print(f"The chunk store '{chunk_store_path}' is empty, the stored articles are kept.")
+        links = None
+    merge_staged_data(conn, links)
+
+
+def process_and_write_local_index(model, directory: str = LOCAL_INDEX_DIR, chunk_store_path: str = CHUNK_STORE_PATH):
+    """
+    Feed the same read -> batch -> encode pipeline into the memory-mapped embedding matrix of the local retrieval
+    backend instead of Postgres. The index is rebuilt from scratch, so every chunk is embedded.
+    """
+    # Imported here so that the Postgres ingestion doesn't need the local backend
+    from database.local_index import LocalIndexWriter
+
+    print(f"Reading the articles from '{chunk_store_path}'...")
+    store = open_chunk_store(chunk_store_path)
+    articles = run_in_thread(read_articles(store, set()))
+    batches = run_in_thread(batch_articles(articles, find_stored=None))
+    encoded_batches = run_in_thread(encode_batches(batches, model))
+    with store, LocalIndexWriter(directory) as writer:
+        for batch in encoded_batches:
+            embeddings, metadata_rows = [], []
+            for article in batch:
+                for chunk_hash, embedding in article.get("embeddings", {}).items():
+                    embeddings.append(embedding)
+                    metadata_rows.append({
+                        "id": writer.count + len(metadata_rows),
+                        "content": article["chunks"][chunk_hash],
+                        "title": article["title"],
+                        "author": article["author"],
+                        "publish_date": article["publish_date"].strftime("%Y-%m-%d"),
+                        "source_link": article["source_link"]
+                    })
+            if len(metadata_rows) > 0:
+                writer.add(embeddings, metadata_rows)
+    # A retriever of this process still maps the replaced index files
+    close_retriever("local")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the scraped press releases and load them into the vector DB.")
+    parser.add_argument("--restart", action="store_true",
+                        help="Discard the checkpoint of an interrupted run instead of resuming it.")
+    parser.add_argument("--backend", choices=["pgvector", "local"], default=RETRIEVAL_BACKEND,
+                        help="Load the chunks into Postgres or into the local embedding matrix.")
+    args = parser.parse_args()
+
     print("Starting data ingestion process...")
 
     # 1. Initialize the embedding model
-    embedding_model = SentenceTransformer(EMBEDDING_MODEL)
-
-    # 2. Connect to the database
-    connection = get_db_connection()
+    embedding_model = load_embedding_model()
 
-    # 3. The embeddings from sentence-transformers are numpy arrays, not simple python lists
-    register_vector(connection)
+    if args.backend == "local":
+        # 2. Write the chunks to the local embedding matrix, no DB needed
+        process_and_write_local_index(embedding_model)
+        print("\nData ingestion complete!")
+    else:
+        # 2. Borrow a connection from the pool (the pgvector types, needed for the numpy embeddings, are already registered)
+        with pooled_connection() as connection:
+            # 3. Process files and insert into the database
+            process_and_insert_data(connection, embedding_model, restart=args.restart)
+            print("\nData ingestion complete!")
 
-    # 4. Process files and insert into the database
-    process_and_insert_data(connection, embedding_model)
-    print("\nData ingestion complete!")
+            # 4. Build the ANN index after the bulk load (IVFFlat is rebuilt once the table has grown enough for its
+            #    clusters to be stale)
+            create_vector_index(connection, rebuild=VECTOR_INDEX_TYPE == "ivfflat" and ivfflat_needs_rebuild(connection))
 
-    with connection.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM documents;")
-        count = cur.fetchone()[0]
-        print(f"There are now {count} document chunks in the database.")
+            with connection.cursor() as cur:
+                cur.execute("SELECT COUNT(*) FROM documents;")
+                count = cur.fetchone()[0]
+                print(f"There are now {count} document chunks in the database.")
 
-    connection.close()
-    print("Database connection closed.")
+    if isinstance(embedding_model, CachedEmbeddingModel):
+        cache_stats = embedding_model.cache.stats()
+        print(f"Embedding cache: {cache_stats['hits']} chunks reused, {cache_stats['misses']} embedded by the model.")
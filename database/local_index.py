@@ -0,0 +1,218 @@
+import os
+import json
+import shutil
+from datetime import date
+
+import numpy as np
+
+from constants import *
+from database.retrievers import Retriever
+
+
+# Files of a local index directory
+INFO_FILE = "index.json"  # Number of rows, dimension, dtype and embedding model
+EMBEDDINGS_FILE = "embeddings.bin"  # Raw row-major (count, dimension) matrix of L2-normalized embeddings
+METADATA_FILE = "metadata.jsonl"  # One JSON object per row: chunk id, content and metadata
+METADATA_OFFSETS_FILE = "metadata_offsets.bin"  # int64 byte offset of every row in the metadata file (+ the file size)
+FILTER_COLUMNS_FILE = "filter_columns.bin"  # Per-row publish date, author code and source link code for the filters
+FILTER_VALUES_FILE = "filter_values.json"  # The authors and source links the codes refer to
+
+FILTER_COLUMNS_DTYPE = np.dtype([("publish_date", np.int32), ("author", np.int32), ("source_link", np.int32)])
+
+SCORE_BLOCK_ROWS = 65536  # float16 matrices are scored in float32 blocks of this many rows
+SCORE_BLOCK_QUERIES = 64  # Batch searches score this many queries per matrix product (bounds the score matrix size)
+
+
+class LocalIndexWriter:
+    """
+    Write the embedding matrix and its metadata sidecar of the local retrieval backend, batch by batch.
+    Everything is written to a temporary directory which replaces the previous index only once the build succeeded.
+    """
+
+    def __init__(self, directory: str = LOCAL_INDEX_DIR, dtype: str = LOCAL_INDEX_DTYPE):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self._tmp_directory = f"{directory.rstrip(os.sep)}.tmp"
+        self._metadata_offset = 0
+        self._filter_values = {"author": {}, "source_link": {}}
+
+        shutil.rmtree(self._tmp_directory, ignore_errors=True)
+        os.makedirs(self._tmp_directory)
+        self._embeddings_file = open(os.path.join(self._tmp_directory, EMBEDDINGS_FILE), "wb")
+        self._metadata_file = open(os.path.join(self._tmp_directory, METADATA_FILE), "wb")
+        self._offsets_file = open(os.path.join(self._tmp_directory, METADATA_OFFSETS_FILE), "wb")
+        self._filter_columns_file = open(os.path.join(self._tmp_directory, FILTER_COLUMNS_FILE), "wb")
+
+    def _files(self) -> tuple:
+        return self._embeddings_file, self._metadata_file, self._offsets_file, self._filter_columns_file
+
+    def _code(self, column: str, value) -> int:
+        """ Dictionary-encode an author or source link so that the filters compare integers. """
+        return self._filter_values[column].setdefault(value, len(self._filter_values[column]))
+
+    def add(self, embeddings, metadata_rows: list[dict]):
+        """ Append rows: their embeddings (L2-normalized here) and the matching metadata dictionaries. """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(metadata_rows), VECTOR_DIMENSION)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        (embeddings / np.maximum(norms, 1e-12)).astype(self.dtype).tofile(self._embeddings_file)
+
+        filter_columns = np.empty(len(metadata_rows), dtype=FILTER_COLUMNS_DTYPE)
+        for i, row in enumerate(metadata_rows):
+            line = json.dumps(row).encode("utf-8") + b"\n"
+            self._offsets_file.write(np.int64(self._metadata_offset).tobytes())
+            self._metadata_file.write(line)
+            self._metadata_offset += len(line)
+            filter_columns[i] = (date.fromisoformat(row["publish_date"]).toordinal(),
+                                 self._code("author", row["author"]), self._code("source_link", row["source_link"]))
+        filter_columns.tofile(self._filter_columns_file)
+        self.count += len(metadata_rows)
+
+    def close(self):
+        """ Finish the build and swap the new index in place of the previous one. """
+        self._offsets_file.write(np.int64(self._metadata_offset).tobytes())
+        for file in self._files():
+            file.close()
+
+        with open(os.path.join(self._tmp_directory, FILTER_VALUES_FILE), "w") as fp:
+            json.dump({column: list(codes) for column, codes in self._filter_values.items()}, fp)
+        with open(os.path.join(self._tmp_directory, INFO_FILE), "w") as fp:
+            json.dump({"count": self.count, "dimension": VECTOR_DIMENSION, "dtype": self.dtype.name,
+                       "model": EMBEDDING_MODEL}, fp)
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.rename(self._tmp_directory, self.directory)
+        print(f"Wrote {self.count} chunks to the local index in '{self.directory}'.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the previous index if the build failed
+            for file in self._files():
+                file.close()
+            shutil.rmtree(self._tmp_directory, ignore_errors=True)
+
+
+class LocalMatrixRetriever(Retriever):
+    """
+    Exact vector search over a memory-mapped matrix of L2-normalized embeddings, without Postgres.
+    Opening the index doesn't parse anything: the matrix and the metadata offsets are memory-mapped, and only the
+    metadata of the returned rows is read. The metadata filters are vectorized masks over the memory-mapped filter
+    columns, applied before the top-k selection.
+    """
+
+    def __init__(self, directory: str = LOCAL_INDEX_DIR):
+        with open(os.path.join(directory, INFO_FILE)) as fp:
+            info = json.load(fp)
+        assert info["model"] == EMBEDDING_MODEL, \
+            f"The local index was built with '{info['model']}' but the configured model is '{EMBEDDING_MODEL}'."
+
+        self.count = info["count"]
+        self.dtype = np.dtype(info["dtype"])
+        if self.count > 0:
+            self.embeddings = np.memmap(os.path.join(directory, EMBEDDINGS_FILE), dtype=self.dtype, mode="r",
+                                        shape=(self.count, info["dimension"]))
+        else:
+            self.embeddings = np.empty((0, info["dimension"]), dtype=self.dtype)
+        self.metadata_offsets = np.memmap(os.path.join(directory, METADATA_OFFSETS_FILE), dtype=np.int64, mode="r",
+                                          shape=(self.count + 1,))
+        self.filter_columns = np.memmap(os.path.join(directory, FILTER_COLUMNS_FILE), dtype=FILTER_COLUMNS_DTYPE,
+                                        mode="r", shape=(self.count,)) if self.count > 0 \
+            else np.empty(0, dtype=FILTER_COLUMNS_DTYPE)
+        with open(os.path.join(directory, FILTER_VALUES_FILE)) as fp:
+            self.filter_codes = {column: {value: code for code, value in enumerate(values)}
+                                 for column, values in json.load(fp).items()}
+        # pread doesn't move a shared file position, so concurrent searches can read the metadata without a lock
+        self._metadata_fd = os.open(os.path.join(directory, METADATA_FILE), os.O_RDONLY)
+
+    def close(self):
+        """
+        Close the metadata file and drop the memory maps, whose file descriptors are released once the arrays returned
+        by earlier searches are gone. The retriever can't be used afterwards.
+        """
+        if self._metadata_fd is not None:
+            os.close(self._metadata_fd)
+            self._metadata_fd = None
+        self.embeddings = self.metadata_offsets = self.filter_columns = None
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarities of the (normalized) queries, a (dimension,) vector or a (dimension, n) matrix, with every
+        row, computed with vectorized dot products.
+        """
+        if self.dtype == np.float32:
+            return self.embeddings @ queries
+
+        # Half precision matrix products aren't BLAS-accelerated, so upcast one block at a time
+        scores = np.empty((self.count,) + queries.shape[1:], dtype=np.float32)
+        for start in range(0, self.count, SCORE_BLOCK_ROWS):
+            block = self.embeddings[start:start + SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ queries
+        return scores
+
+    def _filter_mask(self, filters: dict) -> np.ndarray | None:
+        """ Boolean mask of the rows which pass the metadata filters, or None without filters. """
+        mask = None
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name == "date_from":
+                condition = self.filter_columns["publish_date"] >= date.fromisoformat(str(value)).toordinal()
+            elif name == "date_to":
+                condition = self.filter_columns["publish_date"] <= date.fromisoformat(str(value)).toordinal()
+            elif name in self.filter_codes:
+                # -1 matches no row: the value doesn't occur in the index
+                condition = self.filter_columns[name] == self.filter_codes[name].get(value, -1)
+            else:
+                raise AssertionError(f"Unknown retrieval filter: {name}")
+            mask = condition if mask is None else mask & condition
+        return mask
+
+    def _read_metadata(self, row: int) -> dict:
+        start, end = int(self.metadata_offsets[row]), int(self.metadata_offsets[row + 1])
+        return json.loads(os.pread(self._metadata_fd, end - start, start))
+
+    def _top_chunks(self, scores: np.ndarray, top_k: int, similarity_threshold: float) -> list[dict]:
+        """ Read the top_k rows by score which are above the threshold. """
+        # Select the top_k rows in linear time, then only sort those
+        top_rows = np.argpartition(scores, -top_k)[-top_k:] if top_k < self.count else np.arange(self.count)
+        top_rows = top_rows[np.argsort(-scores[top_rows])]
+
+        relevant_chunks = []
+        for row in top_rows:
+            if scores[row] < similarity_threshold:
+                break
+            chunk = self._read_metadata(int(row))
+            chunk["similarity"] = float(scores[row])
+            chunk["embedding"] = np.asarray(self.embeddings[row], dtype=np.float32)
+            relevant_chunks.append(chunk)
+        return relevant_chunks
+
+    def search(self, query_embedding, top_k: int, similarity_threshold: float,
+               ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES, filters: dict = None) -> list[dict]:
+        return self.batch_search([query_embedding], top_k, similarity_threshold, filters=filters)[0]
+
+    def batch_search(self, query_embeddings: list, top_k: int, similarity_threshold: float,
+                     ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES,
+                     filters: dict = None) -> list[list[dict]]:
+        """ Score a block of queries with one matrix product instead of one matrix-vector product per query. """
+        # The search is exact, so the ANN parameters don't apply
+        mask = self._filter_mask(filters or {})
+        top_k = min(top_k, self.count if mask is None else int(np.count_nonzero(mask)))
+        if top_k == 0:
+            return [[] for _ in query_embeddings]
+
+        relevant_chunks = []
+        for start in range(0, len(query_embeddings), SCORE_BLOCK_QUERIES):
+            queries = np.asarray(query_embeddings[start:start + SCORE_BLOCK_QUERIES], dtype=np.float32)
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+            scores = self._scores(queries.T)
+            if mask is not None:
+                scores[~mask] = -np.inf
+            for column in range(scores.shape[1]):
+                relevant_chunks.append(self._top_chunks(scores[:, column], top_k, similarity_threshold))
+        return relevant_chunks
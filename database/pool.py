@@ -0,0 +1,200 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from pgvector.psycopg2 import register_vector
+
+from constants import *
+from tracing.tracing import span
+
+
+class PoolTimeoutError(Exception):
+    """ Raised when no connection becomes available within the pool timeout. """
+
+
+class PoolClosedError(Exception):
+    """ Raised when a connection is requested from a closed pool. """
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of PostgreSQL connections.
+    The pgvector types are registered once, when a connection is created, instead of on every request.
+    """
+
+    def __init__(self, connect, min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE,
+                 timeout: float = DB_POOL_TIMEOUT, healthcheck_interval: float = DB_POOL_HEALTHCHECK_INTERVAL):
+        if not 0 <= min_size <= max_size:
+            raise ValueError("The pool size bounds must satisfy 0 <= min_size <= max_size.")
+
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+
+        self._idle = []  # (connection, time it was returned to the pool)
+        self._size = 0  # Number of open connections owned by the pool (idle + in use)
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._discarded = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        try:
+            for _ in range(min_size):
+                self._idle.append((self._new_connection(), time.monotonic()))
+                self._size += 1
+                self._created += 1
+        except Exception:
+            self.close()
+            raise
+
+    def _new_connection(self):
+        """ Open a new connection and register the pgvector types on it. """
+        conn = self._connect()
+        try:
+            register_vector(conn)
+            conn.commit()  # The type lookup opens a transaction; don't leave the connection idle in it
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """ Check that a connection taken from the pool is still usable. """
+        if conn.closed:
+            return False
+
+        # Only ping connections that have been idle for a while; recently used ones are almost always fine
+        if time.monotonic() - idle_since < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        """ Close a connection and give its slot back to the pool. Must be called while holding the lock. """
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._size -= 1
+        self._discarded += 1
+
+    def getconn(self):
+        """ Take a connection from the pool, blocking up to `timeout` seconds if the pool is exhausted. """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            candidate = None
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise PoolClosedError("The connection pool is closed.")
+
+                    if self._idle:
+                        # Counted as in use while it is checked, so that concurrent callers respect the bound
+                        candidate = self._idle.pop()
+                        self._in_use += 1
+                        break
+
+                    if self._size < self.max_size:
+                        # Reserve the slot before releasing the lock so that concurrent callers respect the bound
+                        self._size += 1
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(f"No database connection available after {self.timeout}s "
+                                               f"(max_size={self.max_size}).")
+                    self._waiting += 1
+                    try:
+                        self._condition.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if candidate is None:
+                break
+
+            # Ping outside the lock, a slow or dead connection should not block the other threads
+            conn, idle_since = candidate
+            if self._is_healthy(conn, idle_since):
+                return conn
+            with self._condition:
+                self._in_use -= 1
+                self._discard(conn)
+                self._condition.notify()
+
+        # Connect outside the lock, a slow handshake should not block the other threads
+        try:
+            conn = self._new_connection()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._in_use += 1
+            self._created += 1
+        return conn
+
+    def putconn(self, conn, discard: bool = False):
+        """ Return a connection to the pool. Broken connections (or those with `discard=True`) are closed instead. """
+        with self._condition:
+            self._in_use -= 1
+            if discard or self._closed or conn.closed or \
+                    conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block.
+        The transaction is committed if the block succeeds and rolled back otherwise.
+        """
+        # Includes the wait for a free connection and, if needed, the connection setup
+        with span("db.acquire"):
+            conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self) -> dict:
+        """ Return the current pool usage, e.g. for sizing the pool. """
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "created": self._created,
+                "discarded": self._discarded,
+            }
+
+    def close(self):
+        """ Close all idle connections. Connections in use are closed when they are returned. """
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._condition.notify_all()
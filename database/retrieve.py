@@ -1,53 +1,70 @@
-from pgvector.psycopg2 import register_vector
-from sentence_transformers import SentenceTransformer
-
 from constants import *
-from database import get_db_connection
+from database.retrievers import get_retriever
+from caching.caching import encode_query, encode_queries
+from tracing.tracing import span, add_count
 
 
-def retrieve_relevant_chunks(query_text: str, model: SentenceTransformer, top_k: int, similarity_threshold: float) -> list[dict]:
+def retrieve_relevant_chunks(query_text: str, model, top_k: int, similarity_threshold: float,
+                             ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES,
+                             backend: str = RETRIEVAL_BACKEND, mode: str = RETRIEVAL_MODE,
+                             filters: dict = None, query_embedding=None) -> list[dict]:
     """
     Retrieve the top_k most relevant document chunks that are above the similarity threshold.
+    `ef_search` and `probes` tune the recall/speed trade-off of the HNSW and IVFFlat indexes for this query.
+    `backend` selects the vector search backend: the Postgres vector DB ("pgvector") or the local embedding matrix ("local").
+    `mode` selects embeddings-only ("vector") or lexical + vector ("hybrid") retrieval.
+    `filters` restricts the search to a publish date range ("date_from", "date_to"), an "author" or a "source_link".
+    `query_embedding` skips the encoding when the caller already embedded the query (e.g. in a batch).
     """
-    # 1. Connect to the database
-    conn = get_db_connection()
-    register_vector(conn)
+    # 1. Generate the embedding for the user's query (or reuse it if the same question was asked recently)
+    if query_embedding is None:
+        with span("embed_query"):
+            query_embedding = encode_query(model, query_text)
 
-    # 2. Generate the embedding for the user's query
-    query_embedding = model.encode(query_text)
+    # 2. Perform the similarity search
+    retriever = get_retriever(backend)
+    with span(f"{mode}_search"):
+        if mode == "hybrid":
+            relevant_chunks = retriever.hybrid_search(query_text, query_embedding, top_k, similarity_threshold,
+                                                      ef_search=ef_search, probes=probes, filters=filters)
+        else:
+            relevant_chunks = retriever.search(query_embedding, top_k, similarity_threshold, ef_search=ef_search,
+                                               probes=probes, filters=filters)
+    add_count("retrieved_chunks", len(relevant_chunks))
+    return relevant_chunks
 
-    # 3. Perform the vector similarity search
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT content, title, author, publish_date, source_link, 1 - (embedding <=> %s) AS similarity
-            FROM documents
-            WHERE 1 - (embedding <=> %s) >= %s
-            ORDER BY similarity DESC
-            LIMIT %s;
-            """,
-            (query_embedding, query_embedding, similarity_threshold, top_k)
-        )
-        results = cur.fetchall()
 
-    # 4. Format the results into a more usable list of dictionaries
-    relevant_chunks = []
-    for row in results:
-        relevant_chunks.append({
-            "content": row[0],
-            "title": row[1],
-            "author": row[2],
-            "publish_date": row[3].strftime("%Y-%m-%d"),
-            "source_link": row[4],
-            "similarity": row[5]
-        })
+def retrieve_relevant_chunks_batch(query_texts: list[str], model, top_k: int,
+                                   similarity_threshold: float, ef_search: int = HNSW_EF_SEARCH,
+                                   probes: int = IVFFLAT_PROBES, backend: str = RETRIEVAL_BACKEND,
+                                   mode: str = RETRIEVAL_MODE, filters: dict = None) -> list[list[dict]]:
+    """
+    Batch version of `retrieve_relevant_chunks` for evaluations and offline reports: the questions are embedded with
+    one vectorized `encode` call and searched in one round trip. Return the relevant chunks of each question, in order.
+    The hybrid mode still runs one query per question.
+    """
+    # 1. Generate the embeddings of all the questions at once
+    with span("embed_queries"):
+        query_embeddings = encode_queries(model, query_texts)
 
+    # 2. Perform the similarity searches
+    retriever = get_retriever(backend)
+    with span(f"{mode}_batch_search"):
+        if mode == "hybrid":
+            relevant_chunks = [retriever.hybrid_search(query_text, query_embedding, top_k, similarity_threshold,
+                                                       ef_search=ef_search, probes=probes, filters=filters)
+                               for query_text, query_embedding in zip(query_texts, query_embeddings)]
+        else:
+            relevant_chunks = retriever.batch_search(query_embeddings, top_k, similarity_threshold,
+                                                     ef_search=ef_search, probes=probes, filters=filters)
+    add_count("retrieved_chunks", sum(len(chunks) for chunks in relevant_chunks))
     return relevant_chunks
 
 
 if __name__ == "__main__":
     print("Initializing embedding model...")
-    model = SentenceTransformer(EMBEDDING_MODEL)
+    from embeddings.embeddings import load_embedding_model
+    model = load_embedding_model()
 
     # --- Test Case 1: A specific query ---
     test_query_1 = "What are the AI initiatives at Deutsche Telekom?"
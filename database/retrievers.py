@@ -0,0 +1,359 @@
+import time
+import threading
+
+import numpy as np
+
+from constants import *
+from database import pooled_connection
+from database.create import EMBEDDING_STORAGES
+from tracing.tracing import span, set_attribute, current_trace_id
+
+
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+
+def format_results(rows: list[tuple], with_embeddings: bool = False) -> list[dict]:
+    """
+    Format the (id, content, title, author, publish_date, source_link, similarity[, embedding]) rows into dictionaries.
+    The embeddings let the prompt building drop near-duplicate chunks without encoding them again.
+    """
+    relevant_chunks = []
+    for row in rows:
+        relevant_chunks.append({
+            "id": row[0],
+            "content": row[1],
+            "title": row[2],
+            "author": row[3],
+            "publish_date": row[4].strftime("%Y-%m-%d"),
+            "source_link": row[5],
+            "similarity": row[6]
+        })
+        if with_embeddings:
+            relevant_chunks[-1]["embedding"] = row[7]
+    return relevant_chunks
+
+
+def without_embeddings(chunks: list[dict]) -> list[dict]:
+    """ Copies of the chunks without their embedding, e.g. to serialize them to JSON. """
+    return [{key: value for key, value in chunk.items() if key != "embedding"} for chunk in chunks]
+
+
+FILTER_CONDITIONS = {
+    "date_from": "publish_date >= %(date_from)s",
+    "date_to": "publish_date <= %(date_to)s",
+    "author": "author = %(author)s",
+    "source_link": "source_link = %(source_link)s",
+}
+
+
+def get_filter_conditions(filters: dict) -> list[str]:
+    """
+    Translate the metadata filters (publish date range, author, source link) into SQL conditions which use the
+    `%(name)s` placeholders of the filter values. None values are ignored.
+    """
+    unknown_filters = set(filters) - set(FILTER_CONDITIONS)
+    assert len(unknown_filters) == 0, f"Unknown retrieval filters: {unknown_filters}"
+    return [FILTER_CONDITIONS[name] for name, value in filters.items() if value is not None]
+
+
+def run_query(cur, settings_sql: str, query_sql: str, params: dict) -> list[tuple]:
+    """
+    Run a retrieval query (after its search settings, in the same round trip) and return its rows.
+    With EXPLAIN_SLOW_QUERIES, a query slower than SLOW_QUERY_THRESHOLD_MS is run again with EXPLAIN (ANALYZE, BUFFERS)
+    and its plan is attached to the current trace (or printed without one).
+    """
+    with span("db.query"):
+        start = time.perf_counter()
+        cur.execute(settings_sql + query_sql, params)
+        rows = cur.fetchall()
+        duration_ms = (time.perf_counter() - start) * 1000
+
+    if EXPLAIN_SLOW_QUERIES and duration_ms >= SLOW_QUERY_THRESHOLD_MS:
+        # The search settings are local to the transaction, which is still open
+        with span("db.explain"):
+            cur.execute(f"EXPLAIN (ANALYZE, BUFFERS) {query_sql}", params)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        if current_trace_id() is not None:
+            set_attribute("slow_query_plan", plan)
+        else:
+            print(f"Slow retrieval query ({duration_ms:.0f} ms):\n{plan}")
+    return rows
+
+
+class Retriever:
+    """ A vector search backend. The query embedding is computed by the caller. """
+
+    def search(self, query_embedding, top_k: int, similarity_threshold: float,
+               ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES, filters: dict = None) -> list[dict]:
+        """
+        Return the top_k chunks most similar to the query embedding which are above the similarity threshold,
+        most similar first, as dictionaries with the chunk id, content, metadata and similarity.
+        `filters` restricts the search to a publish date range ("date_from", "date_to"), an "author" or a "source_link".
+        """
+        raise NotImplementedError
+
+    def batch_search(self, query_embeddings: list, top_k: int, similarity_threshold: float,
+                     ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES,
+                     filters: dict = None) -> list[list[dict]]:
+        """ Run `search` for each query embedding. Backends override this to answer all of them at once. """
+        return [self.search(query_embedding, top_k, similarity_threshold, ef_search=ef_search, probes=probes,
+                            filters=filters)
+                for query_embedding in query_embeddings]
+
+    def hybrid_search(self, query_text: str, query_embedding, top_k: int, similarity_threshold: float,
+                      ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES, filters: dict = None) -> list[dict]:
+        """ Like `search`, but also matching the words of the query text. Not every backend supports it. """
+        raise NotImplementedError(f"The {type(self).__name__} doesn't support hybrid retrieval.")
+
+    def close(self):
+        """ Release the files or connections held by the retriever. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PgvectorRetriever(Retriever):
+    """
+    Search the documents table of the Postgres vector DB.
+    With a compact embedding `storage` ("halfvec" or "binary"), the ANN index finds an oversampled set of candidates
+    which are then re-ranked exactly with the full-precision embeddings. `exact` disables the index scans altogether,
+    e.g. to measure the recall of the approximate searches.
+    """
+
+    def __init__(self, storage: str = EMBEDDING_STORAGE, exact: bool = False):
+        assert storage in EMBEDDING_STORAGES, f"Unknown embedding storage: {storage}"
+        self.storage = storage
+        self.exact = exact
+
+    def _oversampling(self) -> int:
+        """ How many candidates per result the compact index has to return for the full-precision re-ranking. """
+        return {"vector": 1, "halfvec": HALFVEC_RERANK_OVERSAMPLING, "binary": BINARY_RERANK_OVERSAMPLING}[self.storage]
+
+    def _candidates_sql(self, filter_conditions: list[str], query: str = "%(query)s") -> str:
+        """
+        The query yielding the nearest rows (by the storage's representation) with their full-precision distance.
+        `query` is the SQL expression of the query embedding: a parameter, or a column of an outer query.
+        """
+        where = f"WHERE {' AND '.join(filter_conditions)}" if len(filter_conditions) > 0 else ""
+        if self.storage == "vector":
+            # A plain `ORDER BY distance LIMIT k` so that Postgres can walk the ANN index
+            return f"""
+                SELECT id, content, title, author, publish_date, source_link, embedding, embedding <=> {query} AS distance
+                FROM documents
+                {where}
+                ORDER BY distance
+                LIMIT %(top_k)s
+            """
+
+        indexed_expression, _, distance_operator, query_expression = EMBEDDING_STORAGES[self.storage]
+        query_expression = query_expression.replace("%(query)s", query)
+        return f"""
+            SELECT id, content, title, author, publish_date, source_link, embedding, embedding <=> {query} AS distance
+            FROM (
+                SELECT id, content, title, author, publish_date, source_link, embedding
+                FROM documents
+                {where}
+                ORDER BY {indexed_expression} {distance_operator} {query_expression}
+                LIMIT %(candidates)s
+            ) AS candidates
+            ORDER BY distance
+            LIMIT %(top_k)s
+        """
+
+    def _settings(self, ef_search: int, probes: int, candidates: int, filtered: bool) -> tuple[str, dict]:
+        """
+        The statement (and its parameters) setting the search parameters for the current transaction.
+        With filters, the ANN index is scanned iteratively until enough rows pass them (pgvector >= 0.8), instead of
+        returning the ef_search/probes nearest rows and filtering most of them out afterwards.
+        """
+        sql = """
+            SELECT set_config('hnsw.ef_search', %(ef_search)s, true),
+                   set_config('ivfflat.probes', %(probes)s, true),
+                   set_config('enable_indexscan', %(enable_indexscan)s, true);
+        """
+        params = {
+            # HNSW can't return more than ef_search rows
+            "ef_search": str(max(ef_search, candidates)),
+            "probes": str(probes),
+            "enable_indexscan": "off" if self.exact else "on",
+        }
+        if filtered and ITERATIVE_INDEX_SCAN != "off":
+            sql += """
+                SELECT set_config('hnsw.iterative_scan', %(iterative_scan)s, true),
+                       set_config('ivfflat.iterative_scan', %(iterative_scan)s, true);
+            """
+            params["iterative_scan"] = ITERATIVE_INDEX_SCAN
+        return sql, params
+
+    def search(self, query_embedding, top_k: int, similarity_threshold: float,
+               ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES, filters: dict = None) -> list[dict]:
+        filters = filters or {}
+        filter_conditions = get_filter_conditions(filters)
+        candidates = top_k * self._oversampling()
+        settings_sql, settings_params = self._settings(ef_search, probes, candidates, len(filter_conditions) > 0)
+
+        # Perform the vector similarity search on a pooled connection (the pgvector types are already registered)
+        # The threshold is only applied to the top_k rows, so that it doesn't prevent the use of the index
+        # (the outer ORDER BY also restores the exact order of a relaxed iterative index scan)
+        with pooled_connection() as conn, conn.cursor() as cur:
+            results = run_query(
+                cur,
+                settings_sql,
+                f"""
+                SELECT id, content, title, author, publish_date, source_link, 1 - distance AS similarity, embedding
+                FROM ({self._candidates_sql(filter_conditions)}) AS nearest
+                WHERE 1 - distance >= %(similarity_threshold)s
+                ORDER BY distance;
+                """,
+                {
+                    **settings_params,
+                    **filters,
+                    "query": query_embedding,
+                    "top_k": top_k,
+                    "candidates": candidates,
+                    "similarity_threshold": similarity_threshold,
+                }
+            )
+
+        return format_results(results, with_embeddings=True)
+
+    def batch_search(self, query_embeddings: list, top_k: int, similarity_threshold: float,
+                     ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES,
+                     filters: dict = None) -> list[list[dict]]:
+        """
+        Search the nearest chunks of every query embedding in one statement: the embeddings are sent as a single
+        vector[] parameter and each one drives its own index scan through a LATERAL join.
+        """
+        if len(query_embeddings) == 0:
+            return []
+        filters = filters or {}
+        filter_conditions = get_filter_conditions(filters)
+        candidates = top_k * self._oversampling()
+        settings_sql, settings_params = self._settings(ef_search, probes, candidates, len(filter_conditions) > 0)
+
+        with pooled_connection() as conn, conn.cursor() as cur:
+            results = run_query(
+                cur,
+                settings_sql,
+                f"""
+                SELECT nearest.id, nearest.content, nearest.title, nearest.author, nearest.publish_date,
+                       nearest.source_link, 1 - nearest.distance AS similarity, q.query_index
+                FROM unnest(%(queries)s::vector[]) WITH ORDINALITY AS q(embedding, query_index)
+                CROSS JOIN LATERAL ({self._candidates_sql(filter_conditions, query="q.embedding")}) AS nearest
+                WHERE 1 - nearest.distance >= %(similarity_threshold)s
+                ORDER BY q.query_index, nearest.distance;
+                """,
+                {
+                    **settings_params,
+                    **filters,
+                    "queries": [np.asarray(query_embedding, dtype=np.float32) for query_embedding in query_embeddings],
+                    "top_k": top_k,
+                    "candidates": candidates,
+                    "similarity_threshold": similarity_threshold,
+                }
+            )
+
+        # Split the rows by question (the ordinality is 1-based)
+        relevant_chunks = [[] for _ in query_embeddings]
+        for row, chunk in zip(results, format_results(results)):
+            relevant_chunks[row[7] - 1].append(chunk)
+        return relevant_chunks
+
+    def hybrid_search(self, query_text: str, query_embedding, top_k: int, similarity_threshold: float,
+                      ef_search: int = HNSW_EF_SEARCH, probes: int = IVFFLAT_PROBES, filters: dict = None,
+                      semantic_depth: int = HYBRID_SEMANTIC_DEPTH, lexical_depth: int = HYBRID_LEXICAL_DEPTH,
+                      semantic_weight: float = HYBRID_SEMANTIC_WEIGHT,
+                      lexical_weight: float = HYBRID_LEXICAL_WEIGHT) -> list[dict]:
+        """
+        Run the ANN search and the full-text search in one round trip and merge their rankings with reciprocal rank
+        fusion: score = sum(weight / (RRF_K + rank)). Exact-term matches (product names, tariff codes, figures) rank
+        high even when their embedding is not the closest, so a small top_k is enough.
+        The similarity threshold only discards the chunks which don't match any word of the question either.
+        """
+        filters = filters or {}
+        filter_conditions = get_filter_conditions(filters)
+        lexical_filter = "".join(f" AND {condition}" for condition in filter_conditions)
+        candidates = semantic_depth * self._oversampling()
+        settings_sql, settings_params = self._settings(ef_search, probes, candidates, len(filter_conditions) > 0)
+
+        with pooled_connection() as conn, conn.cursor() as cur:
+            results = run_query(
+                cur,
+                settings_sql,
+                f"""
+                WITH semantic AS (
+                    SELECT id, row_number() OVER (ORDER BY distance) AS rank
+                    FROM ({self._candidates_sql(filter_conditions)}) AS nearest
+                ),
+                lexical AS (
+                    SELECT id, row_number() OVER (ORDER BY text_rank DESC) AS rank
+                    FROM (
+                        SELECT id, ts_rank_cd(content_tsv, text_query) AS text_rank
+                        FROM documents, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', %(query_text)s) AS text_query
+                        WHERE content_tsv @@ text_query{lexical_filter}
+                        ORDER BY text_rank DESC
+                        LIMIT %(lexical_depth)s
+                    ) AS matches
+                ),
+                fused AS (
+                    SELECT coalesce(semantic.id, lexical.id) AS id,
+                           coalesce(%(semantic_weight)s::float8 / (%(rrf_k)s + semantic.rank), 0) +
+                           coalesce(%(lexical_weight)s::float8 / (%(rrf_k)s + lexical.rank), 0) AS score,
+                           lexical.id IS NOT NULL AS lexical_match
+                    FROM semantic FULL OUTER JOIN lexical ON semantic.id = lexical.id
+                )
+                SELECT d.id, d.content, d.title, d.author, d.publish_date, d.source_link,
+                       1 - (d.embedding <=> %(query)s) AS similarity, d.embedding, fused.score
+                FROM fused JOIN documents AS d ON d.id = fused.id
+                WHERE fused.lexical_match OR 1 - (d.embedding <=> %(query)s) >= %(similarity_threshold)s
+                ORDER BY fused.score DESC
+                LIMIT %(result_count)s;
+                """,
+                {
+                    **settings_params,
+                    **filters,
+                    "query": query_embedding,
+                    "query_text": query_text,
+                    "top_k": semantic_depth,
+                    "candidates": candidates,
+                    "lexical_depth": lexical_depth,
+                    "semantic_weight": semantic_weight,
+                    "lexical_weight": lexical_weight,
+                    "rrf_k": RRF_K,
+                    "similarity_threshold": similarity_threshold,
+                    "result_count": top_k,
+                }
+            )
+
+        relevant_chunks = format_results(results, with_embeddings=True)
+        for chunk, row in zip(relevant_chunks, results):
+            chunk["score"] = row[8]
+        return relevant_chunks
+
+
+def get_retriever(backend: str = RETRIEVAL_BACKEND) -> Retriever:
+    """ Return the (process-wide) retriever of the given backend: "pgvector" or "local". """
+    if backend not in _retrievers:
+        with _retrievers_lock:
+            if backend not in _retrievers:
+                if backend == "pgvector":
+                    _retrievers[backend] = PgvectorRetriever()
+                elif backend == "local":
+                    # Imported here so that the pgvector backend doesn't need numpy's memory-mapped index files
+                    from database.local_index import LocalMatrixRetriever
+                    _retrievers[backend] = LocalMatrixRetriever(LOCAL_INDEX_DIR)
+                else:
+                    raise ValueError(f"Unknown retrieval backend: {backend}")
+    return _retrievers[backend]
+
+
+def close_retriever(backend: str = RETRIEVAL_BACKEND):
+    """ Close the process-wide retriever of the backend, the next `get_retriever` opens it again (e.g. a new index). """
+    with _retrievers_lock:
+        retriever = _retrievers.pop(backend, None)
+    if retriever is not None:
+        retriever.close()
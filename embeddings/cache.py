@@ -0,0 +1,236 @@
+import os
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+from constants import *
+
+
+# Files of the embedding cache directory
+INDEX_FILE = "index.sqlite"  # Text key -> slot of its vector, and the last time it was used (for the LRU eviction)
+VECTORS_FILE = "vectors.bin"  # (slots, dimension) float32 matrix, created sparse at its maximum size
+KEYS_FILE = "keys.bin"  # The key of the vector stored in each slot, written after the vector (see `get`)
+
+KEY_SIZE = 32  # SHA-256 digest
+SQLITE_MAX_PARAMETERS = 500  # Keys per `IN (...)` query
+MAX_PENDING_TOUCHES = 10_000  # Cache hits whose LRU timestamp is kept in memory before it is written anyway
+
+
+def normalize_text(text: str) -> str:
+    """ Collapse the whitespace, which the tokenizer ignores anyway, so that it doesn't change the cache key. """
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Disk-backed embeddings of the texts we already encoded, keyed by (model name, normalized text hash), shared by
+    every process: the vectors live in a memory-mapped file of fixed-size slots and an SQLite index maps the keys to
+    their slots. Above `max_mb` the least recently used embeddings are evicted and their slots reused.
+
+    Readers take no lock, the slot's key works as the sequence number of a seqlock: a writer clears it before
+    overwriting the vector and writes it back once the vector is complete, and a reader only keeps its copy of the vector
+    if the slot held the expected key both before and after the copy, so it never returns a half-written or evicted one.
+    """
+
+    def __init__(self, model_name: str, directory: str = EMBEDDING_CACHE_DIR, max_mb: float = EMBEDDING_CACHE_MAX_MB,
+                 dimension: int = VECTOR_DIMENSION):
+        self.model_name = model_name
+        self.directory = directory
+        self.dimension = dimension
+        self.max_slots = max(1, int(max_mb * 2**20) // (dimension * 4))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # One SQLite connection per cache, shared by the threads of the process
+        # Key -> when it was last read. The lookups stay read-only, the timestamps are written in batches
+        self._pending_touches = {}
+        self._last_touch_flush = time.monotonic()
+        atexit.register(self.flush)
+
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, INDEX_FILE), timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, slot INTEGER NOT NULL, "
+                              "last_used REAL NOT NULL) WITHOUT ROWID;")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used_idx ON entries (last_used);")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value INTEGER NOT NULL);")
+            self._open_files()
+            self.conn.execute("COMMIT;")
+        except BaseException:
+            self.conn.execute("ROLLBACK;")
+            raise
+
+    def _open_files(self):
+        """ Map the vector and key files, (re)creating them if the size or the dimension changed. Runs in a write transaction. """
+        info = dict(self.conn.execute("SELECT name, value FROM info;").fetchall())
+        vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        keys_path = os.path.join(self.directory, KEYS_FILE)
+        if info.get("slots") != self.max_slots or info.get("dimension") != self.dimension \
+                or not os.path.exists(vectors_path) or not os.path.exists(keys_path):
+            # Sparse files: the disk space is only used as the slots are filled
+            np.memmap(vectors_path, dtype=np.float32, mode="w+", shape=(self.max_slots, self.dimension)).flush()
+            np.memmap(keys_path, dtype=np.uint8, mode="w+", shape=(self.max_slots, KEY_SIZE)).flush()
+            self.conn.execute("DELETE FROM entries;")
+            self.conn.executemany("INSERT OR REPLACE INTO info (name, value) VALUES (?, ?);",
+                                  [("slots", self.max_slots), ("dimension", self.dimension), ("next_slot", 0)])
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(self.max_slots, self.dimension))
+        self.keys = np.memmap(keys_path, dtype=np.uint8, mode="r+", shape=(self.max_slots, KEY_SIZE))
+
+    def flush(self):
+        """ Write the pending LRU timestamps of the cache hits. """
+        with self._lock:
+            self._flush_touches()
+
+    def close(self):
+        atexit.unregister(self.flush)
+        self.flush()
+        self.conn.close()
+
+    def get_key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+    def _find_slots(self, keys: list[bytes]) -> dict:
+        slots = {}
+        for start in range(0, len(keys), SQLITE_MAX_PARAMETERS):
+            batch = keys[start:start + SQLITE_MAX_PARAMETERS]
+            slots.update(self.conn.execute(f"SELECT key, slot FROM entries WHERE key IN ({', '.join('?' * len(batch))});",
+                                           batch).fetchall())
+        return slots
+
+    def _write_touches(self):
+        """ Write the pending LRU timestamps. Runs in a write transaction. """
+        self.conn.executemany("UPDATE entries SET last_used = ? WHERE key = ? AND last_used < ?;",
+                              [(used, key, used) for key, used in self._pending_touches.items()])
+        self._pending_touches.clear()
+
+    def _flush_touches(self):
+        """
+        Write the pending LRU timestamps in one transaction. Skipped if another process holds the write lock, the LRU
+        order is a hint (they are written with the next flush or `put`). Must be called while holding the lock.
+        """
+        self._last_touch_flush = time.monotonic()
+        if len(self._pending_touches) == 0:
+            return
+        self.conn.execute("PRAGMA busy_timeout = 0;")
+        try:
+            self.conn.execute("BEGIN IMMEDIATE;")
+            self._write_touches()
+            self.conn.execute("COMMIT;")
+        except sqlite3.OperationalError:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK;")
+            if len(self._pending_touches) > MAX_PENDING_TOUCHES:
+                self._pending_touches.clear()
+        finally:
+            self.conn.execute("PRAGMA busy_timeout = 30000;")
+
+    def get(self, keys: list[bytes]) -> dict:
+        """ Return the cached embeddings of the keys which are in the cache (key -> vector). """
+        with self._lock:
+            slots = self._find_slots(keys)
+        embeddings = {}
+        for key, slot in slots.items():
+            # Before the copy: the vector may not be written yet (its index entry is committed first) or the slot reused
+            if self.keys[slot].tobytes() != key:
+                continue
+            embedding = np.array(self.vectors[slot])
+            # After the copy: a writer may have started overwriting the slot meanwhile
+            if self.keys[slot].tobytes() == key:
+                embeddings[key] = embedding
+        if len(embeddings) > 0:
+            now = time.time()
+            with self._lock:
+                self._pending_touches.update(dict.fromkeys(embeddings, now))
+                if len(self._pending_touches) >= MAX_PENDING_TOUCHES \
+                        or time.monotonic() - self._last_touch_flush >= EMBEDDING_CACHE_TOUCH_INTERVAL:
+                    self._flush_touches()
+        return embeddings
+
+    def _allocate_slots(self, keys: list[bytes]) -> list[int]:
+        """ Give every key a slot: its own if it has one, else a never used one, else one of the least recently used. """
+        now = time.time()
+        slots = self._find_slots(keys)
+        new_keys = [key for key in keys if key not in slots]
+        self.conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?;", [(now, key) for key in slots])
+
+        next_slot = self.conn.execute("SELECT value FROM info WHERE name = 'next_slot';").fetchone()[0]
+        free_slots = list(range(next_slot, min(next_slot + len(new_keys), self.max_slots)))
+        self.conn.execute("UPDATE info SET value = ? WHERE name = 'next_slot';", (next_slot + len(free_slots),))
+        evicted = self.conn.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT ?;",
+                                    (len(new_keys) - len(free_slots),)).fetchall()
+        self.conn.executemany("DELETE FROM entries WHERE key = ?;", [(key,) for key, _ in evicted])
+        free_slots += [slot for _, slot in evicted]
+
+        self.conn.executemany("INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?);",
+                              [(key, slot, now) for key, slot in zip(new_keys, free_slots)])
+        slots.update(zip(new_keys, free_slots))
+        return [slots[key] for key in keys]
+
+    def put(self, keys: list[bytes], embeddings):
+        """ Store the embeddings of the keys, evicting the least recently used ones if the cache is full. """
+        embeddings = dict(zip(keys, np.asarray(embeddings, dtype=np.float32).reshape(len(keys), self.dimension)))
+        # A batch bigger than the whole cache only keeps its last embeddings
+        keys = list(embeddings)[-self.max_slots:]
+        embeddings = np.stack([embeddings[key] for key in keys])
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE;")
+            try:
+                # The eviction has to see the recent hits
+                self._write_touches()
+                slots = self._allocate_slots(keys)
+                # Invalidate the slots before the new index entries are visible and before their vectors change
+                self.keys[slots] = 0
+                self.conn.execute("COMMIT;")
+            except BaseException:
+                self.conn.execute("ROLLBACK;")
+                raise
+            self.vectors[slots] = embeddings
+            self.keys[slots] = np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(len(keys), KEY_SIZE)
+            self.vectors.flush()
+            self.keys.flush()
+
+    def encode(self, texts: list[str], encode_function) -> np.ndarray:
+        """
+        Return the embeddings of the texts: the cached ones are read from disk and only the missing (distinct) texts
+        are passed to `encode_function` in one batch, then added to the cache.
+        """
+        keys = [self.get_key(text) for text in texts]
+        embeddings = self.get(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in embeddings}
+        self.hits += len(keys) - sum(key not in embeddings for key in keys)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            new_embeddings = encode_function(list(missing.values()))
+            self.put(list(missing), new_embeddings)
+            embeddings.update(zip(missing, np.asarray(new_embeddings, dtype=np.float32)))
+
+        if len(keys) == 0:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.stack([embeddings[key] for key in keys])
+
+    def stats(self) -> dict:
+        count = self.conn.execute("SELECT COUNT(*) FROM entries;").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "max_entries": self.max_slots}
+
+
+class CachedEmbeddingModel:
+    """ An embedding model behind the persistent embedding cache, with the call shape of `SentenceTransformer.encode`. """
+
+    def __init__(self, model, model_name: str, cache: EmbeddingCache = None):
+        self.model = model
+        self.cache = cache or EmbeddingCache(model_name)
+
+    def encode(self, sentences, **kwargs):
+        # Options which change the vectors (e.g. normalize_embeddings) are not part of the cache key
+        if len(kwargs) > 0:
+            return self.model.encode(sentences, **kwargs)
+        if isinstance(sentences, str):
+            return self.cache.encode([sentences], self.model.encode)[0]
+        return self.cache.encode(list(sentences), self.model.encode)
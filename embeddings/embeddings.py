@@ -0,0 +1,132 @@
+import os
+import threading
+
+import numpy as np
+
+from constants import *
+from embeddings.cache import CachedEmbeddingModel
+
+
+# Files of an exported ONNX model directory
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model_quantized.onnx"  # int8 weights (dynamic quantization)
+TOKENIZER_FILE = "tokenizer.json"
+
+
+class OnnxEmbedder:
+    """
+    The all-MiniLM-L6-v2 encoder exported to ONNX (see `python -m embeddings.export`), run with onnxruntime and the
+    Rust `tokenizers` library instead of PyTorch. It reproduces the SentenceTransformer pipeline (mean pooling over
+    the tokens, then L2 normalization), so its vectors can be compared with the stored embeddings.
+    """
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, quantized: bool = ONNX_QUANTIZED,
+                 threads: int = ONNX_THREADS):
+        # Imported here so that the default backend doesn't need them
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=ONNX_MAX_SEQUENCE_LENGTH)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        model_file = ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, model_file), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _encode_batch(self, sentences: list[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(sentences)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+
+        # Mean pooling over the real (not padding) tokens, then L2 normalization
+        mask = attention_mask[:, :, None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs) -> np.ndarray:
+        """ Same call shape as `SentenceTransformer.encode`: one text gives a vector, a list gives a matrix. """
+        if isinstance(sentences, str):
+            return self._encode_batch([sentences])[0]
+        if len(sentences) == 0:
+            return np.empty((0, VECTOR_DIMENSION), dtype=np.float32)
+
+        # Batch sentences of similar length together so that little time is spent on padding
+        order = np.argsort([len(sentence) for sentence in sentences])
+        embeddings = np.empty((len(sentences), VECTOR_DIMENSION), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            rows = order[start:start + batch_size]
+            embeddings[rows] = self._encode_batch([sentences[row] for row in rows])
+        return embeddings
+
+
+def get_cache_model_name(backend: str = EMBEDDING_BACKEND) -> str:
+    """ The name of the model in the embedding cache keys: the int8 ONNX model gives (slightly) different vectors. """
+    if backend == "onnx":
+        return f"{EMBEDDING_MODEL}/onnx{'-int8' if ONNX_QUANTIZED else ''}"
+    return EMBEDDING_MODEL
+
+
+def load_embedding_model(backend: str = EMBEDDING_BACKEND, cached: bool = EMBEDDING_CACHE_ENABLED):
+    """
+    Load the embedding model of the given backend: "sentence_transformers" (PyTorch) or "onnx".
+    With `cached`, the model is wrapped in the persistent embedding cache.
+    """
+    if backend == "onnx":
+        model = OnnxEmbedder()
+    elif backend == "sentence_transformers":
+        # Imported here because importing torch alone takes seconds
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(EMBEDDING_MODEL)
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    return CachedEmbeddingModel(model, get_cache_model_name(backend)) if cached else model
+
+
+class BackgroundEmbeddingModel:
+    """
+    Load (and warm up) the embedding model on a background thread, so that the app can start serving while the model
+    loads. `encode` waits for the model the first time it is needed.
+    """
+
+    def __init__(self, backend: str = EMBEDDING_BACKEND):
+        self.backend = backend
+        self._model = None
+        self._error = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._load, daemon=True).start()
+
+    def _load(self):
+        try:
+            model = load_embedding_model(self.backend, cached=False)
+            # The first call allocates the buffers (and, with onnxruntime, picks the kernels)
+            model.encode("warm up")
+            self._model = CachedEmbeddingModel(model, get_cache_model_name(self.backend)) if EMBEDDING_CACHE_ENABLED else model
+        except Exception as e:
+            print(f"Error loading the '{self.backend}' embedding model: {e}")
+            self._error = e
+        finally:
+            self._ready.set()
+
+    def get(self):
+        """ Return the model, waiting for it to be loaded if needed. """
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self._model
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set() and self._error is None
+
+    def encode(self, sentences, **kwargs):
+        return self.get().encode(sentences, **kwargs)
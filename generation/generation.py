@@ -1,42 +1,30 @@
-from collections import defaultdict
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from collections.abc import Iterator, AsyncIterator
 
-from openai import OpenAI, OpenAIError
+import numpy as np
+from openai import OpenAI, AsyncOpenAI, OpenAIError, APIStatusError, APIConnectionError, APITimeoutError
 
 from constants import *
+from tracing.tracing import span, add_count, set_attribute, record_error
 
 
-def group_chunks_by_source(context_chunks: list[dict]) -> dict:
-    """
-    Group retrieved chunks by their source URL.
-    """
-    grouped_chunks = defaultdict(list)
-
-    for chunk in context_chunks:
-        source_link = chunk['source_link']
-        grouped_chunks[source_link].append(chunk)
-    return grouped_chunks
-
-
-def build_prompt(user_question: str, context_chunks: list[dict]) -> str:
-    """
-    Build the augmented prompt for the LLM.
-    """
-    assert len(context_chunks) > 0, "The LLM needs at least one context chunk to generate an answer to the user's question."
+_client = None
+_client_lock = threading.Lock()
+_token_encoder = None
+_generation_clients = weakref.WeakKeyDictionary()  # Event loop -> its GenerationClient
 
-    grouped_chunks = group_chunks_by_source(context_chunks)
 
-    # Number the sources for clear citation
-    context_str = ""
-    for i, (url, chunk_list) in enumerate(grouped_chunks.items()):
-        context_str += f"[Source {i + 1}]:\n"
-        context_str += f'URL: {url}\n'
-        context_str += f"Published Date: {chunk_list[0]['publish_date']}\n"
-        context_str += "Relevant Content:\n"
-        for chunk in chunk_list:
-            context_str += f'- "{chunk["content"]}"\n'
-        context_str += "\n"
-
-    prompt = f"""
+# Filled by `build_prompt`, its hash is part of the answer cache key (see `get_prompt_version`)
+PROMPT_TEMPLATE = """
 You are a highly analytical assistant. Your task is to answer a user's question based *only* on the provided context.
 
 Follow these instructions precisely:
@@ -48,38 +36,506 @@ Follow these instructions precisely:
 
 ---
 CONTEXT:
-{context_str}
+{context}
 ---
 
 USER'S QUESTION:
-"{user_question}"
+"{question}"
 
 ---
 
 YOUR STRUCTURED RESPONSE:
 """
-    return prompt
 
 
-def get_llm_answer(prompt):
+class GenerationError(Exception):
     """
-    Send the prompt to the OpenAI API and get the answer.
+    The LLM could not generate an answer. `kind` says why: "authentication", "rate_limit", "timeout", "connection",
+    "server", "bad_request" or "unknown". `retry_after` is the delay (in seconds) requested by the provider, if any.
+    """
+
+    USER_MESSAGES = {
+        "authentication": "You must set the OpenAI API key.",
+        "rate_limit": "Too many questions are being answered right now, please try again in a moment.",
+    }
+    RETRYABLE_KINDS = ("rate_limit", "timeout", "connection", "server")
+
+    def __init__(self, kind: str, message: str, status_code: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """ Whether the same request may succeed later. """
+        return self.kind in self.RETRYABLE_KINDS
+
+    @property
+    def user_message(self) -> str:
+        """ The message to show to the user instead of an answer. """
+        return self.USER_MESSAGES.get(self.kind, "Sorry, I encountered an error while generating the answer.")
+
+    def to_dict(self) -> dict:
+        return {"kind": self.kind, "message": self.user_message, "retryable": self.retryable,
+                "retry_after": self.retry_after}
+
+
+def get_token_encoder():
+    """ The tokenizer of the LLM, or None if tiktoken isn't available (the token counts are then estimated). """
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            try:
+                _token_encoder = tiktoken.encoding_for_model(OPENAI_LLM_MODEL)
+            except KeyError:
+                _token_encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Not installed, or its vocabulary can't be downloaded
+            print(f"Estimating the prompt tokens, tiktoken is not available: {e}")
+            _token_encoder = False
+    return _token_encoder or None
+
+
+def count_tokens(text: str) -> int:
+    encoder = get_token_encoder()
+    if encoder is None:
+        return math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoder = get_token_encoder()
+    if encoder is None:
+        return text[:max_tokens * PROMPT_CHARS_PER_TOKEN]
+    return encoder.decode(encoder.encode(text, disallowed_special=())[:max_tokens])
+
+
+def select_context_chunks(context_chunks: list[dict], duplicate_similarity: float = PROMPT_DUPLICATE_SIMILARITY,
+                          mmr_lambda: float = PROMPT_MMR_LAMBDA) -> list[dict]:
+    """
+    Order the chunks by maximal marginal relevance (relevance minus similarity to the chunks already picked) and
+    drop the near-duplicates, e.g. paragraphs repeating the same heading or boilerplate.
+    The retrieval embeddings of the chunks are used when they are available, otherwise only exact duplicates
+    (ignoring case and whitespace) are dropped.
+    """
+    # Relevance on a 0-1 scale, from the fused score of the hybrid retrieval or the similarity
+    relevance = np.array([chunk.get("score", chunk["similarity"]) for chunk in context_chunks], dtype=np.float32)
+    spread = float(relevance.max() - relevance.min())
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+
+    embeddings = None
+    if all(chunk.get("embedding") is not None for chunk in context_chunks):
+        embeddings = np.array([np.asarray(chunk["embedding"], dtype=np.float32) for chunk in context_chunks])
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    max_similarity = np.full(len(context_chunks), -1.0, dtype=np.float32)  # To the selected chunks
+    seen_texts = set()
+    remaining = list(range(len(context_chunks)))
+    selected_chunks = []
+    while len(remaining) > 0:
+        best = max(remaining, key=lambda i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * max(max_similarity[i], 0.0))
+        remaining.remove(best)
+        text = re.sub(r"\s+", " ", context_chunks[best]["content"]).strip().lower()
+        if max_similarity[best] >= duplicate_similarity or text in seen_texts:
+            continue
+        seen_texts.add(text)
+        selected_chunks.append(context_chunks[best])
+        if embeddings is not None:
+            max_similarity = np.maximum(max_similarity, embeddings @ embeddings[best])
+    return selected_chunks
+
+
+def get_source_header(source_number: int, url: str, publish_date: str) -> str:
+    return f"[Source {source_number}]:\nURL: {url}\nPublished Date: {publish_date}\nRelevant Content:\n"
+
+
+def pack_context(context_chunks: list[dict], token_budget: int = PROMPT_CONTEXT_TOKEN_BUDGET) -> list[tuple[str, list[dict]]]:
+    """
+    Fill the token budget of the context with the most relevant non-redundant chunks, grouped by source.
+    The sources are ordered by their best chunk, so the most relevant ones come first and survive any truncation.
+    A chunk which doesn't fit is skipped (a shorter one may still fit). The first chunk is truncated if needed, so
+    that the context is never empty.
+    """
+    sources = {}  # url -> chunks, in order of relevance
+    used_tokens = 0
+    for chunk in select_context_chunks(context_chunks):
+        url = chunk["source_link"]
+        header_tokens = 0 if url in sources else count_tokens(get_source_header(len(sources) + 1, url, chunk["publish_date"]) + "\n")
+        chunk_tokens = count_tokens(f'- "{chunk["content"]}"\n')
+        if used_tokens + header_tokens + chunk_tokens > token_budget:
+            if len(sources) > 0:
+                continue
+            chunk = {**chunk, "content": truncate_to_tokens(chunk["content"], max(token_budget - header_tokens - 4, 1))}
+            chunk_tokens = count_tokens(f'- "{chunk["content"]}"\n')
+        sources.setdefault(url, []).append(chunk)
+        used_tokens += header_tokens + chunk_tokens
+    return list(sources.items())
+
+
+def get_prompt_version() -> str:
+    """
+    Hash of the prompt template and of the settings which decide the packed context. It is part of the answer cache
+    key, so that changing any of them doesn't keep serving the answers to the old prompts.
+    """
+    encoder = get_token_encoder()
+    settings = [PROMPT_TEMPLATE, PROMPT_CONTEXT_TOKEN_BUDGET, PROMPT_DUPLICATE_SIMILARITY, PROMPT_MMR_LAMBDA,
+                PROMPT_CHARS_PER_TOKEN if encoder is None else encoder.name]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+
+def build_prompt(user_question: str, context_chunks: list[dict], token_budget: int = PROMPT_CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Build the augmented prompt for the LLM, with at most `token_budget` tokens of (deduplicated) context.
+    """
+    assert len(context_chunks) > 0, "The LLM needs at least one context chunk to generate an answer to the user's question."
+
+    # Number the sources for clear citation (the parts are joined once, in linear time)
+    context_parts = []
+    for i, (url, chunk_list) in enumerate(pack_context(context_chunks, token_budget)):
+        context_parts.append(get_source_header(i + 1, url, chunk_list[0]['publish_date']))
+        for chunk in chunk_list:
+            context_parts.append(f'- "{chunk["content"]}"\n')
+        context_parts.append("\n")
+    context_str = "".join(context_parts)
+
+    return PROMPT_TEMPLATE.format(context=context_str, question=user_question)
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Return the process-wide OpenAI client. Reusing it keeps the HTTPS connections to the API alive between questions.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(api_key=OPENAI_KEY,
+                                 base_url=OPENAI_BASE_URL,
+                                 timeout=LLM_TIMEOUT,
+                                 max_retries=LLM_MAX_RETRIES)
+    return _client
+
+
+def get_completion_params(prompt: str, stream: bool = False) -> dict:
+    """ The chat completion request for the prompt, shared by the sync and asyncio clients. """
+    params = {
+        "model": OPENAI_LLM_MODEL,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": LLM_TEMPERATURE,
+        "max_tokens": LLM_MAX_OUTPUT_TOKENS
+    }
+    if stream:
+        # The last chunk then carries the token counts
+        params.update(stream=True, stream_options={"include_usage": True})
+    return params
+
+
+def request_llm_answer(prompt: str) -> str:
+    """
+    Send the prompt to the OpenAI API and return the answer. Raises a GenerationError if no answer could be generated.
     """
     try:
-        client = OpenAI(api_key=OPENAI_KEY)
-
-        response = client.chat.completions.create(
-            model=OPENAI_LLM_MODEL,
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=LLM_TEMPERATURE,
-            max_tokens=LLM_MAX_OUTPUT_TOKENS
-        )
-        return response.choices[0].message.content
-    except OpenAIError as e:
-        print(f"Error while initializing OpenAI API: {e}")
-        return "You must set the OpenAI API key."
+        with span("llm.request"):
+            response = get_openai_client().chat.completions.create(**get_completion_params(prompt))
     except Exception as e:
-        print(f"Error calling OpenAI API: {e}")
-        return "Sorry, I encountered an error while generating the answer."
+        raise to_generation_error(e) from e
+    record_token_usage(response.usage)
+    return response.choices[0].message.content
+
+
+def stream_llm_answer(prompt: str) -> Iterator[str]:
+    """
+    Send the prompt to the OpenAI API and yield the answer's tokens as they are generated.
+    Raises a GenerationError if the answer could not be generated (possibly after some tokens).
+    """
+    try:
+        with span("llm.stream"):
+            start = time.perf_counter()
+            stream = get_openai_client().chat.completions.create(**get_completion_params(prompt, stream=True))
+            first_token = True
+            # Closes the HTTP response even if the reader stops early (GeneratorExit), so the generation stops too
+            with stream:
+                for chunk in stream:
+                    if chunk.usage is not None:
+                        record_token_usage(chunk.usage)
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        if first_token:
+                            set_attribute("llm_first_token_ms", round((time.perf_counter() - start) * 1000, 3))
+                            first_token = False
+                        yield chunk.choices[0].delta.content
+    except Exception as e:
+        raise to_generation_error(e) from e
+
+
+class TokenBucket:
+    """
+    asyncio token bucket: refilled at `rate_per_minute` and holding at most `capacity` tokens, LLM_RATE_LIMIT_BURST_SECONDS
+    of the rate by default (it starts full, so a whole minute of quota is never sent in one burst). `acquire` waits
+    until enough tokens are available. `pause` holds every `acquire` for a while, e.g. when the provider asks us to
+    retry later.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(1.0, self.rate * LLM_RATE_LIMIT_BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self, amount: float = 1):
+        # A request bigger than the bucket waits for a full bucket, then leaves it in debt
+        needed = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= needed:
+                self.tokens -= amount
+                return
+            await asyncio.sleep(max(self.paused_until - now, (needed - self.tokens) / self.rate))
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class GenerationClient:
+    """
+    asyncio LLM client for many concurrent questions:
+    - at most `max_concurrency` requests in flight, the others wait their turn (backpressure),
+    - requests and tokens per minute are kept under the provider's rate limits with token buckets,
+    - rate limited, timed out and failed requests are retried, after the delay the provider asked for if any
+      (a rate limit pauses every request, not only the one which hit it),
+    - concurrent `complete` calls with the same prompt share one completion.
+    Errors are raised as GenerationError.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENT_REQUESTS,
+                 requests_per_minute: float = LLM_REQUESTS_PER_MINUTE, tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+                 max_retries: int = LLM_MAX_RETRIES):
+        # The retries are done here, so that they go through the rate limits
+        self.client = AsyncOpenAI(api_key=OPENAI_KEY, base_url=OPENAI_BASE_URL, timeout=LLM_TIMEOUT, max_retries=0)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self._in_flight = {}
+
+    async def close(self):
+        await self.client.close()
+
+    async def _wait_for_rate_limits(self, prompt: str):
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire()
+        if self.token_bucket is not None:
+            # The provider counts the prompt and the maximum completion tokens
+            await self.token_bucket.acquire(count_tokens(prompt) + LLM_MAX_OUTPUT_TOKENS)
+
+    def _retry_delay(self, error: GenerationError, attempt: int) -> float | None:
+        """ Return how long to wait before retrying, or None if the error is final. """
+        if not error.retryable or attempt >= self.max_retries:
+            return None
+        if error.retry_after is not None:
+            for bucket in (self.request_bucket, self.token_bucket):
+                if bucket is not None:
+                    bucket.pause(error.retry_after)
+            return error.retry_after
+        return LLM_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def _create(self, prompt: str, stream: bool):
+        """ Send the request: within the concurrency limit and the rate limits, with retries. """
+        attempt = 0
+        while True:
+            await self._wait_for_rate_limits(prompt)
+            try:
+                return await self.client.chat.completions.create(**get_completion_params(prompt, stream=stream))
+            except Exception as e:
+                error = to_generation_error(e)
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise error from e
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _complete(self, prompt: str) -> str:
+        async with self.semaphore:
+            with span("llm.request"):
+                response = await self._create(prompt, stream=False)
+        record_token_usage(response.usage)
+        return response.choices[0].message.content
+
+    async def complete(self, prompt: str) -> str:
+        """ Return the answer to the prompt, sharing the request with the identical prompts in flight. """
+        key = hashlib.sha256(json.dumps(get_completion_params(prompt)).encode("utf-8")).hexdigest()
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._complete(prompt))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done_task: self._in_flight.pop(key) if self._in_flight.get(key) is done_task else None)
+        # A caller which is cancelled must not cancel the request the other callers share
+        return await asyncio.shield(task)
+
+    async def _pump_stream(self, prompt: str, queue: asyncio.Queue):
+        """
+        Read the whole streamed answer into the queue, then None (or the exception which ended it). The concurrency
+        slot is only held while the LLM generates, not while slow readers catch up.
+        """
+        end = None
+        try:
+            async with self.semaphore:
+                with span("llm.stream"):
+                    start = time.perf_counter()
+                    stream = await self._create(prompt, stream=True)
+                    first_token = True
+                    # Closes the HTTP response when the reader stops early and this task is cancelled
+                    async with stream:
+                        try:
+                            async for chunk in stream:
+                                if chunk.usage is not None:
+                                    record_token_usage(chunk.usage)
+                                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                                    if first_token:
+                                        set_attribute("llm_first_token_ms", round((time.perf_counter() - start) * 1000, 3))
+                                        first_token = False
+                                    queue.put_nowait(chunk.choices[0].delta.content)
+                        except Exception as e:
+                            raise to_generation_error(e) from e
+        except Exception as e:
+            # Not only GenerationErrors (e.g. a failing tracing call): whatever ends the task, the reader must not wait forever
+            end = e
+        finally:
+            queue.put_nowait(end)
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        """ Yield the answer's tokens as they are generated. Only the request is retried, not a broken stream. """
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(self._pump_stream(prompt, queue))
+        try:
+            while True:
+                token = await queue.get()
+                if token is None:
+                    return
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        finally:
+            # The reader stopped early (closed or cancelled): stop the generation
+            task.cancel()
+
+
+def get_generation_client() -> GenerationClient:
+    """ Return the GenerationClient of the running event loop (asyncio primitives can't be shared between loops). """
+    loop = asyncio.get_running_loop()
+    client = _generation_clients.get(loop)
+    if client is None:
+        client = _generation_clients[loop] = GenerationClient()
+    return client
+
+
+async def request_llm_answer_async(prompt: str) -> str:
+    """ asyncio version of `request_llm_answer`, through the concurrency-limited, rate-limited and coalescing client. """
+    return await get_generation_client().complete(prompt)
+
+
+async def stream_llm_answer_async(prompt: str) -> AsyncIterator[str]:
+    """ asyncio version of `stream_llm_answer`. """
+    async for token in get_generation_client().stream(prompt):
+        yield token
+
+
+async def generate_answers_async(prompts: list[str], client: GenerationClient = None) -> list:
+    """
+    Fan-out: answer all the prompts concurrently, within the client's concurrency and rate limits. Return the answer
+    of each prompt, in order, or the GenerationError which prevented it (one failure doesn't fail the batch).
+    """
+    client = client or get_generation_client()
+    return await asyncio.gather(*(client.complete(prompt) for prompt in prompts), return_exceptions=True)
+
+
+def answer_questions(questions: list[str], context_chunks: list[list[dict]],
+                     max_concurrency: int = LLM_MAX_CONCURRENT_REQUESTS) -> list:
+    """
+    Blocking entry point for batch jobs (e.g. reports over hundreds of questions): build the prompt of every question
+    from its retrieved chunks (see `retrieve_relevant_chunks_batch`) and answer them all concurrently, so the batch
+    takes about one LLM latency per `max_concurrency` questions. Return the answers, or GenerationErrors, in order
+    (None for the questions without relevant chunks).
+    """
+    answerable = [i for i, chunks in enumerate(context_chunks) if len(chunks) > 0]
+    prompts = [build_prompt(questions[i], context_chunks[i]) for i in answerable]
+
+    async def generate() -> list:
+        client = GenerationClient(max_concurrency=max_concurrency)
+        try:
+            return await generate_answers_async(prompts, client)
+        finally:
+            await client.close()
+
+    answers = [None] * len(questions)
+    for i, answer in zip(answerable, asyncio.run(generate())):
+        answers[i] = answer
+    return answers
+
+
+def record_token_usage(usage):
+    """ Add the prompt and completion token counts reported by the API (if any) to the current trace. """
+    if usage is not None:
+        add_count("prompt_tokens", usage.prompt_tokens)
+        add_count("completion_tokens", usage.completion_tokens)
+
+
+def get_retry_after(error: APIStatusError) -> float | None:
+    """ The delay (in seconds) the provider asked for in the Retry-After(-Ms) header of an error response, if any. """
+    headers = error.response.headers
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                return max(parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def to_generation_error(error: Exception) -> GenerationError:
+    """ Log an error raised while calling the OpenAI API and convert it to a GenerationError. """
+    if isinstance(error, GenerationError):
+        return error
+    record_error("llm", error)
+
+    if isinstance(error, APIStatusError):
+        status_code = error.status_code
+        if status_code in (401, 403):
+            kind = "authentication"
+        elif status_code == 429:
+            kind = "rate_limit"
+        elif status_code in (408, 409) or status_code >= 500:
+            kind = "server"
+        else:
+            kind = "bad_request"
+        print(f"Error calling OpenAI API ({status_code}): {error}")
+        return GenerationError(kind, str(error), status_code=status_code, retry_after=get_retry_after(error))
+    if isinstance(error, APITimeoutError):
+        kind = "timeout"
+    elif isinstance(error, APIConnectionError):
+        kind = "connection"
+    elif isinstance(error, OpenAIError):
+        # Raised by the client itself, e.g. when no API key is set
+        print(f"Error while initializing OpenAI API: {error}")
+        return GenerationError("authentication", str(error))
+    else:
+        kind = "unknown"
+    print(f"Error calling OpenAI API: {error}")
+    return GenerationError(kind, str(error))
+
+
+def get_llm_answer(prompt):
+    """
+    Send the prompt to the OpenAI API and get the answer. Raises a GenerationError if no answer could be generated.
+    """
+    return request_llm_answer(prompt)
@@ -0,0 +1,34 @@
+import os
+import gzip
+import hashlib
+
+from constants import *
+
+
+def get_archive_path(html_hash: str) -> str:
+    """ Path of an archived page: sharded by the first two hex digits of its hash to keep the directories small. """
+    return os.path.join(HTML_ARCHIVE_DIR, html_hash[:2], f"{html_hash}.html.gz")
+
+
+def archive_html(html: str) -> str:
+    """
+    Store the HTML of a page in the compressed, content-addressed archive and return its SHA-256 hash.
+    A page which did not change is stored only once.
+    """
+    data = html.encode('utf-8')
+    html_hash = hashlib.sha256(data).hexdigest()
+    path = get_archive_path(html_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique temporary name, the pages are archived by several processes at once
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as fp:
+            fp.write(gzip.compress(data, compresslevel=HTML_ARCHIVE_COMPRESSION_LEVEL, mtime=0))
+        os.replace(tmp_path, path)
+    return html_hash
+
+
+def read_archived_html(html_hash: str) -> str:
+    """ Return the HTML of an archived page. Raises FileNotFoundError if it is not in the archive. """
+    with open(get_archive_path(html_hash), 'rb') as fp:
+        return gzip.decompress(fp.read()).decode('utf-8')
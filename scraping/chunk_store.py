@@ -0,0 +1,112 @@
+import os
+import glob
+import json
+import sqlite3
+
+from constants import *
+
+
+class ChunkStore:
+    """
+    All the scraped press releases in one SQLite file: one row per article with its metadata and its chunks (a compact
+    JSON array). Articles are read by link or streamed in scraping order, without loading the corpus in memory.
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_PATH):
+        self.path = path
+        # The ingestion reads the store on a pipeline thread, but a store is only ever used by one thread at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the ingestion read while the scraper writes
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS articles (
+                    link TEXT PRIMARY KEY,
+                    title TEXT,
+                    date TEXT,
+                    author TEXT,
+                    content TEXT NOT NULL
+                );
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM articles;").fetchone()[0]
+
+    def __contains__(self, link: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM articles WHERE link = ?;", (link,)).fetchone() is not None
+
+    @staticmethod
+    def _to_article(row: tuple) -> dict:
+        """ The article in the shape returned by the scraper's `parse_article`. """
+        link, title, date, author, content = row
+        return {"title": title, "date": date, "author": author, "link": link, "content": json.loads(content)}
+
+    @staticmethod
+    def _to_row(article: dict) -> tuple:
+        return (article["link"], article["title"], article["date"], article["author"],
+                json.dumps(article["content"], separators=(',', ':')))
+
+    def get_article(self, link: str) -> dict | None:
+        row = self.conn.execute("SELECT link, title, date, author, content FROM articles WHERE link = ?;",
+                                (link,)).fetchone()
+        return None if row is None else self._to_article(row)
+
+    def put_articles(self, articles: list[dict]):
+        """ Insert or update the articles, in one transaction. An updated article keeps its place in the store's order. """
+        with self.conn:
+            # INSERT OR REPLACE would delete the row and append it again with a new rowid
+            self.conn.executemany("INSERT INTO articles (link, title, date, author, content) VALUES (?, ?, ?, ?, ?) "
+                                  "ON CONFLICT (link) DO UPDATE SET title = excluded.title, date = excluded.date, "
+                                  "author = excluded.author, content = excluded.content;",
+                                  [self._to_row(article) for article in articles])
+
+    def put_article(self, article: dict):
+        self.put_articles([article])
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM articles;")
+
+    def links(self) -> list[str]:
+        return [row[0] for row in self.conn.execute("SELECT link FROM articles ORDER BY rowid;")]
+
+    def iter_articles(self):
+        """ Stream the articles in the order they were first stored. """
+        cursor = self.conn.execute("SELECT link, title, date, author, content FROM articles ORDER BY rowid;")
+        for row in cursor:
+            yield self._to_article(row)
+
+    def iter_chunks(self):
+        """ Stream the chunks of every article, as (link, chunk) pairs. """
+        for article in self.iter_articles():
+            for chunk in article["content"]:
+                yield article["link"], chunk
+
+
+def import_json_directory(store: ChunkStore, json_dir: str) -> int:
+    """ Copy the press release JSON files written by earlier versions of the scraper into the store. """
+    articles = []
+    for filepath in sorted(glob.glob(os.path.join(json_dir, "*.json"))):
+        with open(filepath) as fp:
+            articles.append(json.load(fp))
+    store.put_articles(articles)
+    return len(articles)
+
+
+def open_chunk_store(path: str = CHUNK_STORE_PATH, json_dir: str = PRESS_RELEASES_DIR) -> ChunkStore:
+    """ Open the chunk store. When it is created, the articles of the JSON directory (if any) are imported into it. """
+    created = not os.path.exists(path)
+    store = ChunkStore(path)
+    if created and json_dir is not None and len(glob.glob(os.path.join(json_dir, "*.json"))) > 0:
+        count = import_json_directory(store, json_dir)
+        print(f"Converted {count} press release JSON files from '{json_dir}' into '{path}'.")
+    return store
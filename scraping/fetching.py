@@ -0,0 +1,119 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import *
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Return the shared HTTP session. It keeps the connections alive between requests (one pool per host, sized for the
+    scraping concurrency). The retries are done by `fetch`, so that they go through the per-host rate limit too.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=SCRAPING_CONCURRENCY, pool_maxsize=SCRAPING_CONCURRENCY)
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+class HostRateLimiter:
+    """ Space out the requests sent to the same host so that we never exceed `rate` requests per second. """
+
+    def __init__(self, rate: float = SCRAPING_RATE_LIMIT_PER_HOST):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_slot = {}  # host -> earliest time the next request may be sent
+        self._lock = threading.Lock()
+
+    def wait(self, url: str):
+        """ Block until a request to the host of the URL may be sent. """
+        if not self.interval:
+            return
+
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, url: str, seconds: float):
+        """ Send no request to the host of the URL for `seconds` (e.g. when it answered with a Retry-After). """
+        host = urlsplit(url).netloc
+        with self._lock:
+            resume = time.monotonic() + seconds
+            self._next_slot[host] = max(self._next_slot.get(host, resume), resume)
+
+
+_rate_limiter = HostRateLimiter()
+
+
+def get_retry_delay(response: requests.Response | None, attempt: int) -> float:
+    """ Seconds to wait before retrying: the Retry-After of the response if it has one, else exponential backoff. """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return SCRAPING_BACKOFF_FACTOR * 2 ** attempt
+
+
+def fetch(url: str, params: dict = None, headers: dict = None) -> requests.Response:
+    """
+    GET a URL through the shared session, respecting the per-host rate limit. Connection errors, timeouts, 429 and 5xx
+    responses are retried up to SCRAPING_MAX_RETRIES times; every attempt waits for its rate limit slot, and a
+    Retry-After pauses all the requests to the host. Raises on HTTP errors.
+    """
+    for attempt in range(SCRAPING_MAX_RETRIES + 1):
+        _rate_limiter.wait(url)
+        try:
+            response = get_session().get(url, params=params, headers=headers,
+                                         timeout=(SCRAPING_CONNECT_TIMEOUT, SCRAPING_READ_TIMEOUT))
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == SCRAPING_MAX_RETRIES:
+                raise
+            time.sleep(get_retry_delay(None, attempt))
+            continue
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < SCRAPING_MAX_RETRIES:
+            delay = get_retry_delay(response, attempt)
+            response.close()
+            if "Retry-After" in response.headers:
+                _rate_limiter.pause(url, delay)
+            else:
+                time.sleep(delay)
+            continue
+
+        response.raise_for_status()
+        return response
+
+
+def fetch_all(fetch_fn, items: list, concurrency: int = SCRAPING_CONCURRENCY):
+    """
+    Apply `fetch_fn` to every item on a pool of `concurrency` threads, so that the network waits overlap.
+    The results are yielded in the order of `items` as soon as they are available.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from executor.map(fetch_fn, items)
@@ -0,0 +1,121 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup
+
+from constants import *
+from scraping.fetching import fetch
+from scraping.scraping import parse_article, parse_article_html, get_html_parser, scrape_article_urls
+from benchmarks.stats import summarize_latencies, time_calls
+
+
+# Saved press release pages (HTML) with the output of the reference parse path (JSON), also used by the tests
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "fixtures", "press_releases")
+
+
+def parse_article_reference(html: str, article_url: str) -> dict:
+    """ The original parse path: the whole page with the pure-Python parser. Produces the golden outputs. """
+    return parse_article(BeautifulSoup(html, 'html.parser'), article_url)
+
+
+def save_golden_output(html: str, article_url: str, json_path: str):
+    with open(json_path, 'w') as fp:
+        json.dump(parse_article_reference(html, article_url), fp, indent=4)
+
+
+def save_fixtures(article_urls: list[str], fixtures_dir: str):
+    """ Save the raw HTML of the articles, and the output of the reference parse path as their golden output. """
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for article_url in article_urls:
+        html = fetch(article_url).text
+        name = f"press_release_{hashlib.sha1(article_url.encode('utf-8')).hexdigest()[:16]}"
+        with open(os.path.join(fixtures_dir, f"{name}.html"), 'w', encoding='utf-8') as fp:
+            fp.write(html)
+        save_golden_output(html, article_url, os.path.join(fixtures_dir, f"{name}.json"))
+    print(f"Saved {len(article_urls)} fixtures to '{fixtures_dir}'.")
+
+
+def update_golden_outputs(fixtures_dir: str):
+    """ Regenerate the golden outputs of the saved fixtures, after an intended change of the chunking rules. """
+    fixtures = load_fixtures(fixtures_dir)
+    for html_path, (html, golden) in zip(sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))), fixtures):
+        save_golden_output(html, golden["link"], f"{os.path.splitext(html_path)[0]}.json")
+    print(f"Updated the golden outputs of {len(fixtures)} fixtures in '{fixtures_dir}'.")
+
+
+def load_fixtures(fixtures_dir: str) -> list[tuple[str, dict]]:
+    """ Return the (HTML, golden article dict) pairs of the saved fixtures. """
+    fixtures = []
+    for html_path in sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))):
+        with open(html_path, encoding='utf-8') as fp:
+            html = fp.read()
+        with open(f"{os.path.splitext(html_path)[0]}.json") as fp:
+            fixtures.append((html, json.load(fp)))
+    return fixtures
+
+
+def check_fixtures(fixtures: list[tuple[str, dict]], parser: str) -> list[str]:
+    """ Parse every fixture with the fast path and return the links of those whose output differs from the golden one. """
+    return [golden["link"] for html, golden in fixtures if parse_article_html(html, golden["link"], parser) != golden]
+
+
+def benchmark_parsers(fixtures: list[tuple[str, dict]], parsers: list[str]) -> dict:
+    """ Time the parse and chunking of one article with the reference path and the fast path of each parser. """
+    arguments = [(html, golden["link"]) for html, golden in fixtures]
+    results = {}
+    latencies, _ = time_calls(lambda argument: parse_article_reference(*argument), arguments)
+    results["reference (html.parser, whole page)"] = summarize_latencies(latencies)
+    for parser in parsers:
+        latencies, _ = time_calls(lambda argument: parse_article_html(*argument, parser), arguments)
+        results[f"{parser}, strained"] = summarize_latencies(latencies)
+
+    # The process pool, as used by the scraper (the worker start-up is not timed)
+    with ProcessPoolExecutor(max_workers=SCRAPING_PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+        list(executor.map(parse_article_html, *zip(*arguments[:1])))
+        start = time.perf_counter()
+        list(executor.map(parse_article_html, *zip(*arguments), chunksize=4))
+        results[f"{get_html_parser()}, strained, process pool"] = summarize_latencies(
+            [], items=len(arguments), total_seconds=time.perf_counter() - start)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the fast article parse path against golden outputs and time it.")
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    parser.add_argument("--save", type=int, default=0, metavar="N",
+                        help="First download the N latest press releases as fixtures (overwrites their golden outputs).")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="First regenerate the golden outputs of the fixtures with the reference parse path.")
+    args = parser.parse_args()
+
+    if args.save > 0:
+        save_fixtures(scrape_article_urls()[:args.save], args.fixtures_dir)
+    if args.update_golden:
+        update_golden_outputs(args.fixtures_dir)
+
+    fixtures = load_fixtures(args.fixtures_dir)
+    if len(fixtures) == 0:
+        raise SystemExit(f"No fixtures in '{args.fixtures_dir}', save some with --save N.")
+
+    parsers = ['html.parser'] + (['lxml'] if get_html_parser() == 'lxml' else [])
+    failed = False
+    for html_parser in parsers:
+        mismatches = check_fixtures(fixtures, html_parser)
+        failed = failed or (html_parser == get_html_parser() and len(mismatches) > 0)
+        print(f"{html_parser}: {len(fixtures) - len(mismatches)}/{len(fixtures)} fixtures match the golden output"
+              + "".join(f"\n  differs: {link}" for link in mismatches))
+
+    print("\nParse and chunking time per article:")
+    for name, summary in benchmark_parsers(fixtures, parsers).items():
+        latencies = f"{summary['mean_ms']} ms mean, {summary['p95_ms']} ms p95, " if summary["calls"] > 0 else ""
+        print(f"  {name}: {latencies}{summary['throughput_per_s']} articles/s")
+
+    if failed:
+        raise SystemExit(f"The '{get_html_parser()}' parse path does not reproduce the golden chunks, "
+                         f"set SCRAPING_HTML_PARSER = 'html.parser'.")
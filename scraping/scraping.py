@@ -1,51 +1,101 @@
 import os
+import math
 import time
 import json
-import shutil
-import requests
-from pathlib import Path
+import hashlib
+import argparse
+import multiprocessing
+from collections import deque
+from datetime import datetime, timezone
 from tqdm.auto import tqdm
 from tabulate import tabulate
 from unidecode import unidecode
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup, Tag
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 
 from constants import *
+from scraping.fetching import fetch, fetch_all
+from scraping.archive import archive_html, read_archived_html, get_archive_path
+from scraping.chunk_store import ChunkStore, open_chunk_store
+
+
+# An article only needs the <main> element (content, date and author) and the <title>, the rest of the page is not parsed
+ARTICLE_STRAINER = SoupStrainer(['main', 'title'])
+
+
+def get_html_parser() -> str:
+    """ Return the configured BeautifulSoup parser, or the pure-Python one if lxml is not installed. """
+    if SCRAPING_HTML_PARSER == 'lxml':
+        try:
+            import lxml  # noqa: F401
+        except ImportError:
+            return 'html.parser'
+    return SCRAPING_HTML_PARSER
 
 
 def get_soup(url: str, params: dict = None, headers: dict = None) -> BeautifulSoup:
     """ Get the HTML content of a webpage and parse it into a BeautifulSoup instance. """
-    response = requests.get(url, params=params, headers=headers)
-    response.raise_for_status()
-    return BeautifulSoup(response.text, 'html.parser')
+    response = fetch(url, params=params, headers=headers)
+    return BeautifulSoup(response.text, get_html_parser())
+
+
+def get_listing_page_urls(page: int) -> list[str]:
+    """ Retrieve the press release URLs listed on one page of the press releases feed. """
+    params = {
+        'viewtype': 'asFeedList',
+        'page_active': page,
+        '_': int(time.time() * 1000)  # Cache-busting parameter
+    }
 
+    soup = get_soup(PRESS_RELEASES_URL, params=params, headers=HEADERS)
+    article_tags_on_page = soup.find_all('a', class_='media-link', href=True)
+    return [urljoin(TELEKOM_BASE_URL, article_tag['href']) for article_tag in article_tags_on_page]
 
-def scrape_article_urls() -> list[str]:
-    """ Retrieve the list of press releases URLs that we are interested in. """
-    article_urls = set()
 
-    page = 0
+def scrape_article_urls(known_urls: set[str] = None) -> list[str]:
+    """
+    Retrieve the list of press releases URLs that we are interested in.
+    The feed lists the newest press releases first, so once a page contains URLs from `known_urls` (the articles we
+    already scraped) all the following pages only contain known articles too, and we stop paging there.
+    """
+    known_urls = known_urls or set()
+    article_urls = {}  # Used as an ordered set, newest press releases first
+
     with tqdm(total=PRESS_RELEASES_TARGET_COUNT, desc="Scraping press release article URLs") as pbar:
-        while len(article_urls) < PRESS_RELEASES_TARGET_COUNT:
-            params = {
-                'viewtype': 'asFeedList',
-                'page_active': page,
-                '_': int(time.time() * 1000)  # Cache-busting parameter
-            }
+        # The first page tells us how many articles a page holds, so that we only prefetch the pages we need
+        first_page_urls = get_listing_page_urls(0)
+        page_size = max(1, len(first_page_urls))
+        article_urls.update(dict.fromkeys(first_page_urls))
+        pbar.n = min(len(article_urls), PRESS_RELEASES_TARGET_COUNT)
+        pbar.refresh()
+
+        next_page = 1
+        last_page_reached = len(first_page_urls) == 0 or not known_urls.isdisjoint(first_page_urls)
+        while len(article_urls) < PRESS_RELEASES_TARGET_COUNT and not last_page_reached:
+            # Fetch the next batch of listing pages in parallel
+            missing_count = PRESS_RELEASES_TARGET_COUNT - len(article_urls)
+            pages_count = min(SCRAPING_CONCURRENCY, math.ceil(missing_count / page_size))
+            pages = list(range(next_page, next_page + pages_count))
+            next_page += pages_count
+
+            for page_urls in fetch_all(get_listing_page_urls, pages):
+                if len(page_urls) == 0:
+                    last_page_reached = True
+                    break
 
-            soup = get_soup(PRESS_RELEASES_URL, params=params, headers=HEADERS)
-            article_tags_on_page = soup.find_all('a', class_='media-link', href=True)
-            for article_tag in article_tags_on_page:
-                full_article_url = urljoin(TELEKOM_BASE_URL, article_tag['href'])
-                article_urls.add(full_article_url)
-                pbar.update(1)
+                article_urls.update(dict.fromkeys(page_urls))
+                pbar.n = min(len(article_urls), PRESS_RELEASES_TARGET_COUNT)
+                pbar.refresh()
 
-                if len(full_article_url) == PRESS_RELEASES_TARGET_COUNT:
+                # Stop as soon as we have enough articles, or when we reach the articles scraped by a previous run
+                if not known_urls.isdisjoint(page_urls):
+                    last_page_reached = True
+                    break
+                if len(article_urls) >= PRESS_RELEASES_TARGET_COUNT:
                     break
 
-            page += 1
-    article_urls = list(article_urls)
-    return article_urls[:PRESS_RELEASES_TARGET_COUNT]
+    return list(article_urls)[:PRESS_RELEASES_TARGET_COUNT]
 
 
 def serialize_table_to_text(table_tag: Tag) -> str:
@@ -100,58 +150,229 @@ def html_aware_chunker(html_content: Tag) -> list[str]:
     return chunks
 
 
-def clear_directory(path):
-    """ Delete all files and directories in the given directory without deleting the directory itself. """
-    for item in Path(path).iterdir():
-        if item.is_dir():
-            shutil.rmtree(item)
-        else:
-            item.unlink()
+def parse_article(soup: BeautifulSoup, article_url: str) -> dict:
+    """ Extract the content chunks and the metadata of a press release from its parsed page. """
+    main_section = soup.find('main')
 
+    # Split the content of the article according to the page structure (paragraphs, headers, tables, etc)
+    article_content = main_section.find('section')
+    article_content_chunks = html_aware_chunker(article_content)
 
-def scrape_articles_content(article_urls: list[str]):
-    """ Retrieve the content of the given list of press release URLs, parse that content into a useful format, and save it to disk. """
-    # Delete the previous articles, if any
-    os.makedirs(PRESS_RELEASES_DIR, exist_ok=True)
-    clear_directory(PRESS_RELEASES_DIR)
+    # Get the date, title, and author of the article
+    article_date = main_section.find('time').get_text(separator='\n', strip=True)
+    article_title = soup.find('title').get_text(separator='\n', strip=True)
 
-    for idx, article_url in enumerate(tqdm(article_urls, desc="Scraping the content of the articles")):
-        soup = get_soup(article_url)
-        main_section = soup.find('main')
+    # Some articles don't have authors
+    article_author_tag = main_section.find('address')
+    if article_author_tag is None:
+        article_author = None
+    else:
+        article_author = unidecode(article_author_tag.get_text(separator='\n', strip=True))
 
-        # Split the content of the article according to the page structure (paragraphs, headers, tables, etc)
-        article_content = main_section.find('section')
-        article_content_chunks = html_aware_chunker(article_content)
+    # Use just ASCII characters instead of UniCode
+    article_title = unidecode(article_title)
+    article_date = unidecode(article_date)
 
-        # Get the date, title, and author of the article
-        article_date = main_section.find('time').get_text(separator='\n', strip=True)
-        article_title = soup.find('title').get_text(separator='\n', strip=True)
+    # Concatenate all the article information in one dictionary
+    return {
+        "title": article_title,
+        "date": article_date,
+        "author": article_author,
+        "link": article_url,
+        "content": article_content_chunks
+    }
 
-        # Some articles don't have authors
-        article_author_tag = main_section.find('address')
-        if article_author_tag is None:
-            article_author = None
-        else:
-            article_author = unidecode(article_author_tag.get_text(separator='\n', strip=True))
 
-        # Use just ASCII characters instead of UniCode
-        article_title = unidecode(article_title)
-        article_date = unidecode(article_date)
+def parse_article_html(html: str, article_url: str, parser: str = None) -> dict:
+    """ Parse only the parts of an article page we need and extract its content chunks and metadata. """
+    soup = BeautifulSoup(html, parser or get_html_parser(), parse_only=ARTICLE_STRAINER)
+    return parse_article(soup, article_url)
+
+
+def parse_and_archive_article(html: str, article_url: str) -> tuple[str, dict]:
+    """ Archive the raw HTML of an article, then parse it. Return the hash of the HTML and the article dict. """
+    return archive_html(html), parse_article_html(html, article_url)
+
+
+def parse_archived_article(html_hash: str, article_url: str) -> dict:
+    """ Parse an article from the HTML archive instead of downloading it. """
+    return parse_article_html(read_archived_html(html_hash), article_url)
+
+
+def get_parse_executor() -> ProcessPoolExecutor:
+    """ The pool of processes parsing and chunking the articles. """
+    # Spawn (instead of fork) the workers, the downloads are running on threads in this process
+    return ProcessPoolExecutor(max_workers=SCRAPING_PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+def parse_articles(article_urls: list[str], responses):
+    """
+    Archive, parse and chunk the downloaded articles on a pool of processes, so that the CPU-bound parsing neither
+    blocks the downloads nor is limited to one core. Yield (URL, response, (HTML hash, article dict)) in the order of
+    `article_urls`, as soon as they are available. The last item is None for the articles which did not change (no response).
+    """
+    with get_parse_executor() as executor:
+        pending = deque()
+        for article_url, response in zip(article_urls, responses):
+            future = None if response is None else executor.submit(parse_and_archive_article, response.text, article_url)
+            pending.append((article_url, response, future))
+            while len(pending) > 0 and (pending[0][2] is None or pending[0][2].done()):
+                article_url, response, future = pending.popleft()
+                yield article_url, response, None if future is None else future.result()
+
+        for article_url, response, future in pending:
+            yield article_url, response, None if future is None else future.result()
 
-        # Concatenate all the article information in one file
-        article_dict = {
-            "title": article_title,
-            "date": article_date,
-            "author": article_author,
-            "link": article_url,
-            "content": article_content_chunks
-        }
 
-        full_file_path = os.path.join(PRESS_RELEASES_DIR, f"press_release_{idx}.json")
-        with open(full_file_path, 'w') as fp:
-            json.dump(article_dict, fp, indent=4)
+def load_manifest() -> dict:
+    """ Load the scraping manifest: article URL -> content and HTML hashes, ETag/Last-Modified and scrape time. """
+    if not os.path.exists(SCRAPING_MANIFEST_PATH):
+        return {}
+    with open(SCRAPING_MANIFEST_PATH) as fp:
+        return json.load(fp)
+
+
+def save_manifest(manifest: dict):
+    """ Atomically save the scraping manifest, so that an interrupted run never leaves a truncated file behind. """
+    tmp_path = f"{SCRAPING_MANIFEST_PATH}.tmp"
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(tmp_path, SCRAPING_MANIFEST_PATH)
+
+
+def save_article(store: ChunkStore, article_dict: dict, manifest_entry: dict = None) -> tuple[str, str]:
+    """
+    Write a parsed article to the chunk store, unless its content did not change since the manifest entry.
+    Return whether the article is "new", "changed" or "unchanged", and the hash of its content.
+    """
+    content_hash = hashlib.sha256(json.dumps(article_dict, sort_keys=True).encode('utf-8')).hexdigest()
+    if manifest_entry is not None and manifest_entry["content_hash"] == content_hash and article_dict["link"] in store:
+        return "unchanged", content_hash
+
+    store.put_article(article_dict)
+    return "new" if manifest_entry is None else "changed", content_hash
+
+
+def fetch_article(article_url: str, manifest_entry: dict = None):
+    """
+    Download an article with a conditional GET based on the validators from its manifest entry.
+    Return None if the server answers that the article did not change (304 Not Modified).
+    """
+    headers = {}
+    if manifest_entry is not None:
+        if manifest_entry.get("etag"):
+            headers['If-None-Match'] = manifest_entry["etag"]
+        if manifest_entry.get("last_modified"):
+            headers['If-Modified-Since'] = manifest_entry["last_modified"]
+
+    response = fetch(article_url, headers=headers)
+    if response.status_code == 304:
+        return None
+    return response
+
+
+def scrape_articles_content(article_urls: list[str], incremental: bool = True):
+    """
+    Retrieve the content of the given list of press release URLs, parse that content into a useful format, and save it
+    to the chunk store. In incremental mode the articles we already have are only re-downloaded if the server reports a
+    change, and only re-written if their parsed content changed. Otherwise (or without a manifest) everything is re-scraped.
+    """
+    store = open_chunk_store()
+    manifest = load_manifest() if incremental else {}
+    if len(manifest) == 0:
+        # Delete the previous articles, if any
+        store.clear()
+    # Read once here, the downloads run on other threads
+    stored_links = set(store.links())
+
+    def fetch_if_changed(article_url):
+        manifest_entry = manifest.get(article_url)
+        # If the article was deleted, or the page is not archived (e.g. it was scraped before the archive existed),
+        # download it again
+        if manifest_entry is not None and (
+                article_url not in stored_links
+                or manifest_entry.get("html_hash") is None
+                or not os.path.exists(get_archive_path(manifest_entry["html_hash"]))):
+            manifest_entry = None
+        return fetch_article(article_url, manifest_entry)
+
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+    try:
+        # The articles are downloaded concurrently on threads, parsed on processes, and saved in order as they arrive
+        responses = fetch_all(fetch_if_changed, article_urls)
+        for article_url, response, parsed in tqdm(parse_articles(article_urls, responses), total=len(article_urls),
+                                                  desc="Scraping the content of the articles"):
+            manifest_entry = manifest.get(article_url)
+            scraped_at = datetime.now(timezone.utc).isoformat()
+            if response is None:
+                counts["unchanged"] += 1
+                manifest_entry["scraped_at"] = scraped_at
+                continue
+
+            html_hash, article_dict = parsed
+            status, content_hash = save_article(store, article_dict, manifest_entry)
+            counts[status] += 1
+
+            manifest[article_url] = {
+                "content_hash": content_hash,
+                "html_hash": html_hash,
+                "etag": response.headers.get('ETag'),
+                "last_modified": response.headers.get('Last-Modified'),
+                "scraped_at": scraped_at,
+            }
+    finally:
+        # Keep the progress of a partial run
+        save_manifest(manifest)
+        store.close()
+
+    print(f"Scraped {counts['new']} new, {counts['changed']} changed and {counts['unchanged']} unchanged articles.")
+
+
+def rechunk_from_archive():
+    """
+    Rebuild the articles from the HTML archive, without any network access: e.g. after a change of the chunking rules.
+    The articles are parsed in parallel and only the ones whose content changed are re-written.
+    """
+    store = open_chunk_store()
+    manifest = load_manifest()
+    article_urls = [url for url, entry in manifest.items()
+                    if entry.get("html_hash") is not None and os.path.exists(get_archive_path(entry["html_hash"]))]
+    if len(article_urls) < len(manifest):
+        print(f"{len(manifest) - len(article_urls)} articles are not archived, the next scraping run downloads them again.")
+
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+    html_hashes = [manifest[url]["html_hash"] for url in article_urls]
+    try:
+        with get_parse_executor() as executor:
+            article_dicts = executor.map(parse_archived_article, html_hashes, article_urls, chunksize=16)
+            for article_url, article_dict in tqdm(zip(article_urls, article_dicts), total=len(article_urls),
+                                                  desc="Re-chunking the archived articles"):
+                status, manifest[article_url]["content_hash"] = save_article(store, article_dict, manifest[article_url])
+                counts[status] += 1
+    finally:
+        save_manifest(manifest)
+        store.close()
+
+    print(f"Re-chunked {len(article_urls)} articles: {counts['changed']} changed "
+          f"and {counts['unchanged']} unchanged.")
 
 
 if __name__ == "__main__":
-    articles_urls = scrape_article_urls()
-    scrape_articles_content(articles_urls)
+    parser = argparse.ArgumentParser(description="Scrape Deutsche Telekom's press releases.")
+    parser.add_argument("--full", action="store_true",
+                        help="Re-download every article instead of only the new and changed ones.")
+    parser.add_argument("--revalidate", action="store_true",
+                        help="Also check every known article for changes (with cheap conditional requests).")
+    parser.add_argument("--rechunk", action="store_true",
+                        help="Rebuild the articles from the archived HTML instead of scraping (no network access).")
+    args = parser.parse_args()
+
+    if args.rechunk:
+        rechunk_from_archive()
+    else:
+        known_article_urls = set() if args.full else set(load_manifest())
+        articles_urls = scrape_article_urls(known_urls=known_article_urls)
+        if args.revalidate:
+            listed_urls = set(articles_urls)
+            articles_urls += [url for url in known_article_urls if url not in listed_urls]
+        scrape_articles_content(articles_urls, incremental=not args.full)
@@ -0,0 +1,339 @@
+import json
+import asyncio
+import argparse
+from datetime import date
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from constants import *
+from database import pool_stats
+from database.retrieve import retrieve_relevant_chunks
+from database.retrievers import FILTER_CONDITIONS, without_embeddings
+from generation.generation import build_prompt, GenerationError
+from caching.caching import encode_queries, get_answer_async, stream_answer_async, get_answer_cache_key, \
+    normalize_question, cache_stats
+from tracing.tracing import start_trace, span
+from embeddings.embeddings import BackgroundEmbeddingModel
+
+
+NO_RELEVANT_CHUNKS_MESSAGE = "No relevant information found in the press releases for your query."
+
+
+class MicroBatchEncoder:
+    """
+    Embed the questions of concurrent requests together: the first question waits up to `max_wait_ms` for others to
+    join its batch, then the whole batch is encoded with one `encode` call on a worker thread. While a batch is being
+    encoded, the next one fills up, so under load the batches grow on their own.
+    """
+
+    def __init__(self, model, batch_size: int = SERVICE_ENCODE_BATCH_SIZE,
+                 max_wait_ms: float = SERVICE_ENCODE_BATCH_WAIT_MS):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = None
+        self._worker = None
+
+    def start(self):
+        """ Start the batching task (the queue has to be created on the running event loop). """
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+    async def encode(self, text: str):
+        """ Return the embedding of the text, once its micro-batch has been encoded. """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _next_batch(self) -> list[tuple]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                # Goes through the query embedding LRU, so only the new questions reach the model
+                embeddings = await asyncio.to_thread(encode_queries, self.model, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                # A request may have been cancelled (client gone) while waiting
+                if not future.done():
+                    future.set_result(embedding)
+
+
+class InFlightRequests:
+    """ Deduplicate identical concurrent requests: the first one does the work, the others await its result. """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def run(self, key, coroutine_function, *args):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_function(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done_task: self._tasks.pop(key) if self._tasks.get(key) is done_task else None)
+        # A waiter which is cancelled (client gone) must not cancel the work the other waiters share
+        return await asyncio.shield(task)
+
+
+class SharedStream:
+    """
+    Generate a streamed answer once and replay it to every request asking the same question while it is generated.
+    A request joining late first gets the tokens produced so far. If the generation fails, every request gets the error
+    after the tokens produced before it.
+    """
+
+    def __init__(self, tokens: AsyncIterator[str], on_done):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+        self._task = asyncio.ensure_future(self._consume(tokens, on_done))
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _consume(self, tokens: AsyncIterator[str], on_done):
+        try:
+            async for token in tokens:
+                self.tokens.append(token)
+                self._notify()
+        except Exception as e:
+            # Any failure (LLM, answer cache, ...) is passed on to every reader instead of silently cutting the stream
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            on_done()
+
+    async def __aiter__(self):
+        position = 0
+        while True:
+            changed = self._changed
+            while position < len(self.tokens):
+                yield self.tokens[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class QueryService:
+    """
+    Headless asyncio HTTP API over the retrieval and generation pipeline. The blocking encode and DB calls run on
+    worker threads, the LLM is called with the asyncio OpenAI client, so one process serves many concurrent users.
+    """
+
+    def __init__(self, model):
+        self.encoder = MicroBatchEncoder(model)
+        self.in_flight = InFlightRequests()
+        self.streams = {}
+
+    @staticmethod
+    def parse_filters(filters) -> dict:
+        """ Validate the retrieval filters: ISO dates for the publish date range, strings for the others. """
+        if not isinstance(filters, dict) or len(set(filters) - set(FILTER_CONDITIONS)) > 0:
+            raise web.HTTPBadRequest(text=f"'filters' may only contain: {', '.join(FILTER_CONDITIONS)}.")
+        parsed_filters = {}
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name in ("date_from", "date_to"):
+                try:
+                    parsed_filters[name] = date.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise web.HTTPBadRequest(text=f"'{name}' must be a date in the YYYY-MM-DD format.")
+            elif isinstance(value, str):
+                parsed_filters[name] = value
+            else:
+                raise web.HTTPBadRequest(text=f"'{name}' must be a string.")
+        return parsed_filters
+
+    @classmethod
+    async def parse_request(cls, request: web.Request) -> dict:
+        """ Validate the JSON body: the question and the optional retrieval parameters. """
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="The request body must be JSON.")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="The request body must be a JSON object.")
+        question = body.get("question")
+        if not isinstance(question, str) or len(question.strip()) == 0:
+            raise web.HTTPBadRequest(text="A non-empty 'question' is required.")
+        filters = cls.parse_filters(body.get("filters") or {})
+        # The full-text search needs Postgres, the local backend only supports the vector search
+        modes = ("vector", "hybrid") if RETRIEVAL_BACKEND == "pgvector" else ("vector",)
+        mode = body.get("mode", RETRIEVAL_MODE if RETRIEVAL_MODE in modes else "vector")
+        if mode not in modes:
+            raise web.HTTPBadRequest(text=f"'mode' must be {' or '.join(repr(mode) for mode in modes)}.")
+        top_k = body.get("top_k", TOP_K)
+        # int() would silently truncate 2.9, accept "5" and turn true into 1
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or not 1 <= top_k <= SERVICE_MAX_TOP_K:
+            raise web.HTTPBadRequest(text=f"'top_k' must be an integer between 1 and {SERVICE_MAX_TOP_K}.")
+        try:
+            similarity_threshold = float(body.get("similarity_threshold", SIMILARITY_THRESHOLD))
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="'similarity_threshold' must be a number.")
+        if not -1.0 <= similarity_threshold <= 1.0:
+            raise web.HTTPBadRequest(text="'similarity_threshold' must be between -1 and 1.")
+        return {
+            "question": question,
+            "top_k": top_k,
+            "similarity_threshold": similarity_threshold,
+            "mode": mode,
+            "filters": filters,
+        }
+
+    async def _retrieve(self, params: dict) -> list[dict]:
+        with span("embed_query"):
+            query_embedding = await self.encoder.encode(params["question"])
+        return await asyncio.to_thread(retrieve_relevant_chunks, params["question"], None, params["top_k"],
+                                       params["similarity_threshold"], mode=params["mode"], filters=params["filters"],
+                                       query_embedding=query_embedding)
+
+    async def retrieve_chunks(self, params: dict) -> list[dict]:
+        """ Retrieve the relevant chunks, sharing the work with identical in-flight requests. """
+        key = ("retrieve", normalize_question(params["question"]), params["top_k"], params["similarity_threshold"],
+               params["mode"], json.dumps(params["filters"], sort_keys=True, default=str))
+        return await self.in_flight.run(key, self._retrieve, params)
+
+    async def handle_retrieve(self, request: web.Request) -> web.Response:
+        params = await self.parse_request(request)
+        with start_trace("retrieve"):
+            relevant_chunks = await self.retrieve_chunks(params)
+        return web.json_response({"chunks": without_embeddings(relevant_chunks)})
+
+    async def handle_answer(self, request: web.Request) -> web.Response:
+        params = await self.parse_request(request)
+        with start_trace("question"):
+            relevant_chunks = await self.retrieve_chunks(params)
+            if len(relevant_chunks) == 0:
+                return web.json_response({"answer": None, "message": NO_RELEVANT_CHUNKS_MESSAGE, "chunks": []})
+
+            with span("build_prompt"):
+                prompt = build_prompt(params["question"], relevant_chunks)
+            chunk_ids = [chunk["id"] for chunk in relevant_chunks]
+            try:
+                answer = await self.in_flight.run(("answer", get_answer_cache_key(params["question"], chunk_ids)),
+                                                  get_answer_async, params["question"], chunk_ids, prompt)
+            except GenerationError as e:
+                # 503 when trying again later may work, 502 otherwise
+                return web.json_response({"answer": None, "error": e.to_dict(),
+                                          "chunks": without_embeddings(relevant_chunks)},
+                                         status=503 if e.retryable else 502)
+        return web.json_response({"answer": answer, "chunks": without_embeddings(relevant_chunks)})
+
+    async def handle_stream_answer(self, request: web.Request) -> web.StreamResponse:
+        params = await self.parse_request(request)
+        with start_trace("question"):
+            relevant_chunks = await self.retrieve_chunks(params)
+            response = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+            await response.prepare(request)
+            if len(relevant_chunks) == 0:
+                await response.write(NO_RELEVANT_CHUNKS_MESSAGE.encode("utf-8"))
+                await response.write_eof()
+                return response
+
+            with span("build_prompt"):
+                prompt = build_prompt(params["question"], relevant_chunks)
+            chunk_ids = [chunk["id"] for chunk in relevant_chunks]
+            cache_key = get_answer_cache_key(params["question"], chunk_ids)
+            stream = self.streams.get(cache_key)
+            if stream is None:
+                stream = SharedStream(stream_answer_async(params["question"], chunk_ids, prompt),
+                                      on_done=lambda: self.streams.pop(cache_key, None))
+                self.streams[cache_key] = stream
+
+            with span("answer"):
+                answered = False
+                try:
+                    async for token in stream:
+                        await response.write(token.encode("utf-8"))
+                        answered = True
+                except ConnectionResetError:
+                    # The client left, the shared stream still completes (and is cached) for the others
+                    return response
+                except Exception as e:
+                    if not isinstance(e, GenerationError):
+                        print(f"Error while streaming the answer: {e!r}")
+                        e = GenerationError("unknown", str(e))
+                    # The status was already sent, the error is the end of the text
+                    await response.write((("\n\n" if answered else "") + e.user_message).encode("utf-8"))
+            await response.write_eof()
+        return response
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        health = {"status": "ok", "in_flight": len(self.in_flight), "streams": len(self.streams), "caches": cache_stats()}
+        if isinstance(self.encoder.model, BackgroundEmbeddingModel):
+            health["model_ready"] = self.encoder.model.is_ready()
+        if RETRIEVAL_BACKEND == "pgvector":
+            # The first call opens the pool's connections, which must not block the event loop
+            health["db_pool"] = await asyncio.to_thread(pool_stats)
+        return web.json_response(health)
+
+    async def on_startup(self, app: web.Application):
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SERVICE_WORKER_THREADS))
+        self.encoder.start()
+
+    async def on_cleanup(self, app: web.Application):
+        await self.encoder.stop()
+
+
+def create_app(model) -> web.Application:
+    service = QueryService(model)
+    app = web.Application()
+    app.add_routes([
+        web.post("/retrieve", service.handle_retrieve),
+        web.post("/answer", service.handle_answer),
+        web.post("/answer/stream", service.handle_stream_answer),
+        web.get("/health", service.handle_health),
+    ])
+    app.on_startup.append(service.on_startup)
+    app.on_cleanup.append(service.on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the press release Q&A over HTTP.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    args = parser.parse_args()
+
+    # Start listening right away, the questions wait for the model if it is still loading
+    embedding_model = BackgroundEmbeddingModel()
+    web.run_app(create_app(embedding_model), host=args.host, port=args.port)
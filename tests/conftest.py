@@ -0,0 +1,71 @@
+import time
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from scraping import fetching
+
+
+class StubServer:
+    """
+    A local HTTP server answering GET requests with `respond(path, query, attempt)`, which returns
+    (status, headers, body). Every request is logged as (monotonic time, path, query).
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.respond = lambda path, query, attempt: (404, {}, "")
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                with stub._lock:
+                    attempt = sum(1 for _, path, _ in stub.requests if path == url.path)
+                    stub.requests.append((time.monotonic(), url.path, query))
+                status, headers, body = stub.respond(url.path, query, attempt)
+                data = body.encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def request_times(self, path: str) -> list[float]:
+        return [request_time for request_time, request_path, _ in self.requests if request_path == path]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def rate_limiter(monkeypatch):
+    """ A fresh per-host rate limiter for `fetch` (10 requests/s), and no backoff sleeps between the retries. """
+    limiter = fetching.HostRateLimiter(rate=10.0)
+    monkeypatch.setattr(fetching, "_rate_limiter", limiter)
+    monkeypatch.setattr(fetching, "SCRAPING_BACKOFF_FACTOR", 0.0)
+    return limiter
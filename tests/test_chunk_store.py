@@ -0,0 +1,20 @@
+import os
+
+from scraping.chunk_store import ChunkStore
+
+
+def make_article(number: int, title: str = None) -> dict:
+    return {"title": title or f"Article {number}", "date": "01-15-2025", "author": "Press office",
+            "link": f"https://example.com/press-release-{number}", "content": [f"Chunk of article {number}."]}
+
+
+def test_updated_article_keeps_its_place(tmp_path):
+    with ChunkStore(os.path.join(tmp_path, "chunks.sqlite")) as store:
+        store.put_articles([make_article(number) for number in range(3)])
+        store.put_article(make_article(0, title="Updated title"))
+
+        articles = list(store.iter_articles())
+        assert [article["link"] for article in articles] == [make_article(number)["link"] for number in range(3)]
+        assert articles[0]["title"] == "Updated title"
+        assert store.links() == [article["link"] for article in articles]
+        assert len(store) == 3
@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+
+from embeddings.cache import EmbeddingCache
+
+
+def test_cache_hit_returns_stored_vector(tmp_path):
+    cache = EmbeddingCache("test-model", directory=str(tmp_path), max_mb=1, dimension=4)
+    calls = []
+    encode = lambda texts: calls.append(list(texts)) or np.array([[len(text), 0, 0, 1] for text in texts], dtype=np.float32)
+
+    cache.encode(["first text", "second text"], encode)
+    embeddings = cache.encode(["second  text", "first text"], encode)
+
+    np.testing.assert_array_equal(embeddings, [[11, 0, 0, 1], [10, 0, 0, 1]])
+    assert calls == [["first text", "second text"]]
+    cache.close()
+
+
+class PausedVectors:
+    """ The writer's vector file: a write stores the first half of the vectors, then waits for `resume` to finish. """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.half_written = threading.Event()
+        self.resume = threading.Event()
+
+    def __setitem__(self, slots, embeddings):
+        half = embeddings.shape[1] // 2
+        self.vectors[slots, :half] = embeddings[:, :half]
+        self.half_written.set()
+        self.resume.wait(timeout=5)
+        self.vectors[slots, half:] = embeddings[:, half:]
+
+    def flush(self):
+        self.vectors.flush()
+
+
+class InterleavedVectors:
+    """ The reader's vector file: once the reader has copied a slot, the paused writer finishes before `get` goes on. """
+
+    def __init__(self, vectors, writer_vectors: PausedVectors, writer_thread: threading.Thread):
+        self.vectors = vectors
+        self.writer_vectors = writer_vectors
+        self.writer_thread = writer_thread
+
+    def __getitem__(self, slot):
+        embedding = np.array(self.vectors[slot])
+        self.writer_vectors.resume.set()
+        self.writer_thread.join()
+        return embedding
+
+
+def test_reader_never_sees_a_half_written_vector(tmp_path):
+    """ A reader copies the slot while another process (here a thread with its own cache) is filling it. """
+    writer = EmbeddingCache("test-model", directory=str(tmp_path), max_mb=1, dimension=8)
+    reader = EmbeddingCache("test-model", directory=str(tmp_path), max_mb=1, dimension=8)
+    old_key, new_key = writer.get_key("old text"), writer.get_key("new text")
+    writer.put([old_key], np.full((1, 8), 1, dtype=np.float32))
+    # Take the only slot of the old text, so that the new text's vector is written over it
+    writer.conn.execute("UPDATE info SET value = ? WHERE name = 'next_slot';", (writer.max_slots,))
+
+    writer.vectors = PausedVectors(writer.vectors)
+    thread = threading.Thread(target=writer.put, args=([new_key], np.full((1, 8), 2, dtype=np.float32)))
+    thread.start()
+    assert writer.vectors.half_written.wait(timeout=5)
+    reader.vectors = InterleavedVectors(reader.vectors, writer.vectors, thread)
+
+    embeddings = reader.get([old_key, new_key])
+
+    writer.vectors.resume.set()
+    thread.join()
+    for key, value in ((old_key, 1), (new_key, 2)):
+        assert key not in embeddings or np.all(embeddings[key] == value), "a half-written vector was returned"
+    # Once written, the new vector is found
+    reader.vectors = reader.vectors.vectors
+    np.testing.assert_array_equal(reader.get([new_key])[new_key], np.full(8, 2))
+    reader.close()
+    writer.close()
@@ -0,0 +1,97 @@
+import time
+import threading
+
+import pytest
+import requests
+
+from scraping import fetching
+from scraping.fetching import fetch, fetch_all
+
+
+def test_fetch_retries_server_errors(stub_server, rate_limiter):
+    stub_server.respond = lambda path, query, attempt: (503, {}, "") if attempt < 2 else (200, {}, "ok")
+
+    assert fetch(f"{stub_server.url}/flaky").text == "ok"
+    assert len(stub_server.request_times("/flaky")) == 3
+
+
+def test_fetch_gives_up_after_max_retries(stub_server, rate_limiter, monkeypatch):
+    monkeypatch.setattr(fetching, "SCRAPING_MAX_RETRIES", 2)
+    stub_server.respond = lambda path, query, attempt: (500, {}, "")
+
+    with pytest.raises(requests.HTTPError):
+        fetch(f"{stub_server.url}/down")
+    assert len(stub_server.request_times("/down")) == 3
+
+
+def test_fetch_does_not_retry_client_errors(stub_server, rate_limiter):
+    with pytest.raises(requests.HTTPError):
+        fetch(f"{stub_server.url}/missing")
+    assert len(stub_server.request_times("/missing")) == 1
+
+
+def test_fetch_backs_off_exponentially(stub_server, rate_limiter, monkeypatch):
+    monkeypatch.setattr(fetching, "SCRAPING_BACKOFF_FACTOR", 0.2)
+    stub_server.respond = lambda path, query, attempt: (502, {}, "") if attempt < 2 else (200, {}, "ok")
+
+    fetch(f"{stub_server.url}/flaky")
+    first, second, third = stub_server.request_times("/flaky")
+    assert second - first >= 0.2
+    assert third - second >= 0.4
+
+
+def test_fetch_honours_retry_after(stub_server, rate_limiter):
+    stub_server.respond = lambda path, query, attempt: \
+        (429, {"Retry-After": "1"}, "") if attempt == 0 else (200, {}, "ok")
+
+    fetch(f"{stub_server.url}/throttled")
+    first, second = stub_server.request_times("/throttled")
+    assert second - first >= 0.95
+
+
+def test_retry_after_pauses_the_whole_host(stub_server, rate_limiter):
+    stub_server.respond = lambda path, query, attempt: \
+        (429, {"Retry-After": "1"}, "") if path == "/throttled" and attempt == 0 else (200, {}, "ok")
+
+    throttled = threading.Thread(target=fetch, args=(f"{stub_server.url}/throttled",))
+    throttled.start()
+    time.sleep(0.3)
+    fetch(f"{stub_server.url}/other")
+    throttled.join()
+
+    # The request sent to the host while it asked us to wait was held back too
+    assert stub_server.request_times("/other")[0] - stub_server.request_times("/throttled")[0] >= 0.95
+
+
+def test_rate_limit_per_host(stub_server, rate_limiter):
+    stub_server.respond = lambda path, query, attempt: (200, {}, path)
+
+    urls = [f"{stub_server.url}/page-{i}" for i in range(8)]
+    list(fetch_all(fetch, urls, concurrency=8))
+    request_times = sorted(request_time for request_time, _, _ in stub_server.requests)
+    assert all(later - earlier >= 0.09 for earlier, later in zip(request_times, request_times[1:]))
+
+
+def test_retries_respect_the_rate_limit(stub_server, rate_limiter):
+    # No backoff: without the rate limit, the retries of the 4 URLs would hit the host at once
+    stub_server.respond = lambda path, query, attempt: (503, {}, "") if attempt == 0 else (200, {}, "ok")
+
+    urls = [f"{stub_server.url}/page-{i}" for i in range(4)]
+    assert [response.text for response in fetch_all(fetch, urls, concurrency=4)] == ["ok"] * 4
+    request_times = sorted(request_time for request_time, _, _ in stub_server.requests)
+    assert len(request_times) == 8
+    assert all(later - earlier >= 0.09 for earlier, later in zip(request_times, request_times[1:]))
+
+
+def test_fetch_all_keeps_the_order_of_the_items(stub_server, monkeypatch):
+    monkeypatch.setattr(fetching, "_rate_limiter", fetching.HostRateLimiter(rate=None))
+
+    def respond(path, query, attempt):
+        # The first pages are the slowest to answer
+        index = int(path.rsplit("-", 1)[1])
+        time.sleep(0.05 * (5 - index))
+        return 200, {}, path
+
+    stub_server.respond = respond
+    urls = [f"{stub_server.url}/page-{i}" for i in range(6)]
+    assert [response.text for response in fetch_all(fetch, urls, concurrency=6)] == [f"/page-{i}" for i in range(6)]
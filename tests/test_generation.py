@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from generation import generation
+from generation.generation import GenerationClient
+from benchmarks.stub_llm import find_free_port, start_stub_llm
+
+
+ANSWER_TOKENS = 20
+
+
+@pytest.fixture
+def stub_llm(monkeypatch):
+    """ A local OpenAI-compatible server streaming ANSWER_TOKENS tokens per answer. """
+    port = find_free_port()
+    server = start_stub_llm(port, first_token_latency=0.01, tokens_per_second=1000, answer_tokens=ANSWER_TOKENS)
+    monkeypatch.setattr(generation, "OPENAI_BASE_URL", f"http://127.0.0.1:{port}/v1")
+    monkeypatch.setattr(generation, "OPENAI_KEY", "test-key")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+async def read_stream(prompt: str, limit: int = None, create=None) -> list[str]:
+    client = GenerationClient(requests_per_minute=None, tokens_per_minute=None)
+    if create is not None:
+        client._create = create
+    tokens = []
+    try:
+        stream = client.stream(prompt)
+        async for token in stream:
+            tokens.append(token)
+            if len(tokens) == limit:
+                break
+        await stream.aclose()
+        # The generation task is gone and its concurrency slot is free again
+        await asyncio.sleep(0.05)
+        assert not client.semaphore.locked() and client.semaphore._value == generation.LLM_MAX_CONCURRENT_REQUESTS
+        return tokens
+    finally:
+        await client.close()
+
+
+def test_stream_yields_the_answer(stub_llm):
+    tokens = asyncio.run(asyncio.wait_for(read_stream("Which networks were expanded?"), timeout=10))
+    assert len(tokens) > 0
+
+
+def test_reader_stopping_early_releases_the_slot(stub_llm):
+    tokens = asyncio.run(asyncio.wait_for(read_stream("Which networks were expanded?", limit=2), timeout=10))
+    assert len(tokens) == 2
+
+
+def test_unexpected_error_reaches_the_reader(stub_llm):
+    """ An error which isn't a GenerationError must still end the stream instead of leaving the reader waiting. """
+    async def create(prompt, stream):
+        raise RuntimeError("unexpected failure")
+
+    with pytest.raises(RuntimeError, match="unexpected failure"):
+        asyncio.run(asyncio.wait_for(read_stream("Which networks were expanded?", create=create), timeout=10))
@@ -0,0 +1,68 @@
+import os
+import importlib.util
+
+import numpy as np
+import pytest
+
+from constants import *
+from embeddings.embeddings import OnnxEmbedder, ONNX_MODEL_FILE, TOKENIZER_FILE
+
+
+ONNX_EXPORT_AVAILABLE = all(importlib.util.find_spec(name) is not None
+                            for name in ("onnxruntime", "tokenizers", "sentence_transformers")) \
+    and all(os.path.exists(os.path.join(ONNX_MODEL_DIR, name)) for name in (ONNX_MODEL_FILE, TOKENIZER_FILE))
+
+
+class StubEncoding:
+    def __init__(self, ids, attention_mask):
+        self.ids = ids
+        self.attention_mask = attention_mask
+        self.type_ids = [0] * len(ids)
+
+
+class StubTokenizer:
+    """ Two padded texts: 3 real tokens, and 1 real token followed by 2 padding tokens. """
+
+    def encode_batch(self, sentences):
+        return [StubEncoding([1, 2, 3], [1, 1, 1]), StubEncoding([4, 0, 0], [1, 0, 0])]
+
+
+class StubSession:
+    """ Returns fixed token embeddings, the padding tokens having huge values which must not leak into the pooling. """
+
+    def __init__(self, token_embeddings):
+        self.token_embeddings = token_embeddings
+        self.inputs = None
+
+    def run(self, output_names, inputs):
+        self.inputs = inputs
+        return [self.token_embeddings]
+
+
+def test_mean_pooling_ignores_padding_and_normalizes():
+    token_embeddings = np.array([
+        [[1.0, 0.0], [3.0, 0.0], [2.0, 3.0]],
+        [[0.0, 2.0], [100.0, 100.0], [-100.0, 50.0]],
+    ], dtype=np.float32)
+    embedder = OnnxEmbedder.__new__(OnnxEmbedder)
+    embedder.tokenizer = StubTokenizer()
+    embedder.session = StubSession(token_embeddings)
+    embedder.input_names = {"input_ids", "attention_mask"}
+
+    embeddings = embedder._encode_batch(["first text", "second"])
+
+    # Mean of the real tokens: (2, 1) and (0, 2), then scaled to unit length
+    np.testing.assert_allclose(embeddings, [[2 / np.sqrt(5), 1 / np.sqrt(5)], [0.0, 1.0]], rtol=1e-6)
+    # Only the inputs the graph declares are passed (models without token types)
+    assert set(embedder.session.inputs) == {"input_ids", "attention_mask"}
+
+
+@pytest.mark.skipif(not ONNX_EXPORT_AVAILABLE,
+                    reason=f"onnxruntime, tokenizers or sentence_transformers is missing, or no export in '{ONNX_MODEL_DIR}'")
+def test_float32_export_matches_pytorch():
+    from sentence_transformers import SentenceTransformer
+    from embeddings.export import check_tolerance, TOLERANCE_CHECK_SENTENCES
+
+    reference_model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+    report = check_tolerance(reference_model, OnnxEmbedder(ONNX_MODEL_DIR, quantized=False), TOLERANCE_CHECK_SENTENCES)
+    assert report["min_cosine_similarity"] >= ONNX_FLOAT32_MIN_COSINE_SIMILARITY
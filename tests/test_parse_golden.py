@@ -0,0 +1,36 @@
+import os
+import glob
+import importlib.util
+
+import pytest
+
+from scraping.parse_check import FIXTURES_DIR, load_fixtures, parse_article_reference
+from scraping.scraping import parse_article_html
+
+
+FIXTURE_NAMES = [os.path.splitext(os.path.basename(path))[0]
+                 for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))]
+PARSERS = ["html.parser", pytest.param("lxml", marks=pytest.mark.skipif(importlib.util.find_spec("lxml") is None,
+                                                                         reason="lxml is not installed"))]
+
+
+@pytest.fixture(scope="module")
+def fixtures() -> dict:
+    return dict(zip(FIXTURE_NAMES, load_fixtures(FIXTURES_DIR)))
+
+
+def test_fixtures_are_saved():
+    assert len(FIXTURE_NAMES) >= 3
+
+
+@pytest.mark.parametrize("name", FIXTURE_NAMES)
+def test_reference_parse_matches_golden_output(fixtures, name):
+    html, golden = fixtures[name]
+    assert parse_article_reference(html, golden["link"]) == golden
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("name", FIXTURE_NAMES)
+def test_strained_parse_matches_golden_output(fixtures, name, parser):
+    html, golden = fixtures[name]
+    assert parse_article_html(html, golden["link"], parser) == golden
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from scraping import scraping
+from scraping.scraping import scrape_article_urls
+
+
+ARTICLES_PER_PAGE = 4
+PAGES = 6
+
+
+@pytest.fixture
+def press_release_feed(stub_server, rate_limiter, monkeypatch):
+    """ A paged feed of ARTICLES_PER_PAGE * PAGES press releases, newest first, then empty pages. """
+    monkeypatch.setattr(scraping, "TELEKOM_BASE_URL", stub_server.url)
+    monkeypatch.setattr(scraping, "PRESS_RELEASES_URL", f"{stub_server.url}/feed")
+    monkeypatch.setattr(scraping, "PRESS_RELEASES_TARGET_COUNT", 100)
+    monkeypatch.setattr(scraping, "SCRAPING_CONCURRENCY", 3)
+
+    def respond(path, query, attempt):
+        page = int(query["page_active"])
+        # The later pages answer first, the order of the URLs must not depend on it
+        time.sleep(0.02 * max(0, 3 - page))
+        links = "".join(f'<a class="media-link" href="/press-release-{page * ARTICLES_PER_PAGE + i}">Article</a>'
+                        for i in range(ARTICLES_PER_PAGE) if page < PAGES)
+        return 200, {}, f"<html><body><div>{links}</div></body></html>"
+
+    stub_server.respond = respond
+    return stub_server
+
+
+def get_article_url(server, number: int) -> str:
+    return f"{server.url}/press-release-{number}"
+
+
+def get_requested_pages(server) -> list[int]:
+    return sorted(int(query["page_active"]) for _, path, query in server.requests if path == "/feed")
+
+
+def test_scrapes_every_page_in_order(press_release_feed):
+    urls = scrape_article_urls()
+
+    assert urls == [get_article_url(press_release_feed, i) for i in range(ARTICLES_PER_PAGE * PAGES)]
+    assert PAGES in get_requested_pages(press_release_feed)
+
+
+def test_stops_at_the_first_known_article(press_release_feed):
+    known_urls = {get_article_url(press_release_feed, 2 * ARTICLES_PER_PAGE + 1)}
+
+    urls = scrape_article_urls(known_urls)
+
+    # Everything up to the page of the known article, nothing after it
+    assert urls == [get_article_url(press_release_feed, i) for i in range(3 * ARTICLES_PER_PAGE)]
+    # Only the batch of listing pages fetched in parallel with the page of the known article
+    assert get_requested_pages(press_release_feed) == [0, 1, 2, 3]
+
+
+def test_stops_on_the_first_page_when_it_is_known(press_release_feed):
+    urls = scrape_article_urls({get_article_url(press_release_feed, 0)})
+
+    assert urls == [get_article_url(press_release_feed, i) for i in range(ARTICLES_PER_PAGE)]
+    assert get_requested_pages(press_release_feed) == [0]
+
+
+def test_only_fetches_the_pages_needed_for_the_target_count(press_release_feed, monkeypatch):
+    monkeypatch.setattr(scraping, "PRESS_RELEASES_TARGET_COUNT", 10)
+
+    urls = scrape_article_urls()
+
+    assert urls == [get_article_url(press_release_feed, i) for i in range(10)]
+    assert get_requested_pages(press_release_feed) == [0, 1, 2]
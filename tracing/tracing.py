@@ -0,0 +1,228 @@
+import json
+import time
+import uuid
+import threading
+from contextvars import ContextVar
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from constants import *
+
+
+# The trace of the question being answered, per thread (Streamlit runs every session on its own thread)
+_current_trace = ContextVar("current_trace", default=None)
+
+_exporters = None
+_exporters_lock = threading.Lock()
+
+
+class Span:
+    """ Times a stage of the current trace. Use `span(name)` to create one. """
+
+    def __init__(self, trace, name: str):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self.trace.spans.append({
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.start) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "error": None if exc_type is None else exc_type.__name__,
+        })
+
+
+class NoopSpan:
+    """ Returned when tracing is disabled or no trace is active, so that instrumented code costs one function call. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+    """ The spans, counts (chunks, tokens), attributes and errors of one request. Exported when it ends. """
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.spans = []
+        self.counts = defaultdict(int)
+        self.attributes = {}
+        self.errors = []
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration_ms = round((time.perf_counter() - self.start) * 1000, 3)
+        if exc_type is not None:
+            self.errors.append({"kind": self.name, "error": f"{exc_type.__name__}: {exc_value}"})
+        _current_trace.reset(self._token)
+        for exporter in get_exporters():
+            try:
+                exporter.export(self)
+            except Exception as e:
+                # Monitoring should never break the answer
+                print(f"Error exporting the trace with {type(exporter).__name__}: {e}")
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "spans": self.spans,
+            "counts": dict(self.counts),
+            "attributes": self.attributes,
+            "errors": self.errors,
+        }
+
+
+def start_trace(name: str):
+    """ Trace a request: `with start_trace("question"): ...`. Does nothing when tracing is disabled. """
+    if not TRACING_ENABLED:
+        return NOOP_SPAN
+    return Trace(name)
+
+
+def span(name: str):
+    """ Time a stage of the current request: `with span("retrieve"): ...`. Does nothing outside of a trace. """
+    trace = _current_trace.get()
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name)
+
+
+def add_count(name: str, value: int):
+    """ Add to a count of the current request, e.g. the retrieved chunks or the prompt tokens. """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.counts[name] += value
+
+
+def set_attribute(name: str, value):
+    """ Attach a (JSON serializable) value to the current request, e.g. a cache hit or a query plan. """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[name] = value
+
+
+def record_error(kind: str, error: Exception):
+    """ Record an error which was handled (e.g. a cache or LLM failure), so that it shows up in the metrics. """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.errors.append({"kind": kind, "error": f"{type(error).__name__}: {error}"})
+
+
+def current_trace_id() -> str | None:
+    trace = _current_trace.get()
+    return None if trace is None else trace.trace_id
+
+
+class LogExporter:
+    """ Print every trace as one JSON line, to be shipped by the log collector. """
+
+    def export(self, trace: Trace):
+        print(f"TRACE {json.dumps(trace.to_dict(), default=str)}")
+
+
+class PrometheusExporter:
+    """
+    Aggregate the traces into Prometheus metrics (a latency histogram per span, counters for the counts and the
+    errors) and serve them in the text format on http://<host>:PROMETHEUS_PORT/metrics.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+
+    def __init__(self, port: int = PROMETHEUS_PORT):
+        self._lock = threading.Lock()
+        self._histograms = {}  # span name -> [bucket counts..., sum, count]
+        self._counts = defaultdict(int)
+        self._errors = defaultdict(int)
+
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f"Serving the Prometheus metrics on port {port}.")
+        except OSError as e:
+            # E.g. another process of the app already serves them
+            self.server = None
+            print(f"Error starting the Prometheus metrics endpoint on port {port}: {e}")
+
+    def _observe(self, name: str, seconds: float):
+        histogram = self._histograms.setdefault(name, [0] * (len(self.BUCKETS) + 2))
+        for i, bucket in enumerate(self.BUCKETS):
+            if seconds <= bucket:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def export(self, trace: Trace):
+        with self._lock:
+            self._observe(trace.name, trace.duration_ms / 1000)
+            for trace_span in trace.spans:
+                self._observe(trace_span["name"], trace_span["duration_ms"] / 1000)
+            for name, value in trace.counts.items():
+                self._counts[name] += value
+            for error in trace.errors:
+                self._errors[error["kind"]] += 1
+
+    def render(self) -> str:
+        lines = ["# TYPE rag_span_duration_seconds histogram"]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                for bucket, count in zip(self.BUCKETS, histogram):
+                    lines.append(f'rag_span_duration_seconds_bucket{{span="{name}",le="{bucket}"}} {count}')
+                lines.append(f'rag_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {histogram[-1]}')
+                lines.append(f'rag_span_duration_seconds_sum{{span="{name}"}} {histogram[-2]}')
+                lines.append(f'rag_span_duration_seconds_count{{span="{name}"}} {histogram[-1]}')
+            for name, value in sorted(self._counts.items()):
+                lines.append(f"# TYPE rag_{name}_total counter")
+                lines.append(f"rag_{name}_total {value}")
+            lines.append("# TYPE rag_errors_total counter")
+            for kind, value in sorted(self._errors.items()):
+                lines.append(f'rag_errors_total{{kind="{kind}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+EXPORTERS = {"log": LogExporter, "prometheus": PrometheusExporter}
+
+
+def get_exporters() -> list:
+    """ Return the (process-wide) exporters configured in TRACING_EXPORTERS. """
+    global _exporters
+    if _exporters is None:
+        with _exporters_lock:
+            if _exporters is None:
+                _exporters = [EXPORTERS[name]() for name in TRACING_EXPORTERS]
+    return _exporters